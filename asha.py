@@ -0,0 +1,430 @@
+'''
+Asynchronous successive halving (ASHA) over the JobIterator experiments
+
+Every JobIterator index of the hyperparameter set (see hw6_base.exp_type_to_hyperparameters())
+is a trial.  Trials are trained in rungs of increasing epoch budgets:
+
+min_epochs, min_epochs * eta, min_epochs * eta^2, ... , --epochs
+
+A worker that asks for a job promotes a trial to the next rung as soon as it is among the
+best 1/eta of the trials that have finished the current rung (the highest rung first); if no
+trial can be promoted, it starts a new trial at the lowest rung.  No worker ever waits for a
+rung to fill up.
+
+A trial runs as 'hw6_base.py <arguments> --exp_index i --epoch_budget b': the run continues
+from its checkpoints up to b epochs and records its progress in <fbase>_budget.json.  At the
+last rung (b = --epochs) it writes its results as usual, so the results of the trials that
+survive to the end are exactly those of a full grid run (same file names, same catalog keys).
+
+State store: a directory on a shared file system that all workers (local threads, other
+processes, SLURM array tasks) use without locks.  Every decision is a file that is created
+exclusively, so only one worker can claim a trial at a rung:
+
+config.json                  rungs, eta, metric (written by the first worker; checked by the others)
+claims/t<trial>_r<rung>      a worker has started the trial at the rung (refreshed while it runs)
+results/t<trial>_r<rung>.json   the metric of the trial at the rung
+
+A claim whose worker has not refreshed it for --claim_timeout seconds (e.g., a preempted SLURM
+task) is taken over by the next worker.
+
+Examples:
+
+# 4 local workers
+python asha.py @parameters.txt --state_dir results/asha --min_epochs 2 --eta 3 --workers 4
+
+# One worker per SLURM array task (all tasks share the state directory)
+python asha.py @parameters.txt --state_dir results/asha --min_epochs 2 --eta 3
+
+# Progress
+python asha.py @parameters.txt --state_dir results/asha --report
+
+All arguments other than the ones below are passed on to hw6_base.py.
+
+'''
+import argparse
+import copy
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from job_control import JobIterator
+from results_io import read_budget, read_results, results_exist
+from run_catalog import results_metrics
+
+
+def rung_budgets(min_epochs, eta, max_epochs):
+    '''
+    :param min_epochs: Budget of the lowest rung
+    :param eta: Reduction factor (each rung keeps the best 1/eta)
+    :param max_epochs: Budget of the last rung (the full run)
+    :return: List of epoch budgets, one per rung
+    '''
+    assert min_epochs >= 1 and eta >= 2, "min_epochs must be positive and eta at least 2"
+    budgets = []
+    b = min_epochs
+    while b < max_epochs:
+        budgets.append(b)
+        b *= eta
+    return budgets + [max_epochs]
+
+
+def _create(fname, obj):
+    '''
+    Create a json file exclusively
+
+    :return: True if this call created the file; False if it already existed
+    '''
+    try:
+        fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(obj, fp)
+    return True
+
+
+def _read(fname):
+    try:
+        with open(fname, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+class StateStore:
+    def __init__(self, dirname, config, claim_timeout=600.0):
+        '''
+        Open (and create, if needed) the shared state of a search
+
+        @param dirname State directory
+        @param config Configuration of the search (rungs, eta, metric, mode, njobs); must match that of
+                      an existing search in the directory
+        @param claim_timeout Seconds after which a claim that is not refreshed is considered abandoned
+        '''
+        self.dirname = dirname
+        self.claim_timeout = claim_timeout
+        os.makedirs(os.path.join(dirname, 'claims'), exist_ok=True)
+        os.makedirs(os.path.join(dirname, 'results'), exist_ok=True)
+
+        fname = os.path.join(dirname, 'config.json')
+        if not _create(fname, config):
+            stored = _read(fname)
+            assert stored == config, "%s holds a different search: %s" % (fname, stored)
+        self.config = config
+
+    def _claim_fname(self, trial, rung):
+        return os.path.join(self.dirname, 'claims', 't%05d_r%d' % (trial, rung))
+
+    def _result_fname(self, trial, rung):
+        return os.path.join(self.dirname, 'results', 't%05d_r%d.json' % (trial, rung))
+
+    def claim(self, trial, rung):
+        '''
+        @return Claim token if this worker now owns the trial at the rung, otherwise None
+        '''
+        token = {'id': uuid.uuid4().hex, 'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+        fname = self._claim_fname(trial, rung)
+        if _create(fname, token):
+            return token
+
+        # Take over an abandoned claim.  The claim is identified by its inode and modification time,
+        #  so that a claim that another worker has just taken over is never mistaken for the stale one
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        if time.time() - st.st_mtime <= self.claim_timeout or self.result(trial, rung) is not None:
+            return None
+
+        # Only one worker can create the takeover marker of a given stale claim
+        if not _create('%s.takeover.%d_%d' % (fname, st.st_ino, st.st_mtime_ns), token):
+            return None
+        tmp = '%s.%s.tmp' % (fname, token['id'])
+        with open(tmp, 'w') as fp:
+            json.dump(token, fp)
+        os.replace(tmp, fname)
+        owner = _read(fname)
+        return token if owner is not None and owner['id'] == token['id'] else None
+
+    def refresh(self, trial, rung):
+        '''
+        Mark a claim as alive
+        '''
+        try:
+            os.utime(self._claim_fname(trial, rung))
+        except OSError:
+            pass
+
+    def claimed(self):
+        '''
+        @return Set of (trial, rung) pairs that have been claimed
+        '''
+        out = set()
+        for f in os.listdir(os.path.join(self.dirname, 'claims')):
+            if f.startswith('t') and '.' not in f:
+                t, r = f[1:].split('_r')
+                out.add((int(t), int(r)))
+        return out
+
+    def record(self, trial, rung, result):
+        '''
+        Store the result of a trial at a rung
+        '''
+        fname = self._result_fname(trial, rung)
+        tmp = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(dict(result, trial=trial, rung=rung), fp)
+        os.replace(tmp, fname)
+
+    def result(self, trial, rung):
+        return _read(self._result_fname(trial, rung))
+
+    def results(self):
+        '''
+        @return Dictionary rung -> list of results (see record())
+        '''
+        out = {}
+        for f in os.listdir(os.path.join(self.dirname, 'results')):
+            if f.endswith('.json'):
+                r = _read(os.path.join(self.dirname, 'results', f))
+                if r is not None:
+                    out.setdefault(r['rung'], []).append(r)
+        return out
+
+
+class ASHA:
+    def __init__(self, store, njobs, eta, mode='max', seed=None):
+        '''
+        @param store StateStore
+        @param njobs Number of trials (JobIterator indices)
+        @param eta Reduction factor
+        @param mode 'max' (e.g., accuracy) or 'min' (e.g., loss): direction of a better metric
+        @param seed Seed of the order in which new trials are started (None -> index order)
+        '''
+        self.store = store
+        self.nrungs = len(store.config['rungs'])
+        self.eta = eta
+        self.sign = 1.0 if mode == 'max' else -1.0
+        self.order = list(range(njobs))
+        if seed is not None:
+            import random
+            random.Random(seed).shuffle(self.order)
+
+    def promotable(self, results, claimed, rung):
+        '''
+        @return Trials at the rung that are in its best 1/eta and have not been promoted yet (best first)
+        '''
+        done = [r for r in results.get(rung, []) if r.get('metric') is not None]
+        done.sort(key=lambda r: -self.sign * r['metric'])
+        return [r['trial'] for r in done[:len(done) // self.eta] if (r['trial'], rung + 1) not in claimed]
+
+    def next_job(self):
+        '''
+        Claim the next job
+
+        @return Tuple (trial, rung), 'wait' if only running jobs are left (their results may allow
+                promotions), or None if the search is complete
+        '''
+        while True:
+            results = self.store.results()
+            claimed = self.store.claimed()
+
+            candidates = []
+            for rung in range(self.nrungs - 2, -1, -1):
+                candidates += [(t, rung + 1) for t in self.promotable(results, claimed, rung)]
+            candidates += [(t, 0) for t in self.order if (t, 0) not in claimed]
+
+            if len(candidates) == 0:
+                # Claims without a result: running, or abandoned (these are taken over once they time out)
+                running = [c for c in claimed if self.store.result(*c) is None]
+                for trial, rung in running:
+                    if self.store.claim(trial, rung) is not None:
+                        return trial, rung
+                return 'wait' if len(running) > 0 else None
+
+            for trial, rung in candidates:
+                if self.store.claim(trial, rung) is not None:
+                    return trial, rung
+            # Every candidate was claimed by another worker in the meantime: look again
+
+
+def trial_fbase(hw6_args, ji, trial):
+    '''
+    :param hw6_args: hw6_base.py arguments (argparse.Namespace)
+    :param ji: JobIterator of the trials
+    :param trial: JobIterator index
+    :return: File base of the run (as generated by hw6_base.generate_fname())
+    '''
+    import hw6_base
+
+    args = copy.copy(hw6_args)
+    args.exp_index = trial
+    return hw6_base.generate_fname(args, ji.set_attributes_by_index(trial, args))
+
+
+def trial_metric(fbase, metric='best_validation_accuracy'):
+    '''
+    :param fbase: File base of the run
+    :param metric: Name of a metric of run_catalog.results_metrics()
+    :return: Tuple (metric value or None, epochs trained)
+    '''
+    if results_exist(fbase) is not None:
+        metrics = results_metrics(read_results(fbase, fields=['history', 'predict_validation_eval',
+                                                               'predict_validation_metrics']))
+    else:
+        budget = read_budget(fbase)
+        metrics = {} if budget is None else results_metrics({'history': budget['history']})
+    return metrics.get(metric), int(metrics.get('epochs_trained', 0))
+
+
+def run_trial(argv, trial, budget, heartbeat=None, log=None):
+    '''
+    Train a trial up to an epoch budget (continuing from its checkpoints) in a child process
+
+    :param argv: hw6_base.py arguments
+    :param trial: JobIterator index
+    :param budget: Epoch budget
+    :param heartbeat: Function called about once a minute while the trial runs (None -> none)
+    :param log: File for the output of the trial (None -> this process' output)
+    :return: Exit status
+    '''
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hw6_base.py')] + argv + \
+        ['--exp_index', str(trial), '--epoch_budget', str(budget)]
+    fp = None if log is None else open(log, 'a')
+    try:
+        proc = subprocess.Popen(cmd, stdout=fp, stderr=subprocess.STDOUT if fp is not None else None)
+        while True:
+            try:
+                return proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                if heartbeat is not None:
+                    heartbeat()
+    finally:
+        if fp is not None:
+            fp.close()
+
+
+def worker(argv, hw6_args, ji, asha, metric='best_validation_accuracy', poll=30.0, log_dir=None):
+    '''
+    Claim and run jobs until the search is complete
+
+    :param argv: hw6_base.py arguments
+    :param hw6_args: Parsed hw6_base.py arguments
+    :param ji: JobIterator of the trials
+    :param asha: ASHA scheduler
+    :param metric: Name of the metric that ranks the trials
+    :param poll: Seconds to wait when only running jobs are left
+    :param log_dir: Directory for the output of each trial (None -> this process' output)
+    :return: Number of jobs run
+    '''
+    store = asha.store
+    njobs = 0
+    while True:
+        job = asha.next_job()
+        if job is None:
+            return njobs
+        if job == 'wait':
+            time.sleep(poll)
+            continue
+
+        trial, rung = job
+        budget = store.config['rungs'][rung]
+        print('Trial %d: rung %d (%d epochs)' % (trial, rung, budget))
+        log = None if log_dir is None else os.path.join(log_dir, 't%05d_r%d.txt' % (trial, rung))
+        start = time.time()
+        status = run_trial(argv, trial, budget, heartbeat=lambda: store.refresh(trial, rung), log=log)
+
+        fbase = trial_fbase(hw6_args, ji, trial)
+        value, epochs = trial_metric(fbase, metric) if status == 0 else (None, 0)
+        # A failed trial gets no metric: it is never promoted
+        store.record(trial, rung, {'metric': value, 'epochs': epochs, 'budget': budget, 'status': status,
+                                   'wall_time': time.time() - start, 'fbase': fbase, 'host': socket.gethostname()})
+        print('Trial %d: rung %d %s = %s (exit status %d)' % (trial, rung, metric, value, status))
+        njobs += 1
+
+
+def report(store, ji):
+    '''
+    :param store: StateStore
+    :param ji: JobIterator of the trials
+    :return: Human-readable table: the metric of each trial at each rung (best trials first)
+    '''
+    results = store.results()
+    claimed = store.claimed()
+    rungs = store.config['rungs']
+    sign = 1.0 if store.config['mode'] == 'max' else -1.0
+
+    rows = {}
+    for rung, rs in results.items():
+        for r in rs:
+            rows.setdefault(r['trial'], [None] * len(rungs))[rung] = r['metric']
+
+    def best(t):
+        # Highest rung first, then the metric at that rung
+        k = max(i for i, v in enumerate(rows[t]) if v is not None) if any(v is not None for v in rows[t]) else -1
+        return (-k, -sign * rows[t][k] if k >= 0 else 0)
+
+    lines = ['%6s %s  %s' % ('trial', ' '.join('%8s' % ('e%d' % b) for b in rungs), 'parameters')]
+    for t in sorted(rows, key=best):
+        lines.append('%6d %s  %s' % (t, ' '.join('%8s' % ('-' if v is None else '%.4f' % v) for v in rows[t]),
+                                     ji.get_param_str(t)))
+    running = sorted(c for c in claimed if store.result(*c) is None)
+    lines.append('Running: %s' % ', '.join('%d@r%d' % c for c in running))
+    lines.append('Trials started: %d of %d' % (len({t for t, r in claimed if r == 0}), ji.get_njobs()))
+    return '\n'.join(lines)
+
+
+def create_parser():
+    '''
+    Create argument parser (the remaining arguments are passed on to hw6_base.py)
+    '''
+    parser = argparse.ArgumentParser(description='Asynchronous successive halving over the JobIterator experiments',
+                                     fromfile_prefix_chars='@')
+    parser.add_argument('--state_dir', type=str, required=True, help='Shared state directory of the search')
+    parser.add_argument('--min_epochs', type=int, default=2, help='Epoch budget of the lowest rung')
+    parser.add_argument('--eta', type=int, default=3, help='Reduction factor: each rung promotes its best 1/eta')
+    parser.add_argument('--metric', type=str, default='best_validation_accuracy',
+                        help='Metric that ranks the trials (see run_catalog.results_metrics())')
+    parser.add_argument('--mode', type=str, default='max', choices=['max', 'min'], help='Direction of a better metric')
+    parser.add_argument('--workers', type=int, default=1, help='Number of workers in this process')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the order of new trials (default: index order)')
+    parser.add_argument('--poll', type=float, default=30.0, help='Seconds between looks while waiting for results')
+    parser.add_argument('--claim_timeout', type=float, default=600.0,
+                        help='Seconds after which a claim that is not refreshed is taken over')
+    parser.add_argument('--log_dir', type=str, default=None, help='Directory for the output of each trial')
+    parser.add_argument('--report', action='store_true', help='Report the state of the search and exit')
+    return parser
+
+
+if __name__ == "__main__":
+    args, argv = create_parser().parse_known_args()
+
+    import hw6_base
+    hw6_args = hw6_base.create_parser().parse_args(argv)
+    hw6_base.check_args(hw6_args)
+    ji = JobIterator(hw6_base.exp_type_to_hyperparameters(hw6_args))
+
+    config = {'rungs': rung_budgets(args.min_epochs, args.eta, hw6_args.epochs),
+              'eta': args.eta,
+              'metric': args.metric,
+              'mode': args.mode,
+              'njobs': ji.get_njobs()}
+    store = StateStore(args.state_dir, config, claim_timeout=args.claim_timeout)
+
+    if args.report:
+        print(report(store, ji))
+        sys.exit(0)
+
+    if args.log_dir is not None:
+        os.makedirs(args.log_dir, exist_ok=True)
+    print('Rungs (epochs): %s; %d trials' % (config['rungs'], config['njobs']))
+    asha = ASHA(store, ji.get_njobs(), args.eta, mode=args.mode, seed=args.seed)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(worker, argv, hw6_args, ji, asha, args.metric, args.poll, args.log_dir)
+                   for _ in range(args.workers)]
+        print('Jobs run: %d' % sum(f.result() for f in futures))
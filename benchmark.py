@@ -0,0 +1,560 @@
+'''
+Benchmarks and consistency checks for the PFAM data path
+
+Tokenizer:
+    python benchmark.py --dataset /home/fagg/datasets/pfam --fold 0
+
+    Checks that the vectorized tokenizer in pfam_loader produces exactly the same
+    padded token ids and class indices as the keras Tokenizer + pad_sequences path
+    when both are fit on the same strings, and reports the throughput of both (strings/sec).
+
+Rotation parity:
+    python benchmark.py --dataset /home/fagg/datasets/pfam --rotation_parity --rotation 0
+
+    Compares prepare_data_set(rotation=r) with the original keras path, which fit the
+    tokenizers on the training folds of the rotation.  The token ids are NOT expected to be
+    identical: the fold caches use one vocabulary fit on all folds (so that a cached fold does
+    not depend on the rotation), which changes the id order and n_tokens, and keeps characters
+    that only occur in the validation/test folds (keras dropped them).  The check reports
+    whether the ids are identical and whether the two data sets are the same up to a
+    relabeling of the ids (same strings, padding, truncation and classes).
+
+Memory footprint:
+    python benchmark.py --dataset /home/fagg/datasets/pfam --footprint --rotation 0
+
+    Reports the size of the arrays of one rotation as stored (compact integer types)
+    and as they would be with int32 tokens/labels.
+
+Startup time:
+    python benchmark.py --startup
+
+    Times 'python hw6_base.py --check' and 'python hw6_base.py --nogo' (the
+    control paths, which must not import TensorFlow).
+
+Benchmark suite (CPU, synthetic data):
+    python benchmark.py --suite --out bench.json
+    python benchmark.py --suite --out bench_new.json --compare bench.json --tolerance 0.1
+
+    Generates synthetic PFAM-like folds (random amino-acid strings with a long-tailed
+    length distribution and imbalanced classes) and times the hot paths: CSV loading,
+    prepare_data_set() (cold: builds the fold caches; warm: from the caches),
+    load_rotation() from the memory-mappable layout, create_tf_datasets() iteration
+    throughput (padded and length-bucketed), and the train/inference step time of
+    create_network() models over a grid of batch sizes, rnnNeurons and embedding_length, for
+    the default and the compiled (--compiled: XLA + fused recurrent kernel) models.
+    The results are written as json.  With --compare, each benchmark is checked against a
+    stored baseline and the run fails (exit code 1) if any of them is more than
+    --tolerance worse.
+
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from pfam_loader import *
+
+
+def keras_tokenize(train_strings, train_labels, strings, labels, len_max):
+    '''
+    Reference (keras) tokenization, as originally done by prepare_data_set()
+
+    :param train_strings: Strings to fit the tokenizer on
+    :param train_labels: Class names to fit the label tokenizer on
+    :param strings: Strings to tokenize
+    :param labels: Class names to encode
+    :param len_max: Length of the padded strings
+
+    :return: Tuple (padded tokens, class indices (examples x 1))
+    '''
+    from tensorflow import keras
+    from tensorflow.keras.preprocessing.sequence import pad_sequences
+
+    tokenizer = keras.preprocessing.text.Tokenizer(char_level=True, filters='\t\n')
+    tokenizer.fit_on_texts(train_strings)
+    ins = pad_sequences(tokenizer.texts_to_sequences(strings), maxlen=len_max)
+
+    tokenizer = keras.preprocessing.text.Tokenizer(filters='\t\n')
+    tokenizer.fit_on_texts(train_labels)
+    outs = np.array(tokenizer.texts_to_sequences(labels)) - 1
+
+    return ins, outs
+
+
+def numpy_tokenize(train_strings, train_labels, strings, labels, len_max):
+    '''
+    Vectorized tokenization (pfam_loader)
+
+    :return: Tuple (padded tokens, class indices (examples x 1))
+    '''
+    word_index = fit_char_vocabulary([train_strings])
+    out_word_index = fit_label_vocabulary([train_labels])
+
+    ins = texts_to_padded(strings, word_index, len_max)
+    outs = encode_labels(labels, out_word_index).reshape(-1, 1) - 1
+
+    return ins, outs
+
+
+def bench_tokenizer(strings, labels, len_max=None, repeats=3):
+    '''
+    Check parity of the two tokenizers and time them
+
+    :param strings: Strings to tokenize
+    :param labels: Class names
+    :param len_max: Length of the padded strings (None -> longest string)
+    :param repeats: Number of timing repetitions (best is reported)
+
+    :return: Dictionary of results
+    '''
+    if len_max is None:
+        len_max = max(len(s) for s in strings)
+
+    results = {'n_strings': len(strings), 'len_max': int(len_max)}
+    outputs = {}
+    for name, fn in [('keras', keras_tokenize), ('numpy', numpy_tokenize)]:
+        best = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            outputs[name] = fn(strings, labels, strings, labels, len_max)
+            best = min(best, time.perf_counter() - start)
+        results['%s_strings_per_sec' % name] = len(strings) / best
+
+    ins_k, outs_k = outputs['keras']
+    ins_n, outs_n = outputs['numpy']
+    results['parity'] = bool(np.array_equal(ins_k, ins_n) and np.array_equal(outs_k, outs_n))
+
+    return results
+
+
+def rotation_parity(basedir, rotation=0, nfolds=5, ntrain_folds=3, cachedir=None):
+    '''
+    Compare prepare_data_set() with the keras path fit on the training folds of the rotation
+
+    :param basedir: Directory containing input files
+    :param rotation: Rotation to compare
+    :param nfolds: Total number of folds
+    :param ntrain_folds: Number of training folds
+    :param cachedir: Directory for the cache files (None -> use the basedir)
+
+    :return: Dictionary of results: n_tokens of both paths, whether the ids are identical and,
+             for each split, whether the data sets are identical up to a relabeling of the ids
+    '''
+    dat = prepare_data_set(basedir=basedir, rotation=rotation, nfolds=nfolds, ntrain_folds=ntrain_folds,
+                           cachedir=cachedir)
+
+    splits = dict(zip(['train', 'valid', 'test'], rotation_folds(rotation, nfolds, ntrain_folds)))
+    dfs = {k: pd.concat([load_pfam_file(basedir, f) for f in fs]) for k, fs in splits.items()}
+    train_strings, train_labels = dfs['train']['string'].values, dfs['train']['label'].values
+    len_max = max(len(s) for s in train_strings)
+
+    # The keras vocabulary of the rotation (fit_*_vocabulary() reproduces it exactly)
+    word_index = fit_char_vocabulary([train_strings])
+    out_word_index = fit_label_vocabulary([train_labels])
+    # keras id -> cached (global) id
+    char_map = np.zeros(len(word_index) + 1, dtype=np.int64)
+    for c, i in word_index.items():
+        char_map[i] = dat['word_index'][c]
+    label_map = np.zeros(len(out_word_index), dtype=np.int64)
+    for w, i in out_word_index.items():
+        label_map[i - 1] = dat['out_word_index'][w] - 1
+
+    results = {'rotation': rotation,
+               'len_max': int(len_max),
+               'n_tokens_keras': len(word_index) + 2,
+               'n_tokens_cached': int(dat['n_tokens']),
+               'ids_identical': True}
+    for k, df in dfs.items():
+        ins_k, outs_k = keras_tokenize(train_strings, train_labels, df['string'].values, df['label'].values,
+                                       len_max)
+        ins_c, outs_c = dat['ins_' + k], dat['outs_' + k]
+        results['ids_identical'] &= bool(np.array_equal(ins_k, ins_c) and np.array_equal(outs_k, outs_c))
+        results['equivalent_' + k] = bool(np.array_equal(char_map[ins_k], ins_c) and
+                                          np.array_equal(label_map[outs_k], outs_c))
+
+    return results
+
+
+def rotation_footprint(dat):
+    '''
+    Memory footprint of the arrays of a rotation
+
+    :param dat: Data structure from load_rotation() or prepare_data_set()
+    :return: Dictionary containing the bytes used by the arrays as stored and with int32 entries
+    '''
+    arrays = [v for k, v in dat.items() if (k.startswith('ins_') or k.startswith('outs_')) and v is not None]
+    return {'bytes': int(sum(a.nbytes for a in arrays)),
+            'bytes_int32': int(sum(a.size * 4 for a in arrays))}
+
+
+def bench_startup(argv, repeats=3):
+    '''
+    Time a complete invocation of hw6_base.py
+
+    :param argv: Arguments for hw6_base.py
+    :param repeats: Number of timing repetitions (best is reported)
+
+    :return: Wall time of the fastest invocation (seconds)
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hw6_base.py')
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script] + argv, check=True, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+#################################################################
+# Benchmark suite
+
+# Families and relative frequencies of the synthetic folds (up to 1:10 imbalance, as in PFAM)
+SYNTHETIC_CLASSES = {'PF01925': 10, 'PF01810': 5, 'PF02659': 2, 'PF03824': 1}
+
+# The 20 standard amino acids, plus rare/ambiguous codes
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+RARE_CODES = 'XUBZ'
+
+
+def synthetic_strings(n, rng, len_median=250, len_sigma=0.5, len_max=1340):
+    '''
+    Random amino-acid strings with a log-normal length distribution
+
+    :param n: Number of strings
+    :param rng: numpy Generator
+    :param len_median: Median string length
+    :param len_sigma: Spread of the (log) lengths
+    :param len_max: Longest string
+    :return: List of strings
+    '''
+    lengths = np.clip(np.round(rng.lognormal(np.log(len_median), len_sigma, n)), 10, len_max).astype(int)
+    alphabet = np.frombuffer((AMINO_ACIDS + RARE_CODES).encode(), dtype=np.uint8)
+    p = np.r_[np.full(len(AMINO_ACIDS), 0.998 / len(AMINO_ACIDS)), np.full(len(RARE_CODES), 0.002 / len(RARE_CODES))]
+    chars = alphabet[rng.choice(len(alphabet), size=int(lengths.sum()), p=p)].tobytes().decode()
+    ends = np.cumsum(lengths)
+    return [chars[e - l:e] for e, l in zip(ends, lengths)]
+
+
+def write_synthetic_folds(dirname, nfolds=5, examples_per_fold=2000, seed=0, len_max=1340):
+    '''
+    Write synthetic pfam_fold_%d.csv files
+
+    :param dirname: Output directory
+    :param nfolds: Number of folds
+    :param examples_per_fold: Number of examples in each fold (+/- 10%)
+    :param seed: Random seed
+    :param len_max: Longest string
+    :return: dirname
+    '''
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    names = list(SYNTHETIC_CLASSES)
+    p = np.array(list(SYNTHETIC_CLASSES.values()), dtype=float)
+    p /= p.sum()
+
+    os.makedirs(dirname, exist_ok=True)
+    for f in range(nfolds):
+        n = int(examples_per_fold * rng.uniform(0.9, 1.1))
+        df = pd.DataFrame({'string': synthetic_strings(n, rng, len_max=len_max),
+                           'label': [names[i] for i in rng.choice(len(names), size=n, p=p)]})
+        df.to_csv('%s/pfam_fold_%d.csv' % (dirname, f), index=False)
+    return dirname
+
+
+def time_repeats(fn, repeats=3):
+    '''
+    :param fn: Function to time (no arguments)
+    :param repeats: Number of repetitions
+    :return: Tuple (fastest wall time (seconds), result of the last call)
+    '''
+    best = np.inf
+    out = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def _entry(value, unit, higher_is_better):
+    return {'value': float(value), 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def bench_loader(dirname, repeats=3):
+    '''
+    Time the data loading paths on a directory of (synthetic) folds.  The fold caches and the
+    rotation directories are (re)built in dirname
+
+    :param dirname: Directory containing the pfam_fold_%d.csv files
+    :param repeats: Timing repetitions
+    :return: Dictionary of benchmark entries
+    '''
+    import shutil
+
+    out = {}
+    n = sum(len(load_pfam_file(dirname, f)) for f in range(5))
+    t, _ = time_repeats(lambda: [load_pfam_file(dirname, f) for f in range(5)], repeats)
+    out['load_pfam_file_rows_per_sec'] = _entry(n / t, 'rows/s', True)
+
+    def cold():
+        # Remove the vocabulary and the fold caches: everything is tokenized again
+        for f in os.listdir(dirname):
+            if f.endswith('_cache') or f == 'pfam_vocab.json':
+                path = os.path.join(dirname, f)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        return prepare_data_set(basedir=dirname, rotation=0)
+
+    t, _ = time_repeats(cold, repeats)
+    out['prepare_data_set_cold_s'] = _entry(t, 's', False)
+    t, dat = time_repeats(lambda: prepare_data_set(basedir=dirname, rotation=0), repeats)
+    out['prepare_data_set_warm_s'] = _entry(t, 's', False)
+
+    write_rotation(basedir=dirname, rotation=0)
+
+    def load():
+        d = load_rotation(basedir=dirname, rotation=0)
+        # Touch every page: memory-mapped arrays are otherwise only read on use
+        return sum(int(d[k].sum()) for k in d if k.startswith('ins_') and d[k] is not None)
+
+    t, _ = time_repeats(load, repeats)
+    out['load_rotation_mmap_s'] = _entry(t, 's', False)
+
+    return out, dat
+
+
+def bench_pipeline(dat, batch=64, bucket_boundaries=(100, 200, 400, 800), repeats=3):
+    '''
+    Iteration throughput of the training set produced by create_tf_datasets()
+
+    :param dat: Rotation data structure
+    :param batch: Batch size
+    :param bucket_boundaries: Bucket boundaries for the length-bucketed variant
+    :param repeats: Timing repetitions (one epoch each)
+    :return: Dictionary of benchmark entries
+    '''
+    out = {}
+    n = len(dat['outs_train'])
+    for name, bounds in [('padded', None), ('bucketed', bucket_boundaries)]:
+        ds, _, _ = create_tf_datasets(dat, batch=batch, prefetch=-1, bucket_boundaries=bounds)
+        t, _ = time_repeats(lambda: sum(1 for _ in ds), repeats)
+        out['tf_dataset_%s_examples_per_sec' % name] = _entry(n / t, 'examples/s', True)
+    return out
+
+
+def bench_model_steps(dat, batch_sizes=(32, 128), rnn_neurons=(10, 30), embedding_lengths=(4, 16), steps=10,
+                      hidden=(15, 10, 5), modes=('default',), r_drop=0.0):
+    '''
+    Train and inference step time of create_network() models
+
+    :param dat: Rotation data structure
+    :param batch_sizes: Batch sizes to time
+    :param rnn_neurons: Values of rnnNeurons to time
+    :param embedding_lengths: Values of embedding_length to time
+    :param steps: Number of timed steps per configuration (after one warm-up step)
+    :param hidden: Dense layer sizes
+    :param modes: Model variants to time: 'default', 'compiled' (XLA + fused recurrent kernel) and/or
+                  'compiled_bf16' (compiled, bfloat16 mixed precision)
+    :param r_drop: Recurrent dropout of the models (the default models then use the generic loop)
+    :return: Dictionary of benchmark entries
+    '''
+    import tensorflow as tf
+
+    out = {}
+    for mode in modes:
+        for neurons in rnn_neurons:
+            for emb in embedding_lengths:
+                out.update(_bench_model(dat, mode, neurons, emb, batch_sizes, steps, hidden, r_drop))
+    tf.keras.mixed_precision.set_global_policy('float32')
+
+    # Speed-up of the compiled variants over the default models
+    for name in list(out):
+        for mode in modes:
+            base = name[:-len(mode) - 1]
+            if mode != 'default' and name.endswith('_' + mode) and base in out:
+                out['speedup_%s' % name] = _entry(out[base]['value'] / out[name]['value'], 'x', True)
+    return out
+
+
+def _bench_model(dat, mode, neurons, emb, batch_sizes, steps, hidden, r_drop):
+    '''
+    Train and inference step time of one model configuration (see bench_model_steps())
+    '''
+    import tensorflow as tf
+    from create_network import create_network
+
+    out = {}
+    tf.keras.backend.clear_session()
+    model = create_network(outs=dat['outs_train'], vocab_size=dat['n_tokens'], output_dim=emb,
+                           len_max=dat['len_max'], dense_layers=[{'units': h} for h in hidden],
+                           n_neurons=neurons, activation_dense='elu', r_drop=r_drop,
+                           compiled=mode != 'default',
+                           precision='bfloat16' if mode == 'compiled_bf16' else 'float32')
+    for batch in batch_sizes:
+        x = dat['ins_train'][:batch]
+        y = dat['outs_train'][:batch]
+        name = 'rnn_%d_emb_%d_batch_%d%s' % (neurons, emb, batch, '' if mode == 'default' else '_' + mode)
+
+        model.train_on_batch(x, y)
+        start = time.perf_counter()
+        for _ in range(steps):
+            model.train_on_batch(x, y)
+        out['train_step_ms_%s' % name] = _entry(1000 * (time.perf_counter() - start) / steps, 'ms', False)
+
+        model.predict_on_batch(x)
+        start = time.perf_counter()
+        for _ in range(steps):
+            model.predict_on_batch(x)
+        out['inference_step_ms_%s' % name] = _entry(1000 * (time.perf_counter() - start) / steps, 'ms', False)
+    return out
+
+
+def run_suite(args):
+    '''
+    Run the benchmark suite
+
+    :param args: ArgumentParser
+    :return: Dictionary: 'meta' (configuration of the run) and 'benchmarks' (name -> entry)
+    '''
+    import tempfile
+
+    # CPU only
+    os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='pfam_bench_')
+    write_synthetic_folds(workdir, examples_per_fold=args.synthetic_examples, seed=args.seed)
+
+    benchmarks, dat = bench_loader(workdir, repeats=args.repeats)
+    benchmarks.update(bench_pipeline(dat, batch=max(args.batch_sizes), repeats=args.repeats))
+    benchmarks.update(bench_model_steps(dat, batch_sizes=args.batch_sizes, rnn_neurons=args.rnn_neurons,
+                                        embedding_lengths=args.embedding_lengths, steps=args.steps,
+                                        modes=args.modes, r_drop=args.r_drop))
+
+    meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpus': os.cpu_count(),
+            'synthetic_examples': args.synthetic_examples,
+            'seed': args.seed,
+            'workdir': workdir}
+    try:
+        import tensorflow as tf
+        meta['tensorflow'] = tf.__version__
+    except ImportError:
+        pass
+
+    return {'meta': meta, 'benchmarks': benchmarks}
+
+
+def compare_results(current, baseline, tolerance=0.1):
+    '''
+    Compare benchmark results against a baseline
+
+    :param current: Results of run_suite()
+    :param baseline: Stored results of run_suite()
+    :param tolerance: Allowed relative slow-down (0.1 = 10%)
+    :return: List of (name, baseline value, current value, relative change, regression) tuples.
+             The relative change is positive when the benchmark got better
+    '''
+    rows = []
+    for name, entry in sorted(current['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if base is None or base['value'] == 0:
+            continue
+        change = (entry['value'] - base['value']) / base['value']
+        if not entry['higher_is_better']:
+            change = -change
+        rows.append((name, base['value'], entry['value'], change, change < -tolerance))
+    return rows
+
+
+def create_parser():
+    '''
+    Create argument parser
+    '''
+    parser = argparse.ArgumentParser(description='PFAM benchmarks', fromfile_prefix_chars='@')
+    parser.add_argument('--dataset', type=str, default='/home/fagg/datasets/pfam', help='Data set directory')
+    parser.add_argument('--fold', type=int, default=0, help='Fold to use for the tokenizer benchmark')
+    parser.add_argument('--repeats', type=int, default=3, help='Timing repetitions')
+    parser.add_argument('--footprint', action='store_true', help='Report the memory footprint of a rotation')
+    parser.add_argument('--rotation', type=int, default=0, help='Rotation for the footprint report and the rotation parity check')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory for the fold caches')
+    parser.add_argument('--startup', action='store_true', help='Report the startup time of the control paths')
+
+    # Benchmark suite
+    parser.add_argument('--suite', action='store_true', help='Run the benchmark suite on synthetic folds')
+    parser.add_argument('--out', type=str, default=None, help='json file for the suite results')
+    parser.add_argument('--compare', type=str, default=None, help='Baseline json file to compare the suite against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative slow-down before flagging')
+    parser.add_argument('--workdir', type=str, default=None,
+                        help='Directory for the synthetic folds and caches (default: a new temporary directory)')
+    parser.add_argument('--synthetic_examples', type=int, default=2000, help='Synthetic examples per fold')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[32, 128], help='Batch sizes to time')
+    parser.add_argument('--rnn_neurons', nargs='+', type=int, default=[10, 30], help='rnnNeurons values to time')
+    parser.add_argument('--embedding_lengths', nargs='+', type=int, default=[4, 16],
+                        help='embedding_length values to time')
+    parser.add_argument('--steps', type=int, default=10, help='Timed steps per model configuration')
+    parser.add_argument('--modes', nargs='+', type=str, default=['default', 'compiled'],
+                        choices=['default', 'compiled', 'compiled_bf16'], help='Model variants to time')
+    parser.add_argument('--rotation_parity', action='store_true',
+                        help='Compare prepare_data_set() with the keras path fit on the training folds of --rotation')
+    parser.add_argument('--r_drop', type=float, default=0.0, help='Recurrent dropout of the timed models')
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+
+    if args.footprint:
+        dat = load_rotation(basedir=args.dataset, rotation=args.rotation, cachedir=args.cache_dir)
+        res = rotation_footprint(dat)
+        print('rotation %d: %.1f MB (compact), %.1f MB (int32)' % (args.rotation, res['bytes'] / 2**20,
+                                                                   res['bytes_int32'] / 2**20))
+
+    if args.rotation_parity:
+        res = rotation_parity(args.dataset, rotation=args.rotation, cachedir=args.cache_dir)
+        for k, v in res.items():
+            print('%s: %s' % (k, v))
+        sys.exit(0)
+
+    if args.suite:
+        res = run_suite(args)
+        for name, entry in sorted(res['benchmarks'].items()):
+            print('%s: %.4g %s' % (name, entry['value'], entry['unit']))
+        if args.out is not None:
+            with open(args.out, 'w') as fp:
+                json.dump(res, fp, indent=1)
+
+        if args.compare is not None:
+            with open(args.compare, 'r') as fp:
+                baseline = json.load(fp)
+            rows = compare_results(res, baseline, tolerance=args.tolerance)
+            for name, base, value, change, regression in rows:
+                print('%s %s: %.4g -> %.4g (%+.1f%%)' % ('REGRESSION' if regression else 'ok        ', name,
+                                                        base, value, 100 * change))
+            sys.exit(1 if any(r[4] for r in rows) else 0)
+        sys.exit(0)
+
+    if args.startup:
+        for argv in [['--check'], ['--nogo', '--exp_index', '0']]:
+            print('hw6_base.py %s: %.3f s' % (' '.join(argv), bench_startup(argv, repeats=args.repeats)))
+        sys.exit(0)
+
+    df = load_pfam_file(args.dataset, args.fold)
+    res = bench_tokenizer(df['string'].values, df['label'].values, repeats=args.repeats)
+    for k, v in res.items():
+        print('%s: %s' % (k, v))
+    assert res['parity'], "Vectorized tokenizer does not match the keras tokenizer"
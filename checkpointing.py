@@ -0,0 +1,207 @@
+'''
+Checkpointing and resume of training runs
+
+CheckpointCallback periodically saves everything needed to continue a run where it
+stopped: the model weights, the optimizer state (slots and iteration count), the epoch
+counter, the history so far, the state of the EarlyStopping callback (including its best
+weights) and the telemetry so far.
+
+Layout (one directory per run, next to the results: <fbase>_checkpoints/):
+ckpt_0007/          checkpoint written after epoch 7 (0-based; ckpt_0007_final: training ended there)
+    ckpt.index, ckpt.data-*     model + optimizer (tf.train.Checkpoint)
+    best_weights.npz            EarlyStopping best weights (if any)
+    state.json                  epoch, history, EarlyStopping and telemetry state
+latest              name of the newest complete checkpoint
+
+A checkpoint is written into a temporary directory that is renamed once complete, and
+the latest pointer is replaced atomically after that, so a crash during a save leaves
+the previous checkpoint as the resume point.  Only the newest `keep` checkpoints are kept.
+
+Note: the tf.data shuffle order of the remaining epochs is not replayed, so a resumed run
+is equivalent to, but not bit-for-bit identical with, an uninterrupted one.
+
+'''
+import json
+import os
+import shutil
+
+import numpy as np
+import tensorflow as tf
+
+from results_io import CHECKPOINTS_SUFFIX
+
+LATEST = 'latest'
+STATE = 'state.json'
+BEST_WEIGHTS = 'best_weights.npz'
+
+
+def checkpoint_dir(fbase):
+    '''
+    :param fbase: File base of the run
+    :return: Directory holding the checkpoints of the run
+    '''
+    return fbase + CHECKPOINTS_SUFFIX
+
+
+def latest_checkpoint(dirname):
+    '''
+    :param dirname: Checkpoint directory of a run
+    :return: Directory of the newest complete checkpoint, or None if there is none
+    '''
+    try:
+        with open(os.path.join(dirname, LATEST), 'r') as fp:
+            name = fp.read().strip()
+    except OSError:
+        return None
+    path = os.path.join(dirname, name)
+    return path if os.path.exists(os.path.join(path, STATE)) else None
+
+
+def read_state(path):
+    '''
+    :param path: Checkpoint directory (from latest_checkpoint())
+    :return: State dictionary (epoch, history, early_stopping, telemetry)
+    '''
+    with open(os.path.join(path, STATE), 'r') as fp:
+        return json.load(fp)
+
+
+def _float(v):
+    return None if v is None else float(v)
+
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    def __init__(self, dirname, every=1, keep=2, early_stopping=None, telemetry=None, max_epochs=None):
+        '''
+        @param dirname Checkpoint directory of the run
+        @param every Save every this many epochs (the last epoch is always saved)
+        @param keep Number of checkpoints to keep (at least 1)
+        @param early_stopping EarlyStopping callback whose state is saved/restored (None -> none)
+        @param telemetry TelemetryCallback whose epochs are saved/restored (None -> none)
+        @param max_epochs Epochs of the complete run (None -> those of fit()).  A fit() that ends
+                          before (at an epoch budget, see asha) does not finish the run: a later
+                          fit() with more epochs continues it
+        '''
+        super().__init__()
+        self.dirname = dirname
+        self.every = every
+        assert keep >= 1, "keep must be at least 1"
+        self.keep = keep
+        self.max_epochs = max_epochs
+        self.early_stopping = early_stopping
+        self.telemetry = telemetry
+        self.history = {}
+        self.resume_state = None
+        self.resume_path = None
+        self.finished = False
+
+    def restore(self, model):
+        '''
+        Load the newest checkpoint (if any) into a compiled model.  The EarlyStopping state is
+        applied when training starts (EarlyStopping resets itself in on_train_begin())
+
+        @param model Compiled model with the same architecture as the checkpointed one
+        @return Epoch to continue from (0 if there is no checkpoint).  If training had already
+                finished, self.finished is set and the model holds the final weights
+        '''
+        path = latest_checkpoint(self.dirname)
+        if path is None:
+            return 0
+
+        # Create the optimizer slots so that they are restored immediately
+        if hasattr(model.optimizer, 'build'):
+            model.optimizer.build(model.trainable_variables)
+        tf.train.Checkpoint(model=model, optimizer=model.optimizer).read(os.path.join(path, 'ckpt')).expect_partial()
+
+        self.resume_state = read_state(path)
+        self.resume_path = path
+        self.finished = self.resume_state.get('finished', False)
+        self.history = {k: list(v) for k, v in self.resume_state['history'].items()}
+        if self.telemetry is not None:
+            self.telemetry.epochs = list(self.resume_state.get('telemetry', []))
+            self.telemetry.global_step = int(self.resume_state.get('global_step', 0))
+
+        print('Resuming from %s (epoch %d)' % (path, self.resume_state['epoch'] + 1))
+        return self.resume_state['epoch'] + 1
+
+    def on_train_begin(self, logs=None):
+        if self.resume_state is None or self.early_stopping is None:
+            return
+        es = self.resume_state['early_stopping']
+        self.early_stopping.wait = es['wait']
+        self.early_stopping.stopped_epoch = es['stopped_epoch']
+        if es['best'] is not None:
+            self.early_stopping.best = es['best']
+        if hasattr(self.early_stopping, 'best_epoch') and es.get('best_epoch') is not None:
+            self.early_stopping.best_epoch = es['best_epoch']
+        fname = os.path.join(self.resume_path, BEST_WEIGHTS)
+        if os.path.exists(fname):
+            with np.load(fname) as npz:
+                self.early_stopping.best_weights = [npz['w%d' % i] for i in range(len(npz.files))]
+
+    def on_epoch_end(self, epoch, logs=None):
+        for k, v in (logs or {}).items():
+            self.history.setdefault(k, []).append(float(v))
+
+        if (epoch + 1) % self.every == 0 or epoch + 1 == self.params.get('epochs'):
+            self.save(epoch)
+
+    def on_train_end(self, logs=None):
+        if len(self.history) == 0:
+            return
+        epoch = len(next(iter(self.history.values()))) - 1
+        stopped = self.early_stopping is not None and self.early_stopping.stopped_epoch > 0
+        if self.max_epochs is None or epoch + 1 >= self.max_epochs or stopped:
+            # Final state (after EarlyStopping has restored its best weights): a restart only evaluates
+            self.save(epoch, finished=True)
+            self.finished = True
+
+    def save(self, epoch, finished=False):
+        '''
+        Write a checkpoint (atomically) and rotate out the old ones
+
+        @param epoch Epoch that just finished (0-based)
+        @param finished Training is over (early termination or last epoch)
+        '''
+        os.makedirs(self.dirname, exist_ok=True)
+        # The final checkpoint of an epoch gets its own name: the pointer never refers to a
+        #  directory that is being replaced
+        name = 'ckpt_%04d%s' % (epoch, '_final' if finished else '')
+        final = os.path.join(self.dirname, name)
+        tmp = '%s.tmp.%d' % (final, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        tf.train.Checkpoint(model=self.model, optimizer=self.model.optimizer).write(os.path.join(tmp, 'ckpt'))
+
+        es = self.early_stopping
+        es_state = None
+        if es is not None:
+            es_state = {'wait': int(es.wait),
+                        'stopped_epoch': int(es.stopped_epoch),
+                        'best': _float(getattr(es, 'best', None)),
+                        'best_epoch': None if getattr(es, 'best_epoch', None) is None else int(es.best_epoch)}
+            if getattr(es, 'best_weights', None) is not None:
+                np.savez(os.path.join(tmp, BEST_WEIGHTS), **{'w%d' % i: w for i, w in enumerate(es.best_weights)})
+
+        state = {'epoch': epoch,
+                 'finished': finished,
+                 'history': self.history,
+                 'early_stopping': es_state,
+                 'telemetry': [] if self.telemetry is None else self.telemetry.epochs,
+                 'global_step': 0 if self.telemetry is None else self.telemetry.global_step}
+        with open(os.path.join(tmp, STATE), 'w') as fp:
+            json.dump(state, fp)
+
+        # Publish: complete directory first, then the pointer
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(tmp, final)
+        pointer = os.path.join(self.dirname, '%s.tmp.%d' % (LATEST, os.getpid()))
+        with open(pointer, 'w') as fp:
+            fp.write(name)
+        os.replace(pointer, os.path.join(self.dirname, LATEST))
+
+        # Rotate out the old checkpoints
+        names = sorted(f for f in os.listdir(self.dirname) if f.startswith('ckpt_') and '.tmp.' not in f)
+        for f in names[:-self.keep]:
+            shutil.rmtree(os.path.join(self.dirname, f), ignore_errors=True)
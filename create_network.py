@@ -1,11 +1,32 @@
 import tensorflow as tf
 from tensorflow.keras.layers import (Input, Embedding, SimpleRNN, Dense, Conv1D, MaxPool1D, LSTM,
-                                     BatchNormalization, Dropout, Activation, GlobalMaxPooling1D, GRU)
+                                     BatchNormalization, Dropout, Activation, GlobalMaxPooling1D, GRU,
+                                     SpatialDropout1D)
 
 from tensorflow.keras.regularizers import l2
 from tensorflow.keras.models import Model, Sequential
 import pandas as pd
 
+from layer_spec import RECURRENT_TYPES, default_layers
+
+# CPU features that provide native bfloat16 arithmetic
+BF16_CPU_FLAGS = ['avx512_bf16', 'amx_bf16']
+
+
+def bf16_supported():
+    '''
+    :return: True if bfloat16 mixed precision is worthwhile on this host (a GPU, or a CPU with
+             native bfloat16 instructions)
+    '''
+    if len(tf.config.list_physical_devices('GPU')) > 0:
+        return True
+    try:
+        with open('/proc/cpuinfo', 'r') as fp:
+            flags = set(fp.read().split())
+    except OSError:
+        return False
+    return any(f in flags for f in BF16_CPU_FLAGS)
+
 
 def create_network(outs,
                    vocab_size,
@@ -19,34 +40,57 @@ def create_network(outs,
                    use_gru=False,
                    dropout=None,
                    r_drop=None,
-                   lrate=0.0001):
+                   lrate=0.0001,
+                   layers=None,
+                   spatial_dropout=None,
+                   compiled=False,
+                   precision='float32'):
+    '''
+    Build and compile the network: embedding -> layers -> dense head -> softmax
+
+    :param layers: Layer specifications between the embedding and the dense head (see layer_spec).
+                   None -> the original architecture (Conv1D(64, 25, strides=2) + GRU(n_neurons))
+    :param spatial_dropout: Rate of the SpatialDropout1D after each convolution (None -> none)
+    :param compiled: XLA-compile the train/predict steps and build the recurrent layers so that they
+                     use the fused kernels: recurrent dropout (r_drop) is replaced by a dropout of the
+                     recurrent layer's input sequence with one mask for all timesteps
+    :param precision: 'float32' or 'bfloat16' (mixed precision: bfloat16 computations, float32 weights
+                      and outputs)
+    '''
+    if layers is None:
+        layers = default_layers(n_neurons, rnn_type='gru')
+
+    # Applies to all layers created from here on
+    tf.keras.mixed_precision.set_global_policy('mixed_bfloat16' if precision == 'bfloat16' else 'float32')
+
     if lambda_regularization is not None:
         lambda_regularization = tf.keras.regularizers.l2(lambda_regularization)
 
     # Initialize the model
     model = Sequential()
 
+    # Tokens arrive as uint8; the Embedding layer widens them to int32 inside the graph
+    model.add(Input(shape=(len_max,), dtype='uint8'))
+
     # Adds an embedding layer
     # Input_dim = size of the vocabulary
     # Output_dim = length of the vector for each word (essentially a hyperparameter)
-    # input_length = maximum length of a sequence
+    # input_length = maximum length of a sequence (None = variable length, e.g., for length-bucketed batches)
     model.add(Embedding(input_dim=vocab_size, output_dim=output_dim, input_length=len_max))
 
-    model.add(Conv1D(filters=64, kernel_size=25, activation='relu', strides=2, padding='same'))
-
-    """
-    model.add(LSTM(n_neurons,
-                   activation='tanh',
-                   use_bias=True,
-                   return_sequences=False,  # Produce entire sequence of outputs
-                   kernel_initializer='random_uniform',
-                   kernel_regularizer=lambda_regularization,
-                   unroll=False))  # Laying this out on the GPU.
-    # Different timesteps can get allocated to different parts of GPU
-    # Runs really fast if enough space on GPU
-    """
+    # Front-end and recurrent layers.  A recurrent layer returns its full sequence if another
+    #  recurrent layer follows it
+    for i, spec in enumerate(layers):
+        return_sequences = any(s['type'] in RECURRENT_TYPES for s in layers[i + 1:])
+        for layer in make_layer(spec, activation=activation, activation_dense=activation_dense,
+                                dropout=dropout, r_drop=r_drop,
+                                spatial_dropout=spatial_dropout, return_sequences=return_sequences,
+                                lambda_regularization=lambda_regularization, compiled=compiled):
+            model.add(layer)
 
-    model.add(GRU(n_neurons, dropout=dropout, recurrent_dropout=r_drop))
+    # Without a recurrent layer, the sequence is reduced by max-pooling over time
+    if not any(s['type'] in RECURRENT_TYPES for s in layers):
+        model.add(GlobalMaxPooling1D())
 
     for i in range(len(dense_layers)):
         model.add(Dense(units=dense_layers[i]['units'],
@@ -65,59 +109,64 @@ def create_network(outs,
                     kernel_initializer='random_uniform',
                     activation='softmax',
                     name='Output_layer',
-                    kernel_regularizer=lambda_regularization))
+                    kernel_regularizer=lambda_regularization,
+                    dtype='float32'))
 
     # The optimizer determines how the gradient descent is to be done
     opt = tf.keras.optimizers.Adam(learning_rate=lrate, beta_1=0.9, beta_2=0.999,
                                    epsilon=None, decay=0.0, amsgrad=False)
 
-    model.compile(loss='sparse_categorical_crossentropy', optimizer=opt, metrics=['sparse_categorical_accuracy'])
+    model.compile(loss='sparse_categorical_crossentropy', optimizer=opt, metrics=['sparse_categorical_accuracy'],
+                  jit_compile=compiled)
 
 
     return model
 
 
-# An attempt at declaring the order of layers at the command line.
-# Takes in the layer type and the parameters associated with the layer, and outputs the layer
-#TODO: Figure out how to ensure the parameters match the given layer.
-# Maybe a stack of tuples?
-
-def makeLayer(type, parameters):
-    if type == 'LSTM':
-        layer = (LSTM(parameters['n_neurons'],
-                      activation=parameters['tanh'],
-                      use_bias=True,
-                      return_sequences=False,  # Produce entire sequence of outputs
-                      kernel_initializer='random_uniform',
-                      kernel_regularizer=lambda_regularization,
-                      unroll=False))
-
-    if type == 'RNN':
-        layer = (SimpleRNN(parameters['n_neurons'],
-                           activation=parameters['tanh'],
-                           use_bias=True,
-                           return_sequences=False,  # Produce entire sequence of outputs
-                           kernel_initializer='random_uniform',
-                           kernel_regularizer=lambda_regularization,
-                           unroll=False))
-
-    if type == 'CNN':
-        layer = (Conv1D(filters=64, kernel_size=25, activation='relu'))
-
-    # Not used in this assignment, but can be potentially recycled
-    if type == 'MP':
-        layer = MaxPooling2D(pool_size=(3,3),
-                              strides=(1,1),
-                              padding='same')
-
-    if type == 'Dense':
-        layer = (Dense(parameters['n_neurons'],
-                           activation=parameters['tanh'],
-                           use_bias=True,
-                           return_sequences=False,  # Produce entire sequence of outputs
-                           kernel_initializer='random_uniform',
-                           kernel_regularizer=lambda_regularization,
-                           unroll=False))
-
-
-    return layer
+def make_layer(spec, activation=None, activation_dense=None, dropout=None, r_drop=None, spatial_dropout=None,
+               return_sequences=False, lambda_regularization=None, compiled=False):
+    '''
+    Translate a layer specification (see layer_spec) into Keras layers
+
+    :param spec: Layer specification dictionary
+    :param activation: Activation of the recurrent layers (None -> the Keras default)
+    :param activation_dense: Activation of the dense layers
+    :param dropout: Input dropout of the recurrent layers
+    :param r_drop: Recurrent dropout
+    :param spatial_dropout: Rate of the SpatialDropout1D after a convolution (None -> none)
+    :param return_sequences: Recurrent layers return their full output sequence
+    :param lambda_regularization: Kernel regularizer of the recurrent and dense layers
+    :param compiled: Recurrent layers use the fused kernels (no recurrent dropout; r_drop becomes a
+                     SpatialDropout1D of the layer's input sequence)
+    :return: List of layers
+    '''
+    t = spec['type']
+    if t == 'conv':
+        layers = [Conv1D(filters=spec['filters'], kernel_size=spec['kernel_size'], activation='relu',
+                         strides=spec['strides'], padding='same')]
+        if spatial_dropout:
+            layers.append(SpatialDropout1D(spatial_dropout))
+        return layers
+
+    if t == 'pool':
+        return [MaxPool1D(pool_size=spec['pool_size'], strides=spec['pool_size'], padding='same')]
+
+    if t in RECURRENT_TYPES:
+        kwargs = {} if activation is None else {'activation': activation}
+        rnn = GRU if t == 'gru' else LSTM
+        if not compiled:
+            return [rnn(spec['units'], dropout=dropout or 0.0, recurrent_dropout=r_drop or 0.0,
+                        return_sequences=return_sequences,
+                        kernel_regularizer=lambda_regularization, **kwargs)]
+
+        # Fused kernels require tanh/sigmoid activations, no recurrent dropout and no unrolling
+        #  (and reset_after=True for GRUs, which is the default)
+        if kwargs.get('activation', 'tanh') != 'tanh':
+            print('Warning: %s activation %s prevents the fused kernel' % (t, kwargs['activation']))
+        layers = [SpatialDropout1D(r_drop)] if r_drop else []
+        layers.append(rnn(spec['units'], dropout=dropout or 0.0, recurrent_dropout=0.0, unroll=False,
+                          return_sequences=return_sequences, kernel_regularizer=lambda_regularization, **kwargs))
+        return layers
+
+    assert t == 'dense', "Unknown layer type %s" % t
+    return [Dense(spec['units'], activation=activation_dense, kernel_regularizer=lambda_regularization)]
@@ -0,0 +1,299 @@
+'''
+Rotation ensembles
+
+Ensemble combines the models of the rotations of one configuration (or a subset of them).
+All members share one input pipeline: a chunk of strings is read and tokenized once.  The
+whole-sequence members share one left-padded array (each takes its last len_max columns), and
+the window members cut their windows from each string's own tokens (once per window setting).
+The members score a chunk
+concurrently, each on its own inference threads, and their class probabilities are combined
+by their mean or by a majority vote.
+
+Members must share the input vocabulary and the label map; both are built from all of the
+folds (see pfam_loader.build_vocabulary()), so the rotations of a configuration always do.
+
+Evaluation: every fold is a training fold of some rotation, so the ensemble must be
+evaluated on labeled sequences outside of the PFAM folds (a CSV with string and label
+columns).  evaluate_file() reports the accuracy of each member and of the ensemble and the
+throughput of both, i.e., the cost of the ensemble relative to a single model.
+
+Examples:
+
+python ensemble.py --results_path results --filebase 'amino__*_LR_0-001000_ntrain_03_rot_*' \
+       --input unannotated.fasta --output scores.csv --combine mean --threads 2
+
+python ensemble.py --results_path results --filebase 'amino__*_rot_*' --rotations 0 2 4 \
+       --evaluate heldout.csv --label_column label
+
+'''
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pfam_loader import encode_labels, pad_tokens, tokenize_strings
+from predictor import Predictor, iter_csv, predict_file, read_vocabulary
+from results_io import VOCAB_SUFFIX, list_results, read_results
+
+COMBINE = ['mean', 'vote']
+
+
+def find_members(dirname, filebase='*', rotations=None):
+    '''
+    Runs of one configuration that can be used as ensemble members
+
+    :param dirname: Results directory
+    :param filebase: File name pattern that selects the runs of the configuration (see list_results())
+    :param rotations: Rotations to use (None -> all that have a saved model)
+    :return: List of file bases, ordered by rotation
+    '''
+    members = {}
+    for fbase in list_results(dirname, filebase):
+        if not (os.path.exists('%s_model' % fbase) and os.path.exists(fbase + VOCAB_SUFFIX)):
+            continue
+        rotation = read_results(fbase, fields=['args'])['args'].rotation
+        if rotations is not None and rotation not in rotations:
+            continue
+        assert rotation not in members, "Several runs of rotation %d match %s (%s, %s)" % (
+            rotation, filebase, members.get(rotation), fbase)
+        members[rotation] = fbase
+
+    assert len(members) > 0, "No runs with a saved model match %s/%s" % (dirname, filebase)
+    if rotations is not None:
+        missing = sorted(set(rotations) - set(members))
+        assert len(missing) == 0, "No saved model for rotations %s" % missing
+    return [members[r] for r in sorted(members)]
+
+
+def combine_predictions(preds, method='mean'):
+    '''
+    :param preds: Class probabilities of each member (list of examples x classes)
+    :param method: 'mean': mean probability; 'vote': fraction of the members that predict each class
+                   (ties are broken by the mean probability)
+    :return: Combined scores (examples x classes)
+    '''
+    mean = np.mean(preds, axis=0)
+    if method == 'mean':
+        return mean.astype(np.float32)
+
+    assert method == 'vote', "Unknown combination %s" % method
+    votes = np.zeros_like(mean)
+    for pred in preds:
+        votes[np.arange(len(pred)), np.argmax(pred, axis=1)] += 1
+    votes /= len(preds)
+    # Ties are broken by the mean: mean / (members + 1) is smaller than one vote (1 / members)
+    return (votes + mean / (len(preds) + 1)).astype(np.float32)
+
+
+class Ensemble:
+    def __init__(self, fbases, batch=4096, threads=1, combine='mean'):
+        '''
+        @param fbases File bases of the member runs (see find_members())
+        @param batch Inference batch size of each member
+        @param threads Inference threads of each member
+        @param combine Combination of the member probabilities ('mean' or 'vote')
+        '''
+        assert combine in COMBINE, "Unknown combination %s" % combine
+        self.fbases = fbases
+        self.combine = combine
+
+        # The shared tokenization requires a common vocabulary and label map
+        vocabs = [read_vocabulary(f) for f in fbases]
+        for f, v in zip(fbases[1:], vocabs[1:]):
+            assert v['word_index'] == vocabs[0]['word_index'], "%s uses a different input vocabulary" % f
+            assert v['out_index_word'] == vocabs[0]['out_index_word'], "%s uses a different label map" % f
+
+        self.members = [Predictor(f, batch=batch, threads=threads) for f in fbases]
+        self.labels = self.members[0].labels
+        self.word_index = vocabs[0]['word_index']
+        self.out_word_index = {w: i for i, w in vocabs[0]['out_index_word'].items()}
+        self.pool = ThreadPoolExecutor(max_workers=len(self.members))
+
+        # Width of the padded array that the whole-sequence members share (None -> no such member)
+        self.len_max = max([m.vocab['len_max'] for m in self.members if m.window is None], default=None)
+        # Inference seconds of each member (see evaluate_file())
+        self.member_time = np.zeros(len(self.members))
+
+    def close(self):
+        for m in self.members:
+            m.close()
+        self.pool.shutdown()
+
+    def tokenize(self, strings):
+        '''
+        Tokenize a chunk of strings once for all of the members
+
+        :param strings: Sequence of strings
+        :return: Model inputs of each member (see Predictor.prepare()).  Members with the same
+                 window settings share their windows
+        '''
+        tokens, offsets = tokenize_strings(strings, self.word_index)
+        padded = None if self.len_max is None else pad_tokens(tokens, offsets, self.len_max)
+        windows = {}
+        ins = []
+        for m in self.members:
+            if m.window is None:
+                # A view of the shared array
+                ins.append(m.prepare(tokens, offsets, padded))
+                continue
+            key = (m.window, m.stride)
+            if key not in windows:
+                windows[key] = m.prepare(tokens, offsets)
+            ins.append(windows[key])
+        return ins
+
+    def _member_predict(self, i, ins):
+        start = time.perf_counter()
+        pred = self.members[i].predict_tokenized(ins)
+        self.member_time[i] += time.perf_counter() - start
+        return pred
+
+    def predict_members(self, ins):
+        '''
+        :param ins: From tokenize()
+        :return: Class probabilities of each member (list of examples x classes)
+        '''
+        return list(self.pool.map(lambda i: self._member_predict(i, ins[i]), range(len(self.members))))
+
+    def predict_tokenized(self, ins):
+        '''
+        :param ins: From tokenize()
+        :return: Combined scores (examples x classes)
+        '''
+        return combine_predictions(self.predict_members(ins), self.combine)
+
+    def predict_strings(self, strings):
+        '''
+        :param strings: Sequence of amino-acid strings
+        :return: Tuple (labels (examples,), combined scores (examples x classes))
+        '''
+        pred = self.predict_tokenized(self.tokenize(strings))
+        return self.labels[np.argmax(pred, axis=1)], pred
+
+    def predict_file(self, fname, out, **kwargs):
+        '''
+        Classify all of the sequences of a file (see predictor.predict_file())
+        '''
+        return predict_file(self, fname, out, **kwargs)
+
+    def evaluate_file(self, fname, column='string', label_column='label', chunksize=65536):
+        '''
+        Accuracy and throughput of the members and of the ensemble on labeled sequences
+
+        :param fname: CSV file with strings and class names (not from the PFAM folds: every fold
+                      is a training fold of some rotation)
+        :param column: Column holding the strings
+        :param label_column: Column holding the class names
+        :param chunksize: Number of sequences per chunk
+        :return: Dictionary: 'members' (file base, accuracy, sequences/sec of each member),
+                 'ensemble' (accuracy and sequences/sec for each combination) and
+                 'tokenize_time'.  A member's throughput includes the (shared) tokenization,
+                 as it would when run alone; 'cost' is the ensemble time relative to the
+                 mean single-model time
+        '''
+        correct = np.zeros(len(self.members))
+        correct_ens = {c: 0 for c in COMBINE}
+        n = 0
+        tokenize_time = 0.0
+        total_time = 0.0
+        self.member_time[:] = 0
+
+        for labels, strings in iter_csv(fname, chunksize=chunksize, column=column, id_column=label_column):
+            labels = encode_labels(labels, self.out_word_index).astype(np.int64) - 1
+
+            start = time.perf_counter()
+            ins = self.tokenize(strings)
+            tokenize_time += time.perf_counter() - start
+            preds = self.predict_members(ins)
+            total_time += time.perf_counter() - start
+
+            for i, pred in enumerate(preds):
+                correct[i] += np.sum(np.argmax(pred, axis=1) == labels)
+            for c in COMBINE:
+                correct_ens[c] += np.sum(np.argmax(combine_predictions(preds, c), axis=1) == labels)
+            n += len(labels)
+
+        single_time = tokenize_time + self.member_time
+        return {'n': n,
+                'tokenize_time': tokenize_time,
+                'members': [{'fbase': f,
+                             'accuracy': float(correct[i] / max(n, 1)),
+                             'sequences_per_sec': n / single_time[i] if single_time[i] > 0 else None}
+                            for i, f in enumerate(self.fbases)],
+                'ensemble': {c: {'accuracy': float(correct_ens[c] / max(n, 1)),
+                                 'sequences_per_sec': n / total_time if total_time > 0 else None}
+                             for c in COMBINE},
+                'cost': total_time / np.mean(single_time) if n > 0 else None}
+
+
+def format_evaluation(ev):
+    '''
+    :param ev: From Ensemble.evaluate_file()
+    :return: Human-readable report
+    '''
+    lines = ['%d sequences' % ev['n']]
+    for m in ev['members']:
+        lines.append('member   %-60s acc %.4f  %8.1f seq/sec' % (os.path.basename(m['fbase']), m['accuracy'],
+                                                                  m['sequences_per_sec'] or 0))
+    for c, e in ev['ensemble'].items():
+        lines.append('ensemble %-60s acc %.4f  %8.1f seq/sec' % (c, e['accuracy'], e['sequences_per_sec'] or 0))
+    lines.append('Ensemble cost: %.2fx the time of one model' % (ev['cost'] or 0))
+    return '\n'.join(lines)
+
+
+def create_parser():
+    '''
+    Create argument parser
+    '''
+    parser = argparse.ArgumentParser(description='Rotation ensemble of trained models', fromfile_prefix_chars='@')
+    parser.add_argument('--results_path', type=str, default='./results', help='Results directory')
+    parser.add_argument('--filebase', type=str, required=True,
+                        help='File name pattern that selects the runs of one configuration (e.g., amino__*_rot_*)')
+    parser.add_argument('--rotations', nargs='+', type=int, default=None, help='Rotations to use (default: all)')
+    parser.add_argument('--combine', type=str, default='mean', choices=COMBINE, help='Combination of the members')
+    parser.add_argument('--input', type=str, default=None, help='CSV or FASTA file to classify')
+    parser.add_argument('--output', type=str, default=None, help='Output CSV file')
+    parser.add_argument('--format', type=str, default=None, choices=['csv', 'fasta'],
+                        help='Input format (default: from the file extension)')
+    parser.add_argument('--column', type=str, default='string', help='CSV column holding the strings')
+    parser.add_argument('--id_column', type=str, default=None, help='CSV column holding the ids (default: row number)')
+    parser.add_argument('--probabilities', action='store_true', help='Write the score of every class')
+    parser.add_argument('--evaluate', type=str, default=None, help='Labeled CSV file to evaluate on')
+    parser.add_argument('--label_column', type=str, default='label', help='CSV column holding the class names')
+    parser.add_argument('--report', type=str, default=None, help='json file for the evaluation')
+    parser.add_argument('--batch', type=int, default=4096, help='Inference batch size')
+    parser.add_argument('--threads', type=int, default=1, help='Inference threads per member')
+    parser.add_argument('--chunksize', type=int, default=65536, help='Sequences read and tokenized at once')
+    parser.add_argument('--cpus_per_task', type=int, default=None, help='Number of TensorFlow threads')
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    assert args.input is None or args.output is not None, "--input needs an --output"
+
+    import tensorflow as tf
+    if args.cpus_per_task is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(args.cpus_per_task)
+        tf.config.threading.set_inter_op_parallelism_threads(args.cpus_per_task)
+
+    fbases = find_members(args.results_path, args.filebase, rotations=args.rotations)
+    print('Members:\n' + '\n'.join(fbases))
+    ensemble = Ensemble(fbases, batch=args.batch, threads=args.threads, combine=args.combine)
+
+    if args.evaluate is not None:
+        ev = ensemble.evaluate_file(args.evaluate, column=args.column, label_column=args.label_column,
+                                    chunksize=args.chunksize)
+        print(format_evaluation(ev))
+        if args.report is not None:
+            with open(args.report, 'w') as fp:
+                json.dump(ev, fp, indent=1)
+
+    if args.input is not None:
+        n = ensemble.predict_file(args.input, args.output, fmt=args.format, chunksize=args.chunksize,
+                                  column=args.column, id_column=args.id_column, probabilities=args.probabilities)
+        print('%d sequences -> %s' % (n, args.output))
+    ensemble.close()
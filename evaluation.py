@@ -0,0 +1,160 @@
+'''
+Single-pass model evaluation
+
+One batched inference pass per data set; the loss, the accuracy, the per-class
+precision/recall and the confusion matrix are all computed from the predictions of
+that pass (model.evaluate() would run the model a second time).
+
+The loss matches model.evaluate() for a model compiled with sparse categorical
+cross-entropy: mean cross-entropy of the (clipped) predicted probabilities plus the
+regularization losses of the model.
+
+Models trained on fixed-length windows (--crop_window) predict whole sequences with
+predict_windows(): the overlapping windows of a chunk of sequences are scored together
+and their predictions are aggregated per sequence.
+
+Example:
+
+evals = evaluate_model(model, {'valid': (ins_valid, outs_valid), 'test': (ins_test, outs_test)},
+                       batch=1024)
+evals['valid']['accuracy'], evals['valid']['confusion']
+
+'''
+import numpy as np
+
+from pfam_loader import aggregate_windows, window_examples
+
+# Names of the data sets as used in the results dictionary
+SPLIT_NAMES = {'train': 'training', 'valid': 'validation', 'test': 'testing'}
+
+# Probability clipping used by the keras cross-entropy
+EPSILON = 1e-7
+
+
+def confusion_matrix(labels, predicted, nclasses):
+    '''
+    :param labels: True class indices (examples)
+    :param predicted: Predicted class indices (examples)
+    :param nclasses: Number of classes
+    :return: nclasses x nclasses matrix of counts (rows: true class, columns: predicted class)
+    '''
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    predicted = np.asarray(predicted, dtype=np.int64).ravel()
+    return np.bincount(labels * nclasses + predicted, minlength=nclasses * nclasses).reshape(nclasses, nclasses)
+
+
+def classification_metrics(pred, labels, regularization=0.0):
+    '''
+    Metrics of a set of predictions
+
+    :param pred: Predicted class probabilities (examples x classes)
+    :param labels: True class indices (examples or examples x 1)
+    :param regularization: Regularization loss to add to the cross-entropy
+    :return: Dictionary: loss, accuracy, precision and recall (per class; nan for a class that
+             is never predicted/never present), confusion (matrix) and n (number of examples)
+    '''
+    pred = np.asarray(pred)
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    nclasses = pred.shape[1]
+
+    # Cross-entropy of the true classes (accumulated in float64)
+    p = np.clip(pred[np.arange(len(labels)), labels].astype(np.float64), EPSILON, 1 - EPSILON)
+    loss = float(-np.mean(np.log(p))) + regularization if len(labels) > 0 else float('nan')
+
+    confusion = confusion_matrix(labels, np.argmax(pred, axis=1), nclasses)
+    correct = np.diag(confusion).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = correct / confusion.sum(axis=0)
+        recall = correct / confusion.sum(axis=1)
+
+    return {'loss': loss,
+            'accuracy': float(correct.sum() / max(len(labels), 1)),
+            'precision': precision,
+            'recall': recall,
+            'confusion': confusion,
+            'n': len(labels)}
+
+
+def regularization_loss(model):
+    '''
+    :param model: Keras model
+    :return: Sum of the regularization losses of the model (float)
+    '''
+    return float(sum(float(l) for l in model.losses))
+
+
+def predict_windows(model, ins, window, stride=None, batch=1024, aggregate='logit', chunk=4096):
+    '''
+    Whole-sequence predictions of a model built for fixed-length windows
+
+    :param model: Keras model with inputs of length window
+    :param ins: Left-padded tokenized inputs (examples x len_max), or a list of such arrays
+    :param window: Window length
+    :param stride: Distance between consecutive windows (None -> window // 2)
+    :param batch: Inference batch size (windows)
+    :param aggregate: Combination of the windows of a sequence (see pfam_loader.aggregate_windows())
+    :param chunk: Number of sequences whose windows are cut and scored together
+    :return: Class probabilities (examples x classes)
+    '''
+    if stride is None:
+        stride = max(1, window // 2)
+
+    preds = []
+    for a in (ins if isinstance(ins, list) else [ins]):
+        for start in range(0, len(a), chunk):
+            windows, owner = window_examples(np.asarray(a[start:start + chunk]), window, stride)
+            pred = model.predict(windows, batch_size=batch, verbose=0)
+            preds.append(aggregate_windows(pred, owner, min(chunk, len(a) - start), method=aggregate))
+    return np.concatenate(preds)
+
+
+def evaluate_model(model, eval_sets, batch=1024, splits=('valid', 'test', 'train'), window=None, stride=None,
+                   aggregate='logit'):
+    '''
+    Predict and evaluate each data set with a single inference pass
+
+    :param model: Keras model (softmax outputs)
+    :param eval_sets: Dictionary split -> (inputs, labels).  The inputs are anything that
+                      model.predict() accepts (an array or an ordered, unshuffled DataSet)
+    :param batch: Inference batch size (ignored for DataSets, which are already batched)
+    :param splits: Splits to evaluate, in order (splits that are absent from eval_sets are skipped)
+    :param window: Window length of the model (None -> the model takes whole sequences).  With windows,
+                   the inputs must be arrays (or lists of arrays); see predict_windows()
+    :param stride: Distance between consecutive windows (None -> window // 2)
+    :param aggregate: Combination of the windows of a sequence ('logit' or 'prob')
+    :return: Dictionary split -> metrics (see classification_metrics()), with the predictions
+             stored under 'predictions'
+    '''
+    regularization = regularization_loss(model)
+
+    evals = {}
+    for k in splits:
+        if k not in eval_sets:
+            continue
+        ins, labels = eval_sets[k]
+        if window is None:
+            pred = model.predict(ins, batch_size=batch)
+        else:
+            pred = predict_windows(model, ins, window, stride=stride, batch=batch, aggregate=aggregate)
+        evals[k] = classification_metrics(pred, labels, regularization)
+        evals[k]['predictions'] = pred
+
+    return evals
+
+
+def store_evaluations(results, evals):
+    '''
+    Add evaluations to a results dictionary: predict_<split> (predictions), predict_<split>_eval
+    ([loss, accuracy], as returned by model.evaluate()) and predict_<split>_metrics (precision,
+    recall, confusion matrix)
+
+    :param results: Results dictionary (modified)
+    :param evals: From evaluate_model()
+    '''
+    for k, ev in evals.items():
+        name = 'predict_%s' % SPLIT_NAMES[k]
+        results[name] = ev['predictions']
+        results[name + '_eval'] = [ev['loss'], ev['accuracy']]
+        results[name + '_metrics'] = {'precision': ev['precision'].tolist(),
+                                      'recall': ev['recall'].tolist(),
+                                      'confusion': ev['confusion'].tolist()}
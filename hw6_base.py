@@ -6,33 +6,63 @@ Author: Andrew H. Fagg (andrewhfagg@gmail.com)
 
 Image classification
 
+Note: only light modules are imported at the top level.  The control paths
+(--check, --nogo, generate_fname()) never import TensorFlow, matplotlib or the
+data loader; these are imported by execute_exp() once an experiment will run.
+
 """
 
 import argparse
 import pickle
-import pandas as pd
-import numpy as np
 import os
-from keras_preprocessing.image import ImageDataGenerator
-import matplotlib.pyplot as plt
-
-from tensorflow.python.keras.utils.vis_utils import model_to_dot
-from tensorflow.python.keras.utils.vis_utils import plot_model
+import shutil
+import time
 
 from job_control import *
-from pfam_loader import *
-from create_network import *
+from results_io import RESULTS_SUFFIXES, CHECKPOINTS_SUFFIX, PREDICTION_FORMATS, results_exist, write_budget, \
+    write_results
+from run_catalog import RunCatalog, default_catalog, results_metrics, run_key
+from layer_spec import default_layers, describe_layers, format_description, layers_from_args, layers_str
 
 #################################################################
 # Default plotting parameters
 FIGURESIZE = (10, 6)
 FONTSIZE = 18
 
-plt.rcParams['figure.figsize'] = FIGURESIZE
-plt.rcParams['font.size'] = FONTSIZE
 
-plt.rcParams['xtick.labelsize'] = FONTSIZE
-plt.rcParams['ytick.labelsize'] = FONTSIZE
+def set_plot_defaults():
+    '''
+    Set the default matplotlib parameters
+    '''
+    import matplotlib.pyplot as plt
+
+    plt.rcParams['figure.figsize'] = FIGURESIZE
+    plt.rcParams['font.size'] = FONTSIZE
+
+    plt.rcParams['xtick.labelsize'] = FONTSIZE
+    plt.rcParams['ytick.labelsize'] = FONTSIZE
+
+
+def configure_devices(args):
+    '''
+    Select the CPU/GPU devices.  This imports TensorFlow
+
+    :param args: ArgumentParser
+    '''
+    # Turn off GPU?
+    if not args.gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    import tensorflow as tf
+
+    # GPU check
+    physical_devices = tf.config.list_physical_devices('GPU')
+    n_physical_devices = len(physical_devices)
+    if (n_physical_devices > 0):
+        tf.config.experimental.set_memory_growth(physical_devices[0], True)
+        print('We have %d GPUs\n' % n_physical_devices)
+    else:
+        print('NO GPU')
 
 
 #################################################################
@@ -57,9 +87,20 @@ def create_parser():
     parser.add_argument('--label', type=str, default=None, help="Extra label to add to output files")
     parser.add_argument('--dataset', type=str, default='/home/fagg/datasets/pfam',
                         help='Data set directory')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory for the fold caches and rotations (default: the data set directory)')
     parser.add_argument('--allele', type=str, default='1301', help="Allele number to focus on")
     parser.add_argument('--Nfolds', type=int, default=5, help='Maximum number of folds')
     parser.add_argument('--results_path', type=str, default='./results', help='Results directory')
+    parser.add_argument('--results_format', type=str, default='columnar', choices=['columnar', 'pickle'],
+                        help="Results storage: json scalars + separate predictions (columnar) or one pickle per run")
+    parser.add_argument('--save_predictions', type=str, default='float16', choices=PREDICTION_FORMATS,
+                        help="columnar: storage of the prediction matrices (none, float16, float32 or topk)")
+    parser.add_argument('--top_k', type=int, default=5, help="columnar: classes kept per example with --save_predictions topk")
+    parser.add_argument('--catalog', type=str, default=None,
+                        help="Run catalog file (default: run_catalog.sqlite in the results directory; "
+                             "must be on a local disk, see run_catalog.py)")
+    parser.add_argument('--no_catalog', action='store_true', help="Do not record the run in the run catalog")
 
     # Specific experiment configuration
     parser.add_argument('--exp_index', type=int, default=1, help='Experiment index')
@@ -78,9 +119,29 @@ def create_parser():
     parser.add_argument('--rnn_activation', type=str, default=None, help='Activation of RNN layers')
     parser.add_argument('--r_drop', type=float, default=0.0, help='Recurrent Dropout')
 
+    # Compilation
+    parser.add_argument('--compiled', action='store_true',
+                        help="XLA-compile the train/predict steps and use the fused recurrent kernels "
+                             "(--r_drop then drops the recurrent layer inputs, one mask for all timesteps)")
+    parser.add_argument('--precision', type=str, default=None, choices=['float32', 'bfloat16'],
+                        help="Computation precision (bfloat16: mixed precision, if the CPU/GPU supports it; "
+                             "default: float32)")
+
     # CNN parameters
     parser.add_argument('--filters', nargs='+', type=int, default=[64],
                         help='Number of filters per 1D-CNN')
+    parser.add_argument('--kernel_sizes', nargs='+', type=int, default=None,
+                        help='Kernel size per 1D-CNN (one value applies to all; default: 25)')
+    parser.add_argument('--conv_strides', nargs='+', type=int, default=None,
+                        help='Stride per 1D-CNN (one value applies to all; default: 2)')
+    parser.add_argument('--pool', nargs='+', type=int, default=None,
+                        help='Max-pooling size after each 1D-CNN (1 = no pooling; one value applies to all)')
+    parser.add_argument('--rnn_type', type=str, default=None, choices=['gru', 'lstm'],
+                        help='Recurrent layer following the 1D-CNNs (default: gru)')
+    parser.add_argument('--layers', nargs='+', type=str, default=None,
+                        help="Layers between the embedding and the dense layers, replacing --filters ... --rnn_type "
+                             "(e.g., conv:64:25:2 pool:2 conv:64:9:2 gru:30; types: conv:filters:kernel:stride (default 64:25:2), "
+                             "pool:size, gru:units, lstm:units, dense:units)")
 
     # Hidden unit parameters
     parser.add_argument('--hidden', nargs='+', type=int, default=[100, 5],
@@ -105,7 +166,61 @@ def create_parser():
                         help="Fraction of available validation set to actually use for validation")
     parser.add_argument('--testing_fraction', type=float, default=0.5,
                         help="Fraction of available testing set to actually use for testing")
+    parser.add_argument('--bucket_boundaries', nargs='+', type=int, default=None,
+                        help="Train on length-bucketed batches, padded only to the longest sequence in the batch (sequence of increasing lengths)")
+    parser.add_argument('--batch_inference', type=int, default=None,
+                        help="Batch size for prediction/evaluation (default: same as --batch)")
+    parser.add_argument('--eval_splits', nargs='+', type=str, default=['valid', 'test', 'train'],
+                        choices=['train', 'valid', 'test'],
+                        help="Data sets to predict and evaluate after training (e.g., skip train in production sweeps)")
+
+    # Input pipeline parameters
+    parser.add_argument('--tf_data', action='store_true', help='Train and evaluate from a tf.data input pipeline')
+    parser.add_argument('--shuffle_buffer', type=int, default=None,
+                        help="tf.data: shuffle buffer size for the training set (reshuffled every epoch)")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="tf.data: cache the examples ('memory' or a cache file name prefix)")
+    parser.add_argument('--prefetch', type=int, default=-1,
+                        help="tf.data: number of batches to prefetch (-1 = AUTOTUNE, 0 = no prefetch)")
+    parser.add_argument('--balance', action='store_true',
+                        help="tf.data: train on a class-balanced stream; an epoch is --steps_per_epoch batches")
+    parser.add_argument('--class_weights', nargs='+', type=float, default=None,
+                        help="Target class distribution for --balance (one weight per class; default: uniform)")
     parser.add_argument('--generator_seed', type=int, default=42, help="Seed used for generator configuration")
+    parser.add_argument('--crop_window', type=int, default=None,
+                        help="tf.data: train on random windows of this length (the model is built for the window); "
+                             "predictions aggregate overlapping windows of each sequence")
+    parser.add_argument('--window_stride', type=int, default=None,
+                        help="Distance between the inference windows of --crop_window (default: half a window)")
+    parser.add_argument('--window_aggregate', type=str, default=None, choices=['logit', 'prob'],
+                        help="Combination of the inference windows: mean logits (default) or mean probabilities")
+
+    # Checkpointing
+    parser.add_argument('--checkpoint_every', type=int, default=5,
+                        help="Checkpoint the training state every this many epochs, and after the last one "
+                             "(0 = no checkpoints)")
+    parser.add_argument('--checkpoint_keep', type=int, default=2, help="Number of checkpoints to keep (at least 1)")
+    parser.add_argument('--no_resume', action='store_true',
+                        help="Start from scratch even if there is a checkpoint of this run")
+    parser.add_argument('--keep_checkpoints', action='store_true',
+                        help="Keep the checkpoints once the results have been written")
+    parser.add_argument('--epoch_budget', type=int, default=None,
+                        help="Stop after this many epochs (of --epochs) and continue later from the checkpoints "
+                             "(used by asha.py)")
+
+    # Deployment
+    parser.add_argument('--tflite', nargs='+', type=str, default=None, choices=['float32', 'dynamic', 'int8'],
+                        help="Also export the model to TFLite with these quantizations")
+    parser.add_argument('--tflite_calibration', type=int, default=500,
+                        help="Training examples used to calibrate the int8 export")
+
+    # Telemetry
+    parser.add_argument('--step_timing', action='store_true',
+                        help="Time every training step (latency percentiles and input wait; slows down training)")
+    parser.add_argument('--profile_steps', nargs=2, type=int, default=None,
+                        help="Capture a TF profiler trace of these training steps (first last; counted across epochs)")
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help="Directory for the profiler trace (default: <file base>_profile)")
 
 
     return parser
@@ -137,6 +252,18 @@ def check_args(args):
     assert (args.L2_regularizer is None or (
             args.L2_regularizer > 0.0 and args.L2_regularizer < 1)), "L2_regularizer must be between 0 and 1"
     assert (args.cpus_per_task is None or args.cpus_per_task > 1), "cpus_per_task must be positive or None"
+    assert (args.spatial_dropout is None or (
+            args.spatial_dropout > 0.0 and args.spatial_dropout < 1)), "spatial_dropout must be between 0 and 1"
+    assert (args.crop_window is None or (args.bucket_boundaries is None and not args.balance)), \
+        "crop_window cannot be combined with bucket_boundaries or balance"
+    assert (args.checkpoint_every >= 0), "checkpoint_every must be non-negative"
+    assert (args.checkpoint_keep >= 1), "checkpoint_keep must be at least 1"
+    assert (args.epoch_budget is None or (args.epoch_budget > 0 and args.checkpoint_every > 0)), \
+        "epoch_budget must be positive and requires checkpoints"
+    assert (args.tflite is None or args.bucket_boundaries is None), \
+        "tflite export needs a fixed input length (no bucket_boundaries)"
+    # Parses (and checks) the layer specifications
+    describe_layers(layers_from_args(args), None, args.embedding_length)
 
 
 def augment_args(args):
@@ -193,6 +320,12 @@ def generate_fname(args, params_str):
     else:
         dropout_str = 'drop_%0.3f_' % (args.dropout)
 
+    # Spatial dropout
+    if args.spatial_dropout is None:
+        sdropout_str = ''
+    else:
+        sdropout_str = 'sdrop_%0.3f_' % (args.spatial_dropout)
+
     # L1 regularization
     if args.L1_regularizer is None:
         regularizer_l1_str = ''
@@ -226,13 +359,51 @@ def generate_fname(args, params_str):
     # learning rate
     lrate_str = "LR_%0.6f_" % args.lrate
 
-    fname = "%s/amino_%s%s_epochs_%s_hidden_%s_%s%s%s%sntrain_%02d_rot_%02d" % (
+    # Layers between the embedding and the dense layers (only if they differ from the original architecture)
+    layers = layers_from_args(args)
+    if layers == default_layers(args.rnnNeurons):
+        layers_fname_str = ""
+    else:
+        layers_fname_str = "layers_%s_" % layers_str(layers)
+
+    # Compiled mode and precision
+    compiled_str = "compiled_" if args.compiled else ""
+    if args.precision is not None and args.precision != 'float32':
+        compiled_str += "%s_" % args.precision
+
+    # Training windows
+    if args.crop_window is None:
+        crop_str = ""
+    else:
+        crop_str = "crop_%d_" % args.crop_window
+
+    # Length buckets
+    if args.bucket_boundaries is None:
+        bucket_str = ""
+    else:
+        bucket_str = "bucket_%s_" % '-'.join(str(b) for b in args.bucket_boundaries)
+
+    # Class-balanced training
+    if not args.balance:
+        balance_str = ""
+    elif args.class_weights is None:
+        balance_str = "bal_"
+    else:
+        balance_str = "bal_%s_" % '-'.join('%0.3f' % w for w in args.class_weights)
+
+    fname = "%s/amino_%s%s_epochs_%s_hidden_%s_%s%s%s%s%s%s%s%s%s%sntrain_%02d_rot_%02d" % (
         args.results_path,
         experiment_type_str,
         label_str,
         epochs_str,
         hidden_str,
+        layers_fname_str,
+        compiled_str,
+        crop_str,
+        bucket_str,
+        balance_str,
         dropout_str,
+        sdropout_str,
         regularizer_l1_str,
         regularizer_l2_str,
         lrate_str,
@@ -247,11 +418,25 @@ def generate_fname(args, params_str):
     return fnameNew
 
 #################################################################
-def execute_exp(args=None):
+def count_entries(ins):
+    '''
+    :param ins: Array, list of arrays (see create_dataset()) or None
+    :return: Total number of entries
+    '''
+    if ins is None:
+        return 0
+    if isinstance(ins, list):
+        return sum(a.size for a in ins)
+    return ins.size
+
+
+def execute_exp(args=None, data_loader=None):
     '''
     Perform the training and evaluation for a single model
 
     :param args: Argparse arguments
+    :param data_loader: Function(args) that returns the rotation data structure (None -> load_rotation()).
+                        The input arrays may be lists of arrays (see create_dataset()); this requires --tf_data
     '''
 
     # Check the arguments
@@ -268,6 +453,62 @@ def execute_exp(args=None):
     args_str = augment_args(args)
     print('Passed augment_args')
 
+    print(args)
+
+    # Output file base
+    fbase = generate_fname(args, args_str)
+
+    # Perform the experiment?
+    if (args.nogo):
+        # No!
+        print("NO GO")
+        print(fbase)
+        return
+
+    # Check if output file already exists (in either format)
+    fname_out = results_exist(fbase)
+    if fname_out is not None:
+        # Results file does exist: exit
+        print("File %s already exists" % fname_out)
+        return
+
+    # Register the run in the catalog
+    if args.no_catalog:
+        return run_exp(args, fbase, args_str, data_loader=data_loader)
+
+    with RunCatalog(catalog_fname(args)) as catalog:
+        run = catalog.start(args, fbase)
+        try:
+            return run_exp(args, fbase, args_str, data_loader=data_loader, catalog=catalog, run=run)
+        except BaseException:
+            # A crashed run must not look like a live one
+            if catalog.status([run]).get(run) == 'running':
+                catalog.finish(run, status='failed')
+            raise
+
+
+def run_exp(args, fbase, args_str, data_loader=None, catalog=None, run=None):
+    '''
+    Train and evaluate a single model (the body of execute_exp())
+
+    :param args: Argparse arguments (after augment_args())
+    :param fbase: Output file base
+    :param args_str: Parameter string from augment_args()
+    :param data_loader: See execute_exp()
+    :param catalog: RunCatalog that the run is registered in (None -> no catalog)
+    :param run: Key of the run in the catalog
+    '''
+
+    # Heavy imports: only needed once the experiment is going to run
+    import tensorflow as tf
+    from pfam_loader import load_rotation, create_tf_datasets, create_dataset
+    from create_network import create_network, bf16_supported
+    from evaluation import evaluate_model, store_evaluations
+    from telemetry import TelemetryCallback
+    from checkpointing import CheckpointCallback, checkpoint_dir
+    from predictor import write_vocabulary
+    set_plot_defaults()
+
     # Set number of threads, if it is specified
     if args.cpus_per_task is not None:
         # Makes sure that you are using no more than the number of threads that you asked for when set up batch file
@@ -275,16 +516,17 @@ def execute_exp(args=None):
         tf.config.threading.set_inter_op_parallelism_threads(args.cpus_per_task)
     print('Passed configure cpus')
 
-    dat_out = load_rotation(basedir=args.dataset, rotation=args.exp_index)
+    if data_loader is None:
+        dat_out = load_rotation(basedir=args.dataset, rotation=args.exp_index, nfolds=args.Nfolds,
+                                ntrain_folds=args.Ntraining, cachedir=args.cache_dir)
+    else:
+        dat_out = data_loader(args)
     #dat_out = prepare_data_set(basedir=args.dataset, rotation=args.exp_index)
 
     # Compute the number of samples in each data set
-    nsamples_train = dat_out['ins_train'].size
-    nsamples_validation = dat_out['ins_valid'].size
-    if dat_out['ins_test'] is None:
-        nsamples_testing = 0
-    else:
-        nsamples_testing = dat_out['ins_test'].size
+    nsamples_train = count_entries(dat_out['ins_train'])
+    nsamples_validation = count_entries(dat_out['ins_valid'])
+    nsamples_testing = count_entries(dat_out['ins_test'])
 
     print("Total samples: Tr:%d, V:%d, Te:%d" % (nsamples_train, nsamples_validation, nsamples_testing))
 
@@ -293,12 +535,26 @@ def execute_exp(args=None):
 
     print("Dense layers:", dense_layers)
 
+    # Layers between the embedding and the dense layers: timesteps left for the recurrent scan and cost
+    layers = layers_from_args(args)
+    len_model = dat_out['len_max'] if args.crop_window is None else min(args.crop_window, dat_out['len_max'])
+    architecture = describe_layers(layers, len_model, args.embedding_length, dense_layers,
+                                   nclasses=len(dat_out['out_word_index']))
+    print(format_description(architecture))
+
+    # Mixed precision only pays off with native bfloat16 support
+    precision = 'float32' if args.precision is None else args.precision
+    if precision == 'bfloat16' and not bf16_supported():
+        print('Warning: no native bfloat16 support on this host; using float32')
+        precision = 'float32'
+    architecture['compiled'] = args.compiled
+    architecture['precision'] = precision
 
 
     model = create_network(outs=dat_out['outs_train'],
                            vocab_size=dat_out['n_tokens'],
                            output_dim=args.embedding_length,
-                           len_max=dat_out['len_max'],
+                           len_max=None if args.bucket_boundaries is not None else len_model,
                            dense_layers=dense_layers,
                            n_neurons=args.rnnNeurons,
                            activation=args.rnn_activation,
@@ -307,93 +563,181 @@ def execute_exp(args=None):
                            use_gru=False,
                            dropout=args.dropout,
                            r_drop=args.r_drop,
-                           lrate=args.lrate)
+                           lrate=args.lrate,
+                           layers=layers,
+                           spatial_dropout=args.spatial_dropout,
+                           compiled=args.compiled,
+                           precision=precision)
 
     # Report model structure if verbosity is turned on
     if args.verbose >= 1:
         print(model.summary())
 
-    print(args)
-
-    # Output file base and pkl file
-    fbase = generate_fname(args, args_str)
-    fname_out = "%s_results.pkl" % fbase
-
-    # Perform the experiment?
-    if (args.nogo):
-        # No!
-        print("NO GO")
-        print(fbase)
-        return
-
-    # Check if output file already exists
-    if os.path.exists(fname_out):
-        # Results file does exist: exit
-        print("File %s already exists" % fname_out)
-        return
-
     # Callbacks
     early_stopping_cb = tf.keras.callbacks.EarlyStopping(monitor='val_sparse_categorical_accuracy',
                                                          mode='min',
                                                          patience=args.patience,
                                                          restore_best_weights=True,
                                                          min_delta=args.min_delta)
-
-    #dat_train, dat_valid, dat_test = create_tf_datasets(dat_out, batch=args.batch)
-
-    history = model.fit(x=dat_out['ins_train'],
-                        y=dat_out['outs_train'],
-                        batch_size=args.batch,
-                        epochs=args.epochs,
-                        use_multiprocessing=False,
-                        verbose=args.verbose >= 2,
-                        validation_data=(dat_out['ins_valid'], dat_out['outs_valid']),
-                        validation_steps=None,
-                        callbacks=[early_stopping_cb])
+    telemetry_cb = TelemetryCallback(args.batch,
+                                     step_timing=args.step_timing,
+                                     profile_steps=args.profile_steps,
+                                     profile_dir=args.profile_dir if args.profile_dir is not None
+                                     else '%s_profile' % fbase)
+    callbacks = [early_stopping_cb, telemetry_cb]
+
+    # Checkpoints: continue a preempted run from its latest checkpoint
+    checkpoint_cb = None
+    initial_epoch = 0
+    if args.checkpoint_every > 0:
+        if args.no_resume:
+            shutil.rmtree(checkpoint_dir(fbase), ignore_errors=True)
+        checkpoint_cb = CheckpointCallback(checkpoint_dir(fbase), every=args.checkpoint_every,
+                                           keep=args.checkpoint_keep, early_stopping=early_stopping_cb,
+                                           telemetry=telemetry_cb, max_epochs=args.epochs)
+        initial_epoch = checkpoint_cb.restore(model)
+        # Must follow the callbacks whose state it saves
+        callbacks.append(checkpoint_cb)
+    train = checkpoint_cb is None or not checkpoint_cb.finished
+    # With an epoch budget, this execution only trains up to the budget
+    epochs = args.epochs if args.epoch_budget is None else min(args.epoch_budget, args.epochs)
+
+    batch_inference = args.batch if args.batch_inference is None else args.batch_inference
+    use_tf_data = args.tf_data or args.bucket_boundaries is not None or args.balance or args.crop_window is not None
+    window = None if args.crop_window is None else len_model
+
+    if use_tf_data:
+        # tf.data input pipeline.  With bucket boundaries, each batch is only padded to its longest sequence
+        prefetch = None if args.prefetch == 0 else args.prefetch
+        cache = None if args.cache is None else ('' if args.cache == 'memory' else args.cache)
+        dat_train, dat_valid, dat_test = create_tf_datasets(dat_out, batch=args.batch,
+                                                            prefetch=prefetch,
+                                                            bucket_boundaries=args.bucket_boundaries,
+                                                            shuffle=args.shuffle_buffer,
+                                                            cache=cache,
+                                                            batch_inference=batch_inference,
+                                                            seed=args.generator_seed,
+                                                            balance=args.balance,
+                                                            class_weights=args.class_weights,
+                                                            crop_window=window)
+
+    if train and use_tf_data:
+        history = model.fit(dat_train,
+                            epochs=epochs,
+                            initial_epoch=initial_epoch,
+                            steps_per_epoch=args.steps_per_epoch if args.balance else None,
+                            use_multiprocessing=False,
+                            verbose=args.verbose >= 2,
+                            validation_data=dat_valid,
+                            validation_steps=None,
+                            callbacks=callbacks)
+    elif train:
+        history = model.fit(x=dat_out['ins_train'],
+                            y=dat_out['outs_train'],
+                            batch_size=args.batch,
+                            epochs=epochs,
+                            initial_epoch=initial_epoch,
+                            use_multiprocessing=False,
+                            verbose=args.verbose >= 2,
+                            validation_data=(dat_out['ins_valid'], dat_out['outs_valid']),
+                            validation_steps=None,
+                            callbacks=callbacks)
 
     print(model.summary())
 
+    # Stopped at the epoch budget: record the progress; a later execution with a larger budget continues
+    if checkpoint_cb is not None and not checkpoint_cb.finished:
+        history = checkpoint_cb.history
+        write_budget(fbase, {'epochs': len(next(iter(history.values()), [])),
+                             'epoch_budget': epochs,
+                             'history': history,
+                             'telemetry': telemetry_cb.summary()})
+        if catalog is not None:
+            catalog.finish(run, results_metrics({'history': history}), status='paused')
+        print('Paused at epoch %d of %d: %s' % (epochs, args.epochs, fbase))
+        return model
+
+
+    # Inference inputs: ordered (unshuffled, unbucketed) so that predictions line up with the examples.
+    #  Only the requested splits are built
+    splits = [k for k in args.eval_splits if dat_out['ins_'+k] is not None]
+    #  With windows, the arrays are cut into windows by the evaluation
+    if use_tf_data and window is None:
+        eval_sets = {k: (create_dataset(dat_out['ins_'+k], dat_out['outs_'+k], batch=batch_inference,
+                                        prefetch=prefetch), dat_out['outs_'+k])
+                     for k in splits}
+    else:
+        eval_sets = {k: (dat_out['ins_'+k], dat_out['outs_'+k]) for k in splits}
 
-    # Generate results data
+    # Generate results data: one inference pass per split
     results = {}
     results['args'] = args
-    results['predict_validation'] = model.predict(dat_out['ins_valid'])
-    results['predict_validation_eval'] = model.evaluate(dat_out['ins_valid'], dat_out['outs_valid'])
-
-    if dat_out['ins_test'] is not None:
-        results['predict_testing'] = model.predict(dat_out['ins_test'])
-        results['predict_testing_eval'] = model.evaluate(dat_out['ins_test'], dat_out['outs_test'])
-
-    results['predict_training'] = model.predict(dat_out['ins_train'])
-    results['predict_training_eval'] = model.evaluate(dat_out['ins_train'], dat_out['outs_train'])
-    results['history'] = history.history
+    eval_start = time.perf_counter()
+    store_evaluations(results, evaluate_model(model, eval_sets, batch=batch_inference, splits=splits,
+                                              window=window, stride=args.window_stride,
+                                              aggregate=args.window_aggregate or 'logit'))
+    # The checkpoints hold the history of all epochs (including those before a restart)
+    results['history'] = checkpoint_cb.history if checkpoint_cb is not None else history.history
+    results['telemetry'] = telemetry_cb.summary()
+    results['telemetry']['eval_time'] = time.perf_counter() - eval_start
+    results['architecture'] = architecture
     tf.keras.utils.plot_model(model, to_file='%s_model_plot.png' % fbase, show_shapes=True, show_layer_names=True)
 
 
     # Save results
     fbase = generate_fname(args, args_str)
     results['fname_base'] = fbase
-    with open("%s_results.pkl" % (fbase), "wb") as fp:
-        pickle.dump(results, fp)
+    if args.results_format == 'pickle':
+        with open("%s_results.pkl" % (fbase), "wb") as fp:
+            pickle.dump(results, fp)
+    else:
+        write_results(fbase, results, predictions=args.save_predictions, top_k=args.top_k)
+
+    if catalog is not None:
+        catalog.finish(run, results_metrics(results))
 
-    # Save model
+    # Save model, together with the input vocabulary that it needs to classify new strings.
+    #  Only the rotation's own vocabulary will do: the tokens of a legacy pickle come from a
+    #  tokenizer fit on its training folds, whose ids may differ from those of pfam_vocab.json
     model.save("%s_model" % (fbase))
+    if dat_out.get('word_index') is not None:
+        write_vocabulary(fbase, dat_out, window=window, stride=args.window_stride,
+                         aggregate=args.window_aggregate or 'logit')
+    else:
+        print('Warning: no input vocabulary available; %s_model cannot be used by the predictor' % fbase)
+
+    if args.tflite is not None:
+        from tflite_export import export_run
+        export_run(model, fbase, args.tflite, ins_train=dat_out['ins_train'], n_calibration=args.tflite_calibration,
+                   window=window, stride=args.window_stride)
+
+    # The run is complete: the checkpoints are no longer needed
+    if checkpoint_cb is not None and not args.keep_checkpoints:
+        shutil.rmtree(checkpoint_dir(fbase), ignore_errors=True)
 
     print(fbase)
 
     return model
 
 
-def check_completeness(args):
+def catalog_fname(args):
     '''
-    Check the completeness of a Cartesian product run.
+    :param args: ArgumentParser
+    :return: Name of the run catalog file
+    '''
+    return default_catalog(args.results_path) if args.catalog is None else args.catalog
 
-    All other args should be the same as if you executed your batch, however, the '--check' flag has been set
 
-    Prints a report of the missing runs, including both the exp_index and the name of the missing results file
+def missing_runs(args):
+    '''
+    Find the runs of a Cartesian product that have not finished.
 
-    :param args: ArgumentParser
+    A run is finished if the run catalog says so or if its results file exists.  The results
+    directories are listed once each (no file system access per run), so runs that are missing
+    from the catalog (e.g., written with --no_catalog or with another catalog file) still count
 
+    :param args: ArgumentParser (modified: holds the parameters of the last job)
+    :return: Tuple (number of jobs, list of (exp_index, results file name, resumable from a checkpoint))
     '''
 
     # Get the corresponding hyperparameters
@@ -402,27 +746,61 @@ def check_completeness(args):
     # Create the iterator
     ji = JobIterator(p)
 
-    print("Total jobs: %d" % ji.get_njobs())
+    # Finished runs in the catalog
+    finished = None
+    if not args.no_catalog and os.path.exists(catalog_fname(args)):
+        with RunCatalog(catalog_fname(args)) as catalog:
+            finished = {k for k, s in catalog.status().items() if s == 'finished'}
 
-    print("MISSING RUNS:")
+    # Contents of the results directories (one listing per directory instead of one stat per job)
+    listings = {}
 
-    indices = []
+    missing = []
     # Iterate over all possible jobs
-    for i in range(ji.get_njobs()):
-        params_str = ji.set_attributes_by_index(i, args)
+    for i, params, params_str in ji.items():
+        for k, v in params.items():
+            setattr(args, k, v)
         # Compute output file name base
         fbase = generate_fname(args, params_str)
 
-        # Output pickle file name
-        fname_out = "%s_results.pkl" % (fbase)
+        # Output file name (either format counts as done)
+        fname_out = "%s%s" % (fbase, RESULTS_SUFFIXES[0] if args.results_format == 'columnar' else RESULTS_SUFFIXES[1])
+        done = finished is not None and run_key(args) in finished
+        if not done:
+            dirname, basename = os.path.split(fbase)
+            if dirname not in listings:
+                listings[dirname] = set(os.listdir(dirname or '.')) if os.path.isdir(dirname or '.') else set()
+            done = any(basename + s in listings[dirname] for s in RESULTS_SUFFIXES)
+
+        if not done:
+            # Results file does not exist (the run may resume from a checkpoint)
+            missing.append((i, fname_out, os.path.isdir(fbase + CHECKPOINTS_SUFFIX)))
+
+    return ji.get_njobs(), missing
+
+
+def check_completeness(args):
+    '''
+    Check the completeness of a Cartesian product run.
+
+    All other args should be the same as if you executed your batch, however, the '--check' flag has been set
+
+    Prints a report of the missing runs, including both the exp_index and the name of the missing results file
+    (see missing_runs())
+
+    :param args: ArgumentParser
+
+    '''
+    njobs, missing = missing_runs(args)
+
+    print("Total jobs: %d" % njobs)
 
-        if not os.path.exists(fname_out):
-            # Results file does not exist: report it
-            print("%3d\t%s" % (i, fname_out))
-            indices.append(i)
+    print("MISSING RUNS:")
+    for i, fname_out, resumable in missing:
+        print("%3d\t%s%s" % (i, fname_out, "\t(checkpointed)" if resumable else ""))
 
     # Give the list of indices that can be inserted into the --array line of the batch file
-    print("Missing indices (%d): %s" % (len(indices), ','.join(str(x) for x in indices)))
+    print("Missing indices (%d): %s" % (len(missing), ','.join(str(m[0]) for m in missing)))
 
 
 #################################################################
@@ -432,22 +810,11 @@ if __name__ == "__main__":
     args = parser.parse_args()
     check_args(args)
 
-    # Turn off GPU?
-    if not args.gpu:
-        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
-
-    # GPU check
-    physical_devices = tf.config.list_physical_devices('GPU')
-    n_physical_devices = len(physical_devices)
-    if (n_physical_devices > 0):
-        tf.config.experimental.set_memory_growth(physical_devices[0], True)
-        print('We have %d GPUs\n' % n_physical_devices)
-    else:
-        print('NO GPU')
-
     if (args.check):
         # Just check to see if all experiments have been executed
         check_completeness(args)
     else:
         # Execute the experiment
+        if not args.nogo:
+            configure_devices(args)
         execute_exp(args)
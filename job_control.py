@@ -4,9 +4,12 @@ Author: Andrew H. Fagg
 Modified by: Alan Lee
 Translate a dictionary containing parameter/list pairs (key/value) into a Cartesian product
 of all combinations of possible parameter values.  
-Internally, the Cartesian product is stored as a list of dictionaries (parameter/value pairs).  
-This class allows for indexed access to this list.  In addition the values of a particular element
-of the list can be added to the property list of an existing object.
+The Cartesian product is never materialized: the ith combination is decoded directly
+from i (mixed-radix arithmetic over the parameter value lists; the last parameter
+varies fastest, as in itertools.product).  Memory use does not depend on the number
+of combinations.
+This class allows for indexed access to this product.  In addition the values of a particular element
+of the product can be added to the property list of an existing object.
 Example:
 # Dictionary of possible parameter values
 p = {'rotation': range(20),
@@ -19,6 +22,10 @@ ji = JobIterator(p)
 #  are the keys from p and the values are the specific combination
 #  of values in the ith element
 ji.set_attributes_by_index(i, obj)
+# Indices handled by worker k of n
+ji.shard(k, n)
+# Parameter strings of many jobs at once
+ji.get_param_strs()
             
 '''
 from itertools import product
@@ -30,18 +37,57 @@ class JobIterator():
         
         @param params Dictionary of key/list pairs
         '''
-        print('Initializing')
         self.params = params
-        # List of all combinations of parameter values
-        self.product = list(dict(zip(params,x))for x in product(*params.values()))
+        self.keys = list(params)
+        # Value lists (range objects stay lazy)
+        self.values = [v if isinstance(v, (range, list, tuple)) else list(v) for v in params.values()]
+        self.sizes = [len(v) for v in self.values]
+
+        # Mixed-radix place values: the last parameter varies fastest
+        self.strides = [1] * len(self.sizes)
+        for j in range(len(self.sizes) - 2, -1, -1):
+            self.strides[j] = self.strides[j + 1] * self.sizes[j + 1]
+        self.njobs = self.strides[0] * self.sizes[0] if len(self.sizes) > 0 else 1
+
         # Iterator over the combinations 
-        self.iter = (dict(zip(params,x))for x in product(*params.values()))
+        self.iter = iter(self)
+
+        # Parameter string fragments, one per parameter value
+        self.fragments = [["%s_%s" % (k, v) for v in vals] for k, vals in zip(self.keys, self.values)]
+
+    def __len__(self):
+        return self.njobs
+
+    def __iter__(self):
+        '''
+        @return Iterator over all combinations, in index order
+        '''
+        keys = self.keys
+        return (dict(zip(keys, x)) for x in product(*self.values))
+
+    def __getitem__(self, i):
+        return self.get_index(i)
         
     def next(self):
         '''
         @return The next combination in the list
         '''
-        return self.iter.next()
+        return next(self.iter)
+
+    __next__ = next
+
+    def _decode(self, i):
+        '''
+        Decode an index into the index of each parameter's value
+
+        @param i Index into the Cartesian product
+        @return List of value indices (one per parameter)
+        '''
+        if i < 0:
+            i += self.njobs
+        if i < 0 or i >= self.njobs:
+            raise IndexError("Job index %d out of range (%d jobs)" % (i, self.njobs))
+        return [(i // stride) % size for stride, size in zip(self.strides, self.sizes)]
         
     def get_index(self, i):
         '''
@@ -50,15 +96,55 @@ class JobIterator():
         @param i Index into the Cartesian product list
         @return The ith combination of parameters
         '''
-        print('getting index')
-        return self.product[i]
+        return {k: vals[j] for k, vals, j in zip(self.keys, self.values, self._decode(i))}
 
     def get_njobs(self):
         '''
         @return The total number of combinationss
         '''
-        print('getting index')
-        return len(self.product)
+        return self.njobs
+
+    def shard(self, k, n):
+        '''
+        Indices handled by worker k of n workers.  The shards are disjoint, cover all
+        indices and differ in size by at most one
+
+        @param k Worker number (0 ... n-1)
+        @param n Number of workers
+        @return range of indices
+        '''
+        assert 0 <= k < n, "Worker number must be between 0 and n-1"
+        return range(k, self.njobs, n)
+
+    def items(self, indices=None):
+        '''
+        Iterate over (index, combination, parameter string) triples
+
+        @param indices Iterable of indices (None -> all indices, in order)
+        '''
+        keys = self.keys
+        if indices is None:
+            # Walk the product of (value, fragment) pairs: no decoding needed
+            pairs = [list(zip(vals, frags)) for vals, frags in zip(self.values, self.fragments)]
+            for i, combo in enumerate(product(*pairs)):
+                yield i, dict(zip(keys, (c[0] for c in combo))), self._join([c[1] for c in combo])
+        else:
+            for i in indices:
+                js = self._decode(i)
+                yield (i,
+                       {k: vals[j] for k, vals, j in zip(keys, self.values, js)},
+                       self._join([frags[j] for frags, j in zip(self.fragments, js)]))
+
+    def get_param_strs(self, indices=None):
+        '''
+        Return the strings that describe many jobs at once
+
+        @param indices Iterable of indices (None -> all indices, in order)
+        @return List of parameter strings
+        '''
+        if indices is None:
+            return [self._join(f) for f in product(*self.fragments)]
+        return [self._join([frags[j] for frags, j in zip(self.fragments, self._decode(i))]) for i in indices]
     
     def set_attributes_by_index(self, i, obj):
         '''
@@ -102,6 +188,14 @@ class JobIterator():
                                             params['Ntraining'], params['rotation'])
                                             
                                             '''
+    @staticmethod
+    def _join(fragments):
+        '''
+        @param fragments List of "key_value" strings
+        @return Parameter string
+        '''
+        return 'JI_' + '_'.join(fragments) if len(fragments) > 0 else 'JI'
+
     def get_param_str(self, i):
         '''
         Return the string that describes the ith job parameters.
@@ -110,15 +204,7 @@ class JobIterator():
         @param i Index into the Cartesian product list
         '''
         
-        out = 'JI_'
-        # Fetch the ith combination of parameter values
-        d = self.get_index(i)
-        # Iterate over the parameters
-        for k,v in d.items():
-            out = out + "%s_%s_"%(k,v) #
-
-        # Return all but the last character
-        return out[:-1]
+        return self._join([frags[j] for frags, j in zip(self.fragments, self._decode(i))])
 
 
             
@@ -0,0 +1,222 @@
+'''
+Declarative layer specifications for create_network()
+
+The layers between the embedding and the dense head are described by a list of
+dictionaries (in the same style as the dense_layers argument of create_network()):
+
+{'type': 'conv', 'filters': 64, 'kernel_size': 25, 'strides': 2}   Conv1D (relu, 'same' padding)
+{'type': 'pool', 'pool_size': 2}                                    MaxPool1D (stride = pool size)
+{'type': 'gru', 'units': 30}                                        GRU
+{'type': 'lstm', 'units': 30}                                       LSTM
+{'type': 'dense', 'units': 10}                                      Dense (per timestep if it comes
+                                                                    before a recurrent layer)
+
+On the command line, a layer is written as type:arg:arg... (see parse_layer()):
+
+--layers conv:64:25:2 pool:2 conv:64:9:2 gru:30
+
+Strided convolutions and pooling shrink the number of timesteps that the recurrent
+layers scan.  describe_layers() reports the sequence length after each layer and an
+estimate of the FLOPs per example, so that architectures can be compared on cost.
+
+Only the standard library is used here: the specifications can be parsed and
+described without importing TensorFlow.
+
+'''
+
+# Defaults of the original architecture: one strided convolution ahead of a GRU
+DEFAULT_FILTERS = 64
+DEFAULT_KERNEL_SIZE = 25
+DEFAULT_STRIDES = 2
+
+# Argument names of each layer type, in command line order (missing trailing entries use the defaults)
+LAYER_ARGS = {'conv': ['filters', 'kernel_size', 'strides'],
+              'pool': ['pool_size'],
+              'gru': ['units'],
+              'lstm': ['units'],
+              'dense': ['units']}
+LAYER_DEFAULTS = {'conv': {'filters': DEFAULT_FILTERS, 'kernel_size': DEFAULT_KERNEL_SIZE, 'strides': DEFAULT_STRIDES},
+                  'pool': {'pool_size': 2}}
+
+RECURRENT_TYPES = ['gru', 'lstm']
+
+# Short names used in file names (see layers_str())
+_SHORT = {'conv': 'c', 'pool': 'p', 'gru': 'g', 'lstm': 'l', 'dense': 'd'}
+
+
+def parse_layer(s):
+    '''
+    Parse one command line layer specification
+
+    :param s: String type:arg:arg... (e.g., 'conv:64:25:2', 'pool:2', 'gru:30')
+    :return: Layer specification dictionary
+    '''
+    fields = s.lower().split(':')
+    assert fields[0] in LAYER_ARGS, "Unknown layer type %s (expected one of %s)" % (fields[0], ', '.join(LAYER_ARGS))
+    names = LAYER_ARGS[fields[0]]
+    assert len(fields) - 1 <= len(names), "Too many arguments for layer %s" % s
+
+    spec = {'type': fields[0]}
+    spec.update(LAYER_DEFAULTS.get(fields[0], {}))
+    spec.update({n: int(v) for n, v in zip(names, fields[1:])})
+    for n in names:
+        assert n in spec, "Missing %s for layer %s" % (n, s)
+        assert spec[n] > 0, "%s must be positive for layer %s" % (n, s)
+    return spec
+
+
+def parse_layers(strs):
+    '''
+    :param strs: List of command line layer specifications
+    :return: List of layer specification dictionaries
+    '''
+    return [parse_layer(s) for s in strs]
+
+
+def default_layers(n_neurons=10, filters=None, kernel_sizes=None, strides=None, pool=None, rnn_type='gru'):
+    '''
+    Layer specifications of a conv/pool front-end followed by one recurrent layer.  With the
+    default arguments, this is the original architecture (Conv1D(64, 25, strides=2) + GRU)
+
+    :param n_neurons: Units of the recurrent layer
+    :param filters: Filters of each convolution (None -> one convolution with DEFAULT_FILTERS)
+    :param kernel_sizes: Kernel size of each convolution (None -> DEFAULT_KERNEL_SIZE; a single
+                         value applies to all convolutions)
+    :param strides: Stride of each convolution (None -> DEFAULT_STRIDES; a single value applies to all)
+    :param pool: Max-pooling size after each convolution (None -> no pooling; 1 -> none for that
+                 convolution; a single value applies to all)
+    :param rnn_type: 'gru' or 'lstm'
+    :return: List of layer specification dictionaries
+    '''
+    if filters is None:
+        filters = [DEFAULT_FILTERS]
+
+    def per_conv(values, default):
+        if values is None:
+            return [default] * len(filters)
+        if len(values) == 1:
+            return list(values) * len(filters)
+        assert len(values) == len(filters), "Expected one value per convolution (%d)" % len(filters)
+        return list(values)
+
+    layers = []
+    for f, k, s, p in zip(filters, per_conv(kernel_sizes, DEFAULT_KERNEL_SIZE), per_conv(strides, DEFAULT_STRIDES),
+                          per_conv(pool, 1)):
+        layers.append({'type': 'conv', 'filters': f, 'kernel_size': k, 'strides': s})
+        if p > 1:
+            layers.append({'type': 'pool', 'pool_size': p})
+    layers.append({'type': rnn_type, 'units': n_neurons})
+    return layers
+
+
+def layers_from_args(args):
+    '''
+    Layer specifications selected by the command line arguments: --layers if given, otherwise
+    the front-end described by --filters/--kernel_sizes/--conv_strides/--pool and --rnnNeurons
+
+    :param args: ArgumentParser
+    :return: List of layer specification dictionaries
+    '''
+    if args.layers is not None:
+        return parse_layers(args.layers)
+    return default_layers(args.rnnNeurons, filters=args.filters, kernel_sizes=args.kernel_sizes,
+                          strides=args.conv_strides, pool=args.pool,
+                          rnn_type='gru' if args.rnn_type is None else args.rnn_type)
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+def describe_layers(layers, len_max, embedding_length, dense_layers=(), nclasses=4):
+    '''
+    Sequence length, width and cost of each layer
+
+    FLOPs count a multiply-add as 2 operations and only include the matrix products
+    (convolutions, recurrent gates and dense layers), which dominate the cost.
+
+    :param layers: List of layer specification dictionaries
+    :param len_max: Length of the input sequences (None -> variable; lengths and FLOPs are then None)
+    :param embedding_length: Width of the embedding
+    :param dense_layers: Dense head (list of {'units': n})
+    :param nclasses: Number of outputs
+    :return: Dictionary: 'layers' (one entry per layer: spec, length, width, flops), 'len_in',
+             'len_rnn' (timesteps scanned by the first recurrent layer), 'reduction' and 'flops'
+             (per example)
+    '''
+    length = len_max
+    width = embedding_length
+    out = []
+    len_rnn = None
+    sequence = True
+
+    for i, spec in enumerate(layers):
+        t = spec['type']
+        steps = length if sequence else 1
+        if t == 'conv':
+            assert sequence, "A convolution cannot follow the last recurrent layer"
+            length = None if length is None else _ceil_div(length, spec['strides'])
+            flops = None if length is None else 2 * length * spec['kernel_size'] * width * spec['filters']
+            width = spec['filters']
+        elif t == 'pool':
+            assert sequence, "Pooling cannot follow the last recurrent layer"
+            length = None if length is None else _ceil_div(length, spec['pool_size'])
+            flops = None if length is None else length * spec['pool_size'] * width
+        elif t in RECURRENT_TYPES:
+            assert sequence, "A recurrent layer cannot follow the last recurrent layer"
+            if len_rnn is None:
+                len_rnn = length
+            gates = 3 if t == 'gru' else 4
+            flops = None if length is None else 2 * length * gates * spec['units'] * (width + spec['units'] + 1)
+            width = spec['units']
+            sequence = any(s['type'] in RECURRENT_TYPES for s in layers[i + 1:])
+        else:
+            flops = None if steps is None else 2 * steps * width * spec['units']
+            width = spec['units']
+        out.append({'spec': spec, 'length': length if sequence else 1, 'width': width, 'flops': flops})
+
+    # Sequences that are not reduced by a recurrent layer are max-pooled over time
+    head = [d['units'] for d in dense_layers] + [nclasses]
+    flops_head = 0
+    for units in head:
+        flops_head += 2 * width * units
+        width = units
+
+    flops = [d['flops'] for d in out]
+    return {'layers': out,
+            'len_in': len_max,
+            'len_rnn': len_rnn,
+            'reduction': None if len_max is None or len_rnn is None else len_max / len_rnn,
+            'flops': None if any(f is None for f in flops) else sum(flops) + flops_head}
+
+
+def layers_str(layers):
+    '''
+    :param layers: List of layer specification dictionaries
+    :return: Compact string for file names (e.g., 'c64k25s2_p2_g30')
+    '''
+    parts = []
+    for spec in layers:
+        t = spec['type']
+        if t == 'conv':
+            parts.append('c%dk%ds%d' % (spec['filters'], spec['kernel_size'], spec['strides']))
+        elif t == 'pool':
+            parts.append('p%d' % spec['pool_size'])
+        else:
+            parts.append('%s%d' % (_SHORT[t], spec['units']))
+    return '_'.join(parts)
+
+
+def format_description(desc):
+    '''
+    :param desc: From describe_layers()
+    :return: Human-readable report (one line per layer and a summary line)
+    '''
+    lines = []
+    for d in desc['layers']:
+        lines.append('%-28s length %6s  width %4d  MFLOPs %s' % (
+            layers_str([d['spec']]), d['length'], d['width'],
+            '?' if d['flops'] is None else '%.2f' % (d['flops'] / 1e6)))
+    lines.append('Recurrent scan: %s -> %s timesteps; %s MFLOPs per example' % (
+        desc['len_in'], desc['len_rnn'], '?' if desc['flops'] is None else '%.2f' % (desc['flops'] / 1e6)))
+    return '\n'.join(lines)
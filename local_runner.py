@@ -0,0 +1,230 @@
+'''
+Local multi-process job runner
+
+An alternative to the SLURM array of batch.sh for a single large workstation: runs the
+JobIterator indices of a sweep as 'hw6_base.py <arguments> --exp_index i' child processes,
+a fixed number at a time.
+
+The cores are split into disjoint sets of --cpus_per_task cores, one per job slot; each job is
+pinned to the cores of its slot (and sizes its TensorFlow thread pools to them), so concurrent
+jobs never oversubscribe the machine.  By default, only the missing runs are executed (the same
+check as hw6_base.py --check: the run catalog if there is one, otherwise the results files).
+
+Every attempt is recorded (index, attempt, cores, start time, wall time, exit status, log file)
+in <log_dir>/runner.jsonl.  A job that fails is retried up to --retries times; with checkpoints,
+a retry continues where the failed attempt stopped.
+
+Examples:
+
+# All missing indices, 4 cores per job, as many jobs as the cores allow
+python local_runner.py @parameters.txt --cpus_per_task 4 --log_dir results/logs
+
+# Selected indices, at most 2 at a time, on cores 0-15
+python local_runner.py @parameters.txt --cpus_per_task 8 --indices 0 3 --jobs 2 --cores 0-15
+
+All arguments other than the ones below are passed on to hw6_base.py.
+
+'''
+import argparse
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_cores(specs):
+    '''
+    :param specs: List of core numbers and ranges (e.g., ['0-7', '16'])
+    :return: Sorted list of core numbers
+    '''
+    cores = set()
+    for s in specs:
+        for part in s.split(','):
+            lo, _, hi = part.partition('-')
+            cores.update(range(int(lo), int(hi or lo) + 1))
+    return sorted(cores)
+
+
+def available_cores():
+    '''
+    :return: Cores that this process may run on
+    '''
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+
+def core_slots(cores, per_job, jobs=None):
+    '''
+    Split the cores into disjoint sets, one per job slot
+
+    :param cores: List of cores
+    :param per_job: Cores per job
+    :param jobs: Maximum number of concurrent jobs (None -> as many as the cores allow)
+    :return: List of core lists
+    '''
+    nslots = len(cores) // per_job
+    assert nslots > 0, "%d cores per job, but only %d cores available" % (per_job, len(cores))
+    if jobs is not None:
+        nslots = min(nslots, jobs)
+    return [cores[k * per_job:(k + 1) * per_job] for k in range(nslots)]
+
+
+def run_job(argv, index, cores, log=None):
+    '''
+    Run one experiment pinned to a set of cores
+
+    :param argv: hw6_base.py arguments
+    :param index: Experiment index
+    :param cores: Cores of the job
+    :param log: File for the output of the job (None -> this process' output)
+    :return: Exit status
+    '''
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hw6_base.py')] + argv + \
+        ['--exp_index', str(index)]
+    # hw6_base requires more than one thread when the thread count is given
+    if len(cores) > 1:
+        cmd += ['--cpus_per_task', str(len(cores))]
+
+    # Pin with taskset, so that the affinity is in place before the job starts any threads (a
+    #  preexec_fn is not safe in this multi-threaded process).  Without taskset, the job is pinned
+    #  right after it is started, long before it creates its TensorFlow thread pools
+    taskset = shutil.which('taskset')
+    if taskset is not None:
+        cmd = [taskset, '-c', ','.join(str(c) for c in cores)] + cmd
+
+    fp = None if log is None else open(log, 'a')
+    try:
+        proc = subprocess.Popen(cmd, stdout=fp, stderr=subprocess.STDOUT if fp is not None else None)
+        if taskset is None and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(proc.pid, cores)
+            except ProcessLookupError:
+                # The job has already exited
+                pass
+        return proc.wait()
+    finally:
+        if fp is not None:
+            fp.close()
+
+
+class Runner:
+    def __init__(self, argv, slots, retries=1, log_dir=None):
+        '''
+        @param argv hw6_base.py arguments (shared by all jobs; without --exp_index and --cpus_per_task)
+        @param slots Core sets of the job slots (see core_slots())
+        @param retries Number of times a failed job is run again
+        @param log_dir Directory for the job output and runner.jsonl (None -> no logs)
+        '''
+        self.argv = argv
+        self.retries = retries
+        self.log_dir = log_dir
+        self.slots = queue.Queue()
+        for s in slots:
+            self.slots.put(s)
+        self.nslots = len(slots)
+        self.records = []
+        self.lock = threading.Lock()
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+
+    def _record(self, rec):
+        with self.lock:
+            self.records.append(rec)
+            if self.log_dir is not None:
+                with open(os.path.join(self.log_dir, 'runner.jsonl'), 'a') as fp:
+                    fp.write(json.dumps(rec) + '\n')
+
+    def _execute(self, index):
+        # A slot is held for all attempts of a job
+        cores = self.slots.get()
+        try:
+            for attempt in range(self.retries + 1):
+                log = None if self.log_dir is None else os.path.join(self.log_dir, 'exp_%04d.txt' % index)
+                start = time.time()
+                print('exp_index %d: attempt %d on cores %s' % (index, attempt, cores))
+                status = run_job(self.argv, index, cores, log=log)
+                self._record({'exp_index': index, 'attempt': attempt, 'cores': cores, 'start': start,
+                              'wall_time': time.time() - start, 'status': status, 'log': log})
+                print('exp_index %d: exit status %d (%.0f s)' % (index, status, time.time() - start))
+                if status == 0:
+                    break
+            return index, status
+        finally:
+            self.slots.put(cores)
+
+    def run(self, indices):
+        '''
+        Run the experiments, at most one per slot at a time
+
+        @param indices Experiment indices
+        @return Dictionary exp_index -> exit status of the last attempt
+        '''
+        with ThreadPoolExecutor(max_workers=self.nslots) as pool:
+            return dict(pool.map(self._execute, indices))
+
+
+def summarize(records):
+    '''
+    :param records: Runner.records
+    :return: Human-readable table: one line per experiment (last attempt)
+    '''
+    last = {}
+    for r in records:
+        last[r['exp_index']] = r
+    lines = ['%9s %8s %7s %10s' % ('exp_index', 'attempts', 'status', 'wall (s)')]
+    for i in sorted(last):
+        attempts = [r for r in records if r['exp_index'] == i]
+        lines.append('%9d %8d %7d %10.0f' % (i, len(attempts), last[i]['status'],
+                                             sum(r['wall_time'] for r in attempts)))
+    failed = [i for i in sorted(last) if last[i]['status'] != 0]
+    lines.append('Failed (%d): %s' % (len(failed), ','.join(str(i) for i in failed)))
+    return '\n'.join(lines)
+
+
+def create_parser():
+    '''
+    Create argument parser (the remaining arguments are passed on to hw6_base.py)
+    '''
+    parser = argparse.ArgumentParser(description='Local multi-process job runner', fromfile_prefix_chars='@')
+    parser.add_argument('--indices', nargs='+', type=int, default=None,
+                        help='Experiment indices to run (default: the missing ones)')
+    parser.add_argument('--all', action='store_true', help='Run all indices, including finished ones')
+    parser.add_argument('--cpus_per_task', type=int, default=1, help='Cores per job')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Maximum number of concurrent jobs (default: as many as the cores allow)')
+    parser.add_argument('--cores', nargs='+', type=str, default=None,
+                        help='Cores to use, e.g. 0-15 32-47 (default: all cores available to this process)')
+    parser.add_argument('--retries', type=int, default=1, help='Number of times a failed job is run again')
+    parser.add_argument('--log_dir', type=str, default=None, help='Directory for the job output and runner.jsonl')
+    parser.add_argument('--dry_run', action='store_true', help='Only list the jobs and their cores')
+    return parser
+
+
+if __name__ == "__main__":
+    args, argv = create_parser().parse_known_args()
+
+    import hw6_base
+    hw6_args = hw6_base.create_parser().parse_args(argv)
+    hw6_base.check_args(hw6_args)
+
+    indices = args.indices
+    if indices is None:
+        njobs, missing = hw6_base.missing_runs(hw6_args)
+        indices = list(range(njobs)) if args.all else [m[0] for m in missing]
+        print('Jobs: %d of %d' % (len(indices), njobs))
+
+    slots = core_slots(available_cores() if args.cores is None else parse_cores(args.cores), args.cpus_per_task,
+                       args.jobs)
+    print('%d slots: %s' % (len(slots), slots))
+    if args.dry_run:
+        print('Indices: %s' % ','.join(str(i) for i in indices))
+        sys.exit(0)
+
+    runner = Runner(argv, slots, retries=args.retries, log_dir=args.log_dir)
+    status = runner.run(indices)
+    print(summarize(runner.records))
+    sys.exit(0 if all(s == 0 for s in status.values()) else 1)
@@ -12,24 +12,50 @@ prepare_data_set(basedir = '/home/fagg/datasets/pfam', rotation = 0, nfolds = 5,
 OR
 
 load_rotation(basedir = '/home/fagg/datasets/pfam', rotation=0)
-    loads an already stored data set from a pickle file
+    opens an already stored data set: a memory-mapped rotation directory
+    (pfam_rotation_%d/) or a pickle file, if one exists.  Otherwise, the rotation
+    is composed from the fold caches.  convert_rotation_pickle() translates a
+    pickle file into the memory-mappable layout.
 
+Fold caches:
+Each pfam_fold_%d.csv is tokenized exactly once into its own cache directory
+(pfam_fold_%d_cache/) that holds the unpadded token stream for the fold.  All folds
+share a single, persisted vocabulary (pfam_vocab.json).  Any rotation (for any
+nfolds/ntrain_folds) is then built by padding and concatenating the cached folds.
+A cache is rebuilt when its source CSV, the tokenizer configuration or the
+vocabulary changes.  A rebuilt cache is written to a new version directory
+(pfam_fold_%d_cache.v<time>_<pid>/) and published by atomically replacing the
+pfam_fold_%d_cache symbolic link (see _publish_dir()).
 
+save_data_sets(basedir = '/home/fagg/datasets/pfam', out_basedir = None, nfolds = 5)
+    builds the vocabulary and all of the fold caches (and, optionally, the
+    memory-mappable rotations).  With chunksize set, the CSV files are streamed:
+    a first pass fits the vocabulary and sizes each fold, then each chunk is
+    tokenized and written into preallocated on-disk arrays, so peak memory is
+    bounded by the chunk size rather than by the size of the corpus.
 
+TensorFlow is only imported by the functions that construct TF DataSets.
 
 '''
-import tensorflow as tf
 import pandas as pd
 import numpy as np
 import os
 import fnmatch
-import matplotlib.pyplot as plt
 import random
 import pickle
+import json
+import shutil
+import hashlib
+import time
 
-from tensorflow.keras.preprocessing.sequence import pad_sequences
+# Configuration of the input (character) and output (label) tokenizers.  These mirror the
+#  keras Tokenizer settings that were originally used.  Any change here invalidates the
+#  vocabulary and all fold caches
+TOKENIZER_CONFIG = {'char_level': True, 'filters': '\t\n', 'lower': True}
 
-from tensorflow import keras
+# Version of the on-disk cache layout.  Bump this to invalidate the fold caches
+#  (2: tokens and labels are stored with the smallest integer type that fits)
+CACHE_FORMAT = 2
 
 def load_pfam_file(basedir, fold):
     '''
@@ -41,6 +67,37 @@ def load_pfam_file(basedir, fold):
     df = pd.read_csv('%s/pfam_fold_%d.csv'%(basedir, fold))
     return df
 
+def iter_pfam_file(basedir, fold, chunksize = None):
+    '''
+    Iterate over a CSV file in DataFrame chunks
+
+    :param basedir: Directory containing input files
+    :param fold: Fold to load
+    :param chunksize: Number of rows per chunk (None -> the whole file as one chunk)
+    '''
+    if chunksize is None:
+        yield load_pfam_file(basedir, fold)
+    else:
+        with pd.read_csv('%s/pfam_fold_%d.csv'%(basedir, fold), chunksize=chunksize) as reader:
+            for df in reader:
+                yield df
+
+def rotation_folds(rotation = 0, nfolds = 5, ntrain_folds = 3):
+    '''
+    Compute the fold indices that make up a rotation
+
+    :param rotation: Rotation to load
+    :param nfolds: Total number of folds
+    :param ntrain_folds: Number of training folds to use
+
+    :return: Tuple of arrays of fold indices (train, valid, test)
+    '''
+    train_folds = (np.arange(ntrain_folds) + rotation) % nfolds
+    valid_folds = (np.array([ntrain_folds]) + rotation) % nfolds
+    test_folds = (np.array([ntrain_folds]) + 1 + rotation) % nfolds
+
+    return train_folds, valid_folds, test_folds
+
 def load_pfam_dataset(basedir = '/home/fagg/datasets/pfam', rotation = 0, nfolds = 5, ntrain_folds = 3):
     '''
     Load train/valid/test datasets into DataFrames
@@ -53,9 +110,7 @@ def load_pfam_dataset(basedir = '/home/fagg/datasets/pfam', rotation = 0, nfolds
     :return: Dictionary containing the DataFrames
     '''
 
-    train_folds = (np.arange(ntrain_folds) + rotation) % nfolds
-    valid_folds = (np.array([ntrain_folds]) + rotation) % nfolds
-    test_folds = (np.array([ntrain_folds]) + 1 + rotation) % nfolds
+    train_folds, valid_folds, test_folds = rotation_folds(rotation, nfolds, ntrain_folds)
 
     train_dfs = [load_pfam_file(basedir, f) for f in train_folds]
     valid_dfs = [load_pfam_file(basedir, f) for f in valid_folds]
@@ -68,20 +123,555 @@ def load_pfam_dataset(basedir = '/home/fagg/datasets/pfam', rotation = 0, nfolds
     return {'train': train_df, 'valid': valid_df, 'test': test_df}
 
 
-def prepare_data_set(basedir = '/home/fagg/datasets/pfam', rotation = 0, nfolds = 5, ntrain_folds = 3):
+def _file_signature(fname):
+    '''
+    Cheap signature of a file that changes whenever the file is rewritten
+
+    :param fname: File name
+    :return: Dictionary containing the size and modification time of the file
+    '''
+    st = os.stat(fname)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _publish_dir(tmp, dirname):
+    '''
+    Atomically make a completely written directory the contents of dirname.  dirname is a
+    symbolic link to the current version (dirname.v<time>_<pid>): replacing the link is atomic,
+    so a reader always sees either the old or the new version as a whole.  The version that is
+    replaced is kept (a reader may still be opening it); older versions are removed.
+
+    :param tmp: Completely written directory (private to this process)
+    :param dirname: Published name
+    '''
+    parent, base = os.path.split(dirname)
+    version = '%s.v%d_%d'%(dirname, time.time_ns(), os.getpid())
+    os.rename(tmp, version)
+
+    link = '%s.link.%d'%(dirname, os.getpid())
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version), link)
+    if os.path.isdir(dirname) and not os.path.islink(dirname):
+        # Directory from before versioning: it becomes the oldest version
+        try:
+            os.rename(dirname, '%s.v0_%d'%(dirname, os.getpid()))
+        except OSError:
+            # Another process moved it first
+            pass
+    os.replace(link, dirname)
+
+    # Keep the current version and the newest other one
+    current = os.readlink(dirname)
+    versions = sorted(f for f in os.listdir(parent or '.') if f.startswith(base + '.v') and f != current)
+    for f in versions[:-1]:
+        shutil.rmtree(os.path.join(parent, f), ignore_errors=True)
+
+
+def _current_dir(dirname):
+    '''
+    :param dirname: Published name (see _publish_dir()), or a plain directory
+    :return: The directory that holds the current version.  Read all files of one version
+             through this name, so that they come from the same version
+    '''
+    return os.path.realpath(dirname)
+
+
+def _digest(obj):
+    '''
+    Stable hash of a JSON-serializable object
+
+    :param obj: Object to hash
+    :return: Hex digest string
+    '''
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _write_json(fname, obj):
+    '''
+    Write a JSON file atomically (write to a temporary file, then rename)
+
+    :param fname: Output file name
+    :param obj: JSON-serializable object
+    '''
+    tmp = '%s.tmp%d' % (fname, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(obj, fp)
+    os.replace(tmp, fname)
+
+
+def _read_json(fname):
+    '''
+    Read a JSON file
+
+    :param fname: File name
+    :return: Decoded object, or None if the file does not exist or cannot be parsed
+    '''
+    try:
+        with open(fname, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _encode(strings):
+    '''
+    Join a set of strings into a single byte buffer (one byte per character).  Characters
+    outside of latin-1 (e.g., in a user's FASTA file) become code 0, which is never part of a
+    vocabulary: like any unknown character, they are dropped by the tokenizer
+
+    :param strings: Sequence of strings
+    :return: Tuple (codes, offsets): string i occupies codes[offsets[i]:offsets[i+1]]
+    '''
+    lengths = np.fromiter((len(s) for s in strings), dtype=np.int64, count=len(strings))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    text = ''.join(strings)
+    if TOKENIZER_CONFIG['lower']:
+        text = text.lower()
+    try:
+        codes = np.frombuffer(text.encode('latin-1'), dtype=np.uint8)
+    except UnicodeEncodeError:
+        # One code point per character
+        points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        codes = np.where(points < 256, points, 0).astype(np.uint8)
+    return codes, offsets
+
+
+def index_dtype(n):
+    '''
+    :param n: Largest index that has to be represented
+    :return: Smallest unsigned integer type that holds 0 ... n (uint8 for the amino-acid vocabulary)
+    '''
+    return np.min_scalar_type(n)
+
+
+def _lookup_table(word_index):
+    '''
+    :param word_index: Character -> token map
+    :return: Byte -> token lookup table (unknown characters map to 0)
+    '''
+    lut = np.zeros(256, dtype=index_dtype(len(word_index)))
+    for c, i in word_index.items():
+        if ord(c) < 256:
+            lut[ord(c)] = i
+    return lut
+
+
+def _count_chars(strings, counts, first, pos):
+    '''
+    Accumulate character statistics for fitting a vocabulary
+
+    :param strings: Sequence of strings
+    :param counts: Per-byte counts (modified)
+    :param first: Per-byte position of first occurrence (modified)
+    :param pos: Number of characters seen before these strings
+    :return: Number of characters seen, including these strings
+    '''
+    codes, _ = _encode(strings)
+    counts += np.bincount(codes, minlength=256)
+    u, idx = np.unique(codes, return_index=True)
+    first[u] = np.minimum(first[u], idx + pos)
+    return pos + len(codes)
+
+
+def _char_index(counts, first):
+    '''
+    :param counts: Per-byte counts
+    :param first: Per-byte position of first occurrence
+    :return: Dictionary containing character -> token map: most frequent character first,
+             ties broken by first occurrence
+    '''
+    present = np.nonzero(counts)[0]
+    # Code 0 stands for the characters that cannot be encoded (see _encode())
+    present = present[present > 0]
+    order = present[np.lexsort((first[present], -counts[present]))]
+    return {chr(c): i + 1 for i, c in enumerate(order)}
+
+
+def _count_labels(labels, counts):
+    '''
+    Accumulate class name counts for fitting the label vocabulary
+
+    :param labels: Sequence of class names
+    :param counts: Dictionary of class name -> count, in order of first occurrence (modified)
+    '''
+    u, idx, c = np.unique(_normalize_labels(labels), return_index=True, return_counts=True)
+    for j in np.argsort(idx):
+        counts[str(u[j])] = counts.get(str(u[j]), 0) + int(c[j])
+
+
+def _label_index(counts):
+    '''
+    :param counts: Dictionary of class name -> count, in order of first occurrence
+    :return: Dictionary containing class name -> index map (index is 1 ... n_classes)
+    '''
+    # Stable sort: ties are broken by first occurrence
+    words = sorted(counts, key=lambda w: counts[w], reverse=True)
+    return {w: i + 1 for i, w in enumerate(words)}
+
+
+def fit_char_vocabulary(text_sets):
+    '''
+    Fit a character vocabulary.  Token ids are identical to those of
+    keras.preprocessing.text.Tokenizer(char_level=True) fit on the same strings:
+    most frequent character first, ties broken by first occurrence.
+
+    :param text_sets: Iterable of sequences of strings (e.g., one per fold or per chunk)
+    :return: Dictionary containing character -> token map (tokens are 1 ... )
+    '''
+    counts = np.zeros(256, dtype=np.int64)
+    first = np.full(256, np.iinfo(np.int64).max, dtype=np.int64)
+    pos = 0
+    for strings in text_sets:
+        pos = _count_chars(strings, counts, first, pos)
+
+    return _char_index(counts, first)
+
+
+def fit_label_vocabulary(label_sets):
+    '''
+    Fit the label vocabulary.  Indices are identical to those of
+    keras.preprocessing.text.Tokenizer() fit on the same (single word) labels.
+
+    :param label_sets: Iterable of sequences of class names (e.g., one per fold or per chunk)
+    :return: Dictionary containing class name -> index map (index is 1 ... n_classes)
+    '''
+    counts = {}
+    for labels in label_sets:
+        _count_labels(labels, counts)
+
+    return _label_index(counts)
+
+
+def _normalize_labels(labels):
+    '''
+    :param labels: Sequence of class names
+    :return: Array of class names, normalized as the label tokenizer does
+    '''
+    labels = np.asarray(labels, dtype=str)
+    if TOKENIZER_CONFIG['lower']:
+        labels = np.char.lower(labels)
+    return labels
+
+
+def tokenize_strings(strings, word_index):
+    '''
+    Tokenize a set of strings, without padding.  As with the keras tokenizer,
+    characters that are not in the vocabulary are dropped.
+
+    :param strings: Sequence of strings
+    :param word_index: Character -> token map
+    :return: Tuple (tokens, offsets): string i occupies tokens[offsets[i]:offsets[i+1]]
+    '''
+    codes, offsets = _encode(strings)
+    tokens = _lookup_table(word_index)[codes]
+
+    keep = tokens > 0
+    if not np.all(keep):
+        kept = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+        offsets = kept[offsets]
+        tokens = tokens[keep]
+
+    return tokens, offsets
+
+
+def pad_tokens(tokens, offsets, len_max, out=None, chunk=65536):
+    '''
+    Left-pad (and, for long strings, left-truncate) a set of tokenized strings to len_max.
+    This matches the behavior of pad_sequences(seq, maxlen=len_max)
+
+    :param tokens: Concatenated tokens
+    :param offsets: String i occupies tokens[offsets[i]:offsets[i+1]]
+    :param len_max: Length of the padded strings
+    :param out: Zero-filled array to write into (examples x len_max).  None -> allocate one (same
+                dtype as the tokens)
+    :param chunk: Number of strings to place at once (bounds the size of the index arrays)
+
+    :return: Padded tokens (examples x len_max)
+    '''
+    n = len(offsets) - 1
+    if out is None:
+        out = np.zeros((n, len_max), dtype=tokens.dtype)
+    flat = out.reshape(-1)
+
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        keep = np.minimum(np.diff(offsets[start:stop + 1]), len_max)
+        total = int(np.sum(keep))
+
+        # Position of each kept token within its (kept part of the) string
+        pos = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(keep) - keep, keep)
+        src = np.repeat(offsets[start + 1:stop + 1] - keep, keep) + pos
+        dst = np.repeat(np.arange(start, stop, dtype=np.int64) * len_max + len_max - keep, keep) + pos
+        flat[dst] = tokens[src]
+
+    return out
+
+
+def texts_to_padded(strings, word_index, len_max, out=None):
+    '''
+    Tokenize and left-pad a set of strings.  Equivalent to
+    pad_sequences(tokenizer.texts_to_sequences(strings), maxlen=len_max)
+
+    :param strings: Sequence of strings
+    :param word_index: Character -> token map
+    :param len_max: Length of the padded strings
+    :param out: Zero-filled array to write into (examples x len_max).  None -> allocate one
+
+    :return: Padded tokens (examples x len_max)
+    '''
+    tokens, offsets = tokenize_strings(strings, word_index)
+    return pad_tokens(tokens, offsets, len_max, out=out)
+
+
+def encode_labels(labels, out_word_index):
+    '''
+    Translate class names into class indices
+
+    :param labels: Sequence of class names
+    :param out_word_index: Class name -> index map
+    :return: Class indices (examples,), using the smallest integer type that fits.  Values are 1 ... n_classes
+    '''
+    u, inv = np.unique(_normalize_labels(labels), return_inverse=True)
+    missing = [w for w in u if w not in out_word_index]
+    if len(missing) > 0:
+        raise ValueError('Unknown class labels: %s' % ', '.join(missing))
+
+    ids = np.array([out_word_index[w] for w in u], dtype=index_dtype(len(out_word_index)))
+    return ids[inv.reshape(-1)]
+
+
+def build_vocabulary(basedir = '/home/fagg/datasets/pfam', nfolds = 5, cachedir = None, force = False,
+                     chunksize = None):
+    '''
+    Build (or load) the vocabulary that is shared by all folds.  The vocabulary is fit
+    on all of the folds so that token ids do not depend on the rotation.  This pass also
+    records the size of each fold, so that the fold caches can be preallocated.
+
+    Note: the ids are not the ones that a tokenizer fit on the training folds of a rotation
+    would produce (the order and n_tokens can differ, and characters that only occur in the
+    validation/test folds are kept); see benchmark.rotation_parity().
+
+    The vocabulary is stored in cachedir/pfam_vocab.json and is rebuilt when any of the
+    source CSV files or the tokenizer configuration changes.
+
+    :param basedir: Directory containing input files
+    :param nfolds: Total number of folds
+    :param cachedir: Directory for the cache files (None -> use the basedir)
+    :param force: Rebuild the vocabulary even if the stored one is current
+    :param chunksize: Number of CSV rows to read at once (None -> read each fold in one piece)
+
+    :return: Vocabulary dictionary
+
+    Dictionary format:
+    key: the sources/configuration that the vocabulary was built from
+    digest: hash of the vocabulary contents
+    word_index: dictionary containing character -> token map (tokens are 1 ... )
+    out_word_index: dictionary containing class name -> index map (note index is 1... n_tokens)
+    folds: dictionary containing fold (str) -> {n: examples, length: total characters, len_max: longest string}
+    '''
+    if cachedir is None:
+        cachedir = basedir
+
+    key = {'config': TOKENIZER_CONFIG,
+           'sources': [_file_signature('%s/pfam_fold_%d.csv'%(basedir, f)) for f in range(nfolds)]}
+
+    fname = '%s/pfam_vocab.json'%(cachedir)
+    vocab = None if force else _read_json(fname)
+    if vocab is not None and vocab['key'] == key and 'folds' in vocab:
+        return vocab
+
+    print('vocabulary fit...')
+    counts = np.zeros(256, dtype=np.int64)
+    first = np.full(256, np.iinfo(np.int64).max, dtype=np.int64)
+    label_counts = {}
+    folds = {}
+    pos = 0
+    for f in range(nfolds):
+        stats = {'n': 0, 'length': 0, 'len_max': 0}
+        for df in iter_pfam_file(basedir, f, chunksize=chunksize):
+            strings = df['string'].values
+            start = pos
+            pos = _count_chars(strings, counts, first, pos)
+            _count_labels(df['label'].values, label_counts)
+
+            stats['n'] += len(strings)
+            stats['length'] += pos - start
+            stats['len_max'] = max([stats['len_max']] + [len(s) for s in strings])
+        folds[str(f)] = stats
+
+    vocab = {'key': key,
+             'word_index': _char_index(counts, first),
+             'out_word_index': _label_index(label_counts),
+             'folds': folds}
+    vocab['digest'] = _digest([vocab['word_index'], vocab['out_word_index']])
+
+    os.makedirs(cachedir, exist_ok=True)
+    _write_json(fname, vocab)
+    return vocab
+
+
+def fold_cache_dir(cachedir, fold):
+    '''
+    :param cachedir: Directory for the cache files
+    :param fold: Fold index
+    :return: Name of the cache directory for the fold
+    '''
+    return '%s/pfam_fold_%d_cache'%(cachedir, fold)
+
+
+def load_fold(basedir = '/home/fagg/datasets/pfam', fold = 0, vocab = None, cachedir = None, force = False,
+              chunksize = None):
+    '''
+    Load a single tokenized fold, tokenizing the CSV file (and caching the result)
+    only if the cache is missing or out of date.
+
+    With a chunksize, the CSV file is streamed: each chunk is tokenized and written
+    into the (preallocated, memory-mapped) cache files, so peak memory is bounded by
+    the chunk size rather than by the size of the fold.
+
+    :param basedir: Directory containing input files
+    :param fold: Fold to load
+    :param vocab: Vocabulary from build_vocabulary()
+    :param cachedir: Directory for the cache files (None -> use the basedir)
+    :param force: Rebuild the cache even if it is current
+    :param chunksize: Number of CSV rows to tokenize at once (None -> whole fold in memory)
+
+    :return: Dictionary containing the unpadded fold (arrays are memory mapped when read from the cache)
+
+    Dictionary format:
+    tokens: concatenation of the tokenized strings (total_length,).  uint8 for the amino-acid vocabulary
+    offsets: string i occupies tokens[offsets[i]:offsets[i+1]] (examples+1,)
+    labels: class index of each example.  Values are 1 ... n_classes (examples,).  Smallest integer type that fits
+    '''
+    if cachedir is None:
+        cachedir = basedir
+
+    dirname = fold_cache_dir(cachedir, fold)
+    key = {'source': _file_signature('%s/pfam_fold_%d.csv'%(basedir, fold)),
+           'config': TOKENIZER_CONFIG,
+           'format': CACHE_FORMAT,
+           'vocab': vocab['digest']}
+
+    current = _current_dir(dirname)
+    meta = None if force else _read_json('%s/meta.json'%(current))
+    if meta is None or meta['key'] != key:
+        print('tokenize fold %d...'%fold)
+        # Build the cache in a private directory and publish it when it is complete, so that
+        #  concurrent readers never see a partially written cache
+        tmp = '%s.tmp.%d'%(dirname, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        if chunksize is None:
+            df = load_pfam_file(basedir, fold)
+            tokens, offsets = tokenize_strings(df['string'].values, vocab['word_index'])
+            labels = encode_labels(df['label'].values, vocab['out_word_index'])
+
+            np.save('%s/tokens.npy'%(tmp), tokens)
+            np.save('%s/offsets.npy'%(tmp), offsets)
+            np.save('%s/labels.npy'%(tmp), labels)
+        else:
+            # Sizes are known from the vocabulary pass: preallocate on disk and fill chunk by chunk
+            stats = vocab['folds'][str(fold)]
+            tokens = np.lib.format.open_memmap('%s/tokens.npy'%(tmp), mode='w+',
+                                               dtype=index_dtype(len(vocab['word_index'])),
+                                               shape=(stats['length'],))
+            offsets = np.lib.format.open_memmap('%s/offsets.npy'%(tmp), mode='w+', dtype=np.int64,
+                                                shape=(stats['n'] + 1,))
+            labels = np.lib.format.open_memmap('%s/labels.npy'%(tmp), mode='w+',
+                                               dtype=index_dtype(len(vocab['out_word_index'])),
+                                               shape=(stats['n'],))
+            row = 0
+            offsets[0] = 0
+            for df in iter_pfam_file(basedir, fold, chunksize=chunksize):
+                t, o = tokenize_strings(df['string'].values, vocab['word_index'])
+                n = len(o) - 1
+                tokens[offsets[row]:offsets[row] + len(t)] = t
+                offsets[row + 1:row + n + 1] = o[1:] + offsets[row]
+                labels[row:row + n] = encode_labels(df['label'].values, vocab['out_word_index'])
+                row += n
+
+            # The vocabulary covers every fold, so no characters are dropped
+            assert row == stats['n'] and offsets[row] == stats['length'], \
+                "Fold %d changed while it was being read"%fold
+            tokens.flush()
+            offsets.flush()
+            labels.flush()
+            del tokens, offsets, labels
+
+        _write_json('%s/meta.json'%(tmp), {'key': key, 'n': vocab['folds'][str(fold)]['n']})
+        _publish_dir(tmp, dirname)
+        current = _current_dir(dirname)
+
+    return {'tokens': np.load('%s/tokens.npy'%(current), mmap_mode='r'),
+            'offsets': np.load('%s/offsets.npy'%(current), mmap_mode='r'),
+            'labels': np.load('%s/labels.npy'%(current), mmap_mode='r')}
+
+
+def pad_fold(fold_dat, len_max):
+    '''
+    Left-pad (and, for long strings, left-truncate) the strings of a fold to len_max.
+    This matches the behavior of pad_sequences(seq, maxlen=len_max)
+
+    :param fold_dat: Fold from load_fold()
+    :param len_max: Length of the padded strings
+
+    :return: Padded tokens (examples x len_max)
+    '''
+    return pad_tokens(fold_dat['tokens'], fold_dat['offsets'], len_max)
+
+
+def _rotation_folds_cached(basedir, rotation, nfolds, ntrain_folds, cachedir, chunksize):
+    '''
+    Open the cached folds that make up a rotation (building the caches if necessary)
+
+    :return: Tuple (splits, folds, rotation information)
+             splits: dictionary containing split name -> array of fold indices
+             folds: dictionary containing fold index -> fold from load_fold()
+             rotation information: dictionary with the len_max, n_tokens, index map and rotation entries
+    '''
+    vocab = build_vocabulary(basedir=basedir, nfolds=nfolds, cachedir=cachedir, chunksize=chunksize)
+
+    # Load each fold that takes part in the rotation (once)
+    splits = dict(zip(['train', 'valid', 'test'], rotation_folds(rotation, nfolds, ntrain_folds)))
+    folds = {f: load_fold(basedir, f, vocab=vocab, cachedir=cachedir, chunksize=chunksize)
+             for f in np.unique(np.concatenate(list(splits.values())))}
+
+    # Compute max length: only defined with respect to the training set
+    len_max = int(max(np.max(np.diff(folds[f]['offsets'])) for f in splits['train']))
+
+    # Fixed vocabulary: the number of tokens does not depend on the rotation
+    info = {'len_max': len_max,
+            'n_tokens': len(vocab['word_index']) + 2,
+            'word_index': dict(vocab['word_index']),
+            'out_word_index': dict(vocab['out_word_index']),
+            'out_index_word': {i: w for w, i in vocab['out_word_index'].items()},
+            'rotation': rotation}
+
+    return splits, folds, info
+
+
+def prepare_data_set(basedir = '/home/fagg/datasets/pfam', rotation = 0, nfolds = 5, ntrain_folds = 3,
+                     cachedir = None, chunksize = None):
     '''
-    Generate a full data set
+    Generate a full data set from the fold caches (building the caches if necessary)
 
     :param basedir: Directory containing input files
     :param rotation: Rotation to load
     :param nfolds: Total number of folds
     :param ntrain_folds: Number of training folds to use
+    :param cachedir: Directory for the cache files (None -> use the basedir)
+    :param chunksize: Number of CSV rows to read at once when building caches (None -> whole folds)
 
     :return: Dictionary containing a full train/validation/test data set
 
     Dictionary format:
-    ins_train: tokenized training inputs (examples x len_max)
-    outs_train: tokenized training outputs (examples x 1).  Values are 0 ... n_tokens-1
+    ins_train: tokenized training inputs (examples x len_max).  uint8 for the amino-acid vocabulary
+    outs_train: tokenized training outputs (examples x 1).  Values are 0 ... n_tokens-1.  Smallest integer type that fits
     ins_valid: tokenized validation inputs (examples x len_max)
     outs_valid: tokenized validation outputs (examples x 1)
     ins_test: tokenized test inputs (examples x len_max)
@@ -90,123 +680,759 @@ def prepare_data_set(basedir = '/home/fagg/datasets/pfam', rotation = 0, nfolds
     n_tokens: Maximum number of output tokens 
     out_index_word: dictionary containing index -> class name map (note index is 1... n_toeksn)
     out_word_index: dictionary containing class name -> index map (note index is 1... n_toeksn)
+    word_index: dictionary containing character -> input token map (the input vocabulary)
     '''
 
-    
-    # Load the data from the disk
-    dat = load_pfam_dataset(basedir=basedir, rotation=rotation, nfolds=nfolds, ntrain_folds=ntrain_folds)
+    splits, folds, info = _rotation_folds_cached(basedir, rotation, nfolds, ntrain_folds, cachedir, chunksize)
+    len_max = info['len_max']
 
-    # Extract ins/outs
     dat_out = {}
+    for k, fs in splits.items():
+        dat_out['ins_'+k] = np.concatenate([pad_fold(folds[f], len_max) for f in fs])
+        dat_out['outs_'+k] = np.concatenate([folds[f]['labels'] for f in fs]).reshape(-1, 1) - 1
 
-    # Extract ins/outs for each dataset
-    for k, df in dat.items():
-        # Get the set of strings
-        
-        dat_out['ins_'+k] = df['string'].values
-        dat_out['outs_'+k] = df['label'].values
-
-    # Compute max length: only defined with respect to the training set
-    len_max = np.max(np.array([len(s) for s in dat_out['ins_train']]))
-
-    print('tokenize fit...')
-    # Convert strings to lists of indices
-    tokenizer = keras.preprocessing.text.Tokenizer(char_level=True,
-                                                   filters='\t\n')
-    tokenizer.fit_on_texts(dat_out['ins_train']) # Fit the tokenizer on the training data
-
-    print('tokenize...')
-    # Loop over all data sets
-    for k in dat.keys():
-        # Loop over all strings and tokenize
-        seq = tokenizer.texts_to_sequences(dat_out['ins_'+k])
-        dat_out['ins_'+k] = pad_sequences(seq, maxlen=len_max) # Pad out so all are the same length
-
-    n_tokens = np.max(dat_out['ins_train']) + 2
-
-    print('outputs...')
-    # Loop over all data sets: create tokenizer for output
-    tokenizer = keras.preprocessing.text.Tokenizer(filters='\t\n')
-    tokenizer.fit_on_texts(dat_out['outs_train']) # Essentially turns into label encoding
-
-    # Tokenize all of the outputs
-    for k in dat.keys():
-        dat_out['outs_'+k] = np.array(tokenizer.texts_to_sequences(dat_out['outs_'+k]))-1
-        #np.expand_dims(dat_out['outs_'+k],  axis=-1)seq =
-        
-    #
-    dat_out['len_max'] = len_max
-    dat_out['n_tokens'] = n_tokens
-    dat_out['out_index_word'] = tokenizer.index_word
-    dat_out['out_word_index'] = tokenizer.word_index
-    dat_out['rotation'] = rotation
+    dat_out.update(info)
     
     return dat_out
 
+
+def write_rotation(basedir = '/home/fagg/datasets/pfam', rotation = 0, nfolds = 5, ntrain_folds = 3,
+                   cachedir = None, dirname = None, chunksize = 65536):
+    '''
+    Build a rotation directly in the memory-mappable layout (see save_rotation()).  The padded
+    arrays are written to disk chunksize examples at a time, so the rotation never has to fit
+    in memory.
+
+    :param basedir: Directory containing input files
+    :param rotation: Rotation to build
+    :param nfolds: Total number of folds
+    :param ntrain_folds: Number of training folds to use
+    :param cachedir: Directory for the cache files (None -> use the basedir)
+    :param dirname: Output directory (None -> rotation_dir(cachedir, rotation))
+    :param chunksize: Number of CSV rows / examples to process at once
+
+    :return: Name of the directory holding the rotation
+    '''
+    if cachedir is None:
+        cachedir = basedir
+    if dirname is None:
+        dirname = rotation_dir(cachedir, rotation)
+
+    splits, folds, info = _rotation_folds_cached(basedir, rotation, nfolds, ntrain_folds, cachedir, chunksize)
+    len_max = info['len_max']
+
+    # Build the rotation in a private directory and publish it when it is complete
+    tmp = '%s.tmp.%d'%(dirname, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for k, fs in splits.items():
+        n = sum(len(folds[f]['labels']) for f in fs)
+        # Newly created files are zero filled (i.e., already padded)
+        ins = np.lib.format.open_memmap('%s/ins_%s.npy'%(tmp, k), mode='w+',
+                                        dtype=folds[fs[0]]['tokens'].dtype, shape=(n, len_max))
+        outs = np.lib.format.open_memmap('%s/outs_%s.npy'%(tmp, k), mode='w+',
+                                         dtype=folds[fs[0]]['labels'].dtype, shape=(n, 1))
+        row = 0
+        for f in fs:
+            offsets = folds[f]['offsets']
+            nf = len(offsets) - 1
+            for start in range(0, nf, chunksize):
+                stop = min(start + chunksize, nf)
+                pad_tokens(folds[f]['tokens'], offsets[start:stop + 1], len_max,
+                           out=ins[row + start:row + stop])
+            outs[row:row + nf, 0] = folds[f]['labels'] - 1
+            row += nf
+
+        ins.flush()
+        outs.flush()
+        del ins, outs
+
+    _write_json('%s/meta.json'%(tmp), _rotation_meta(info, nfolds, ntrain_folds,
+                                                     _rotation_keys(basedir, rotation, nfolds)[0]))
+    _publish_dir(tmp, dirname)
+
+    return dirname
+
     
-def save_data_sets(basedir = '/home/fagg/datasets/pfam', out_basedir = None, nfolds = 5, ntrain_folds = 3):
+def save_data_sets(basedir = '/home/fagg/datasets/pfam', out_basedir = None, nfolds = 5, ntrain_folds = 3,
+                   save_rotations = False, chunksize = None):
     '''
-    Generate pickle files for all rotations.
+    Generate the vocabulary and the fold caches.  Any rotation can then be composed
+    from these with prepare_data_set() / load_rotation().
 
     :param basedir: Directory containing input files
     :param out_basedir: Directory for output files (None -> use the basedir)
     :param nfolds: Total number of folds
-    :param ntrain_folds: Number of training folds to use
-    :param rotation: Rotation to load
+    :param ntrain_folds: Number of training folds to use (only used for save_rotations)
+    :param save_rotations: Also write every rotation in the memory-mappable layout (see save_rotation())
+    :param chunksize: Number of CSV rows to process at once (None -> whole folds).  With a chunksize,
+                      peak memory is bounded by the chunk size rather than by the size of the data set
 
-    :return: Dictionary containing a full train/validation/test data set
+    :return: Vocabulary dictionary
+    '''
+
+    if out_basedir is None:
+        out_basedir = basedir
+
+    vocab = build_vocabulary(basedir=basedir, nfolds=nfolds, cachedir=out_basedir, chunksize=chunksize)
+
+    # Tokenize each fold once
+    for f in range(nfolds):
+        load_fold(basedir, f, vocab=vocab, cachedir=out_basedir, chunksize=chunksize)
+
+    if save_rotations:
+        for r in range(nfolds):
+            write_rotation(basedir=basedir, rotation=r, nfolds=nfolds, ntrain_folds=ntrain_folds,
+                           cachedir=out_basedir, chunksize=65536 if chunksize is None else chunksize)
+
+    return vocab
+
+def rotation_dir(basedir, rotation):
+    '''
+    :param basedir: Directory containing the rotation
+    :param rotation: Rotation index
+    :return: Name of the directory holding the memory-mappable rotation
+    '''
+    return '%s/pfam_rotation_%d'%(basedir, rotation)
+
+
+def _rotation_keys(basedir, rotation, nfolds):
+    '''
+    Signatures of the sources that a stored rotation may have been built from
+
+    :param basedir: Directory containing the input files
+    :param rotation: Rotation index
+    :param nfolds: Total number of folds
+    :return: List of keys: the fold CSV files (with the tokenizer configuration and cache format;
+             see write_rotation()) and the rotation pickle file (see convert_rotation_pickle()),
+             for those that exist
+    '''
+    keys = []
+    csvs = ['%s/pfam_fold_%d.csv'%(basedir, f) for f in range(nfolds)]
+    if all(os.path.exists(f) for f in csvs):
+        keys.append({'sources': [_file_signature(f) for f in csvs],
+                     'config': TOKENIZER_CONFIG,
+                     'format': CACHE_FORMAT})
+    fname = '%s/pfam_rotation_%d.pkl'%(basedir, rotation)
+    if os.path.exists(fname):
+        keys.append({'pickle': _file_signature(fname)})
+    return keys
+
+
+def save_rotation(dat, dirname, nfolds = 5, ntrain_folds = 3, key = None):
+    '''
+    Write a rotation in the memory-mappable layout: one raw .npy file per array
+    (ins_train.npy, outs_train.npy, ...) plus meta.json holding len_max, n_tokens
+    and the index maps.
+
+    :param dat: Data structure from prepare_data_set() or load_rotation()
+    :param dirname: Output directory
+    :param nfolds: Total number of folds that the rotation was built from
+    :param ntrain_folds: Number of training folds that the rotation was built from
+    :param key: Signature of the sources of the rotation (see _rotation_keys()).  load_rotation()
+                only uses a directory whose key matches its current sources (None -> never)
+    '''
+    # Write the rotation in a private directory and publish it when it is complete, so that
+    #  readers never see a mix of old and new arrays
+    tmp = '%s.tmp.%d'%(dirname, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    for k in ['train', 'valid', 'test']:
+        for prefix in ['ins_', 'outs_']:
+            if dat.get(prefix+k) is not None:
+                np.save('%s/%s%s.npy'%(tmp, prefix, k), np.ascontiguousarray(dat[prefix+k]))
+
+    _write_json('%s/meta.json'%(tmp), _rotation_meta(dat, nfolds, ntrain_folds, key))
+    _publish_dir(tmp, dirname)
+
+
+def _rotation_meta(dat, nfolds, ntrain_folds, key):
+    '''
+    :param dat: Data structure (or rotation information) containing len_max, n_tokens, the index maps and rotation
+    :param nfolds: Total number of folds that the rotation was built from
+    :param ntrain_folds: Number of training folds that the rotation was built from
+    :param key: Signature of the sources of the rotation (see _rotation_keys())
+    :return: JSON-serializable metadata for a memory-mappable rotation
+    '''
+    return {'len_max': int(dat['len_max']),
+            'n_tokens': int(dat['n_tokens']),
+            'out_index_word': {str(i): w for i, w in dat['out_index_word'].items()},
+            'out_word_index': {w: int(i) for w, i in dat['out_word_index'].items()},
+            'word_index': None if dat.get('word_index') is None else {c: int(i) for c, i in dat['word_index'].items()},
+            'rotation': int(dat['rotation']),
+            'nfolds': nfolds,
+            'ntrain_folds': ntrain_folds,
+            'key': key}
+
+
+def load_rotation_dir(dirname, mmap_mode = 'r', keys = None):
+    '''
+    Open a rotation stored by save_rotation().  By default, the arrays are memory mapped
+    (read-only): pages are only loaded as they are touched and are shared (via the page cache)
+    by all processes on a node that open the same rotation.
+
+    :param dirname: Directory containing the rotation
+    :param mmap_mode: Memory-map mode for np.load() (None -> read the arrays into memory)
+    :param keys: Acceptable source signatures (see _rotation_keys(); None -> any rotation)
+
+    :return: Dictionary containing a full train/validation/test data set (None if there is no
+             complete rotation in dirname, or if it was built from other sources)
     '''
+    # All files from the same version (see _publish_dir())
+    dirname = _current_dir(dirname)
+    meta = _read_json('%s/meta.json'%(dirname))
+    if meta is None:
+        return None
+    if keys is not None and meta.get('key') not in keys:
+        return None
+
+    dat_out = {}
+    for k in ['train', 'valid', 'test']:
+        for prefix in ['ins_', 'outs_']:
+            fname = '%s/%s%s.npy'%(dirname, prefix, k)
+            dat_out[prefix+k] = np.load(fname, mmap_mode=mmap_mode) if os.path.exists(fname) else None
+
+    dat_out['len_max'] = meta['len_max']
+    dat_out['n_tokens'] = meta['n_tokens']
+    dat_out['out_index_word'] = {int(i): w for i, w in meta['out_index_word'].items()}
+    dat_out['out_word_index'] = meta['out_word_index']
+    # Rotations written before the input vocabulary was stored: None
+    dat_out['word_index'] = meta.get('word_index')
+    dat_out['rotation'] = meta['rotation']
+    dat_out['nfolds'] = meta['nfolds']
+    dat_out['ntrain_folds'] = meta['ntrain_folds']
 
+    return dat_out
+
+
+def compact_rotation(dat):
+    '''
+    Narrow the token and label arrays of a rotation (e.g., from an int32 pickle file) to the
+    smallest integer types that fit.  Modifies dat
+
+    :param dat: Data structure from prepare_data_set() or load_rotation()
+    :return: dat
+    '''
+    for k in ['train', 'valid', 'test']:
+        if dat.get('ins_'+k) is not None:
+            dat['ins_'+k] = dat['ins_'+k].astype(index_dtype(dat['n_tokens']), copy=False)
+        if dat.get('outs_'+k) is not None:
+            dat['outs_'+k] = dat['outs_'+k].astype(index_dtype(len(dat['out_word_index'])), copy=False)
+    return dat
+
+
+def convert_rotation_pickle(basedir = '/home/fagg/datasets/pfam', rotation = 0, out_basedir = None):
+    '''
+    Convert a rotation pickle file (pfam_rotation_%d.pkl) into the memory-mappable layout
+
+    :param basedir: Directory containing the pickle file
+    :param rotation: Rotation to convert
+    :param out_basedir: Directory for the converted rotation (None -> use the basedir)
+
+    :return: Name of the directory holding the converted rotation
+    '''
     if out_basedir is None:
         out_basedir = basedir
-        
-    # Loop over all rotations
-    for r in range(nfolds):
-        # Load the rotation
-        dat=prepare_data_set(basedir=basedir, rotation=r, nfolds=nfolds, ntrain_folds=ntrain_folds)
 
-        # Write rotation to pickle file
-        fname = '%s/pfam_rotation_%d.pkl'%(basedir, r)
+    with open('%s/pfam_rotation_%d.pkl'%(basedir, rotation), 'rb') as fp:
+        dat = compact_rotation(pickle.load(fp))
+
+    dirname = rotation_dir(out_basedir, rotation)
+    save_rotation(dat, dirname, key={'pickle': _file_signature('%s/pfam_rotation_%d.pkl'%(basedir, rotation))})
+    return dirname
 
-        with open(fname, 'wb') as fp:
-            pickle.dump(dat, fp)
             
-def load_rotation(basedir = '/home/fagg/datasets/pfam', rotation=0):
+def load_rotation(basedir = '/home/fagg/datasets/pfam', rotation=0, nfolds = 5, ntrain_folds = 3, cachedir = None,
+                  mmap_mode = 'r'):
     '''
-    Load a single rotation from a pickle file.  These rotations are 5 folds, 3 training folds
+    Load a single rotation.  In order of preference, the rotation comes from:
+    1. A memory-mappable rotation directory (pfam_rotation_%d/, see save_rotation()) in
+       the cachedir or the basedir, if it was built from the current fold CSV files or
+       rotation pickle file (with the current tokenizer configuration)
+    2. A rotation pickle file (5 folds, 3 training folds)
+    3. The fold caches (see prepare_data_set())
 
     :param basedir: Directory containing files
     :param rotation: Rotation to load
+    :param nfolds: Total number of folds
+    :param ntrain_folds: Number of training folds to use
+    :param cachedir: Directory for the cache files (None -> use the basedir)
+    :param mmap_mode: Memory-map mode for rotation directories (None -> read into memory)
 
     :return: Dictionary containing a full train/validation/test data set
     '''
+    keys = _rotation_keys(basedir, rotation, nfolds)
+    for d in ([basedir] if cachedir is None else [cachedir, basedir]):
+        dat_out = load_rotation_dir(rotation_dir(d, rotation), mmap_mode=mmap_mode, keys=keys)
+        if dat_out is not None and dat_out['nfolds'] == nfolds and dat_out['ntrain_folds'] == ntrain_folds:
+            return dat_out
+
     fname = '%s/pfam_rotation_%d.pkl'%(basedir, rotation)
-    with open(fname, 'rb') as fp:
-        dat_out = pickle.load(fp)
-        return dat_out
-    return None
+    if nfolds == 5 and ntrain_folds == 3 and os.path.exists(fname):
+        with open(fname, 'rb') as fp:
+            dat_out = compact_rotation(pickle.load(fp))
+            return dat_out
+
+    return prepare_data_set(basedir=basedir, rotation=rotation, nfolds=nfolds, ntrain_folds=ntrain_folds,
+                            cachedir=cachedir)
+
+def _reverse_sequence(x, y):
+    '''
+    Reverse the time axis of a single example
+    '''
+    import tensorflow as tf
+
+    return tf.reverse(x, [0]), y
 
-def create_tf_datasets(dat, batch=8, prefetch=None):
+def _reverse_batch(x, y):
+    '''
+    Reverse the time axis of a batch of examples
+    '''
+    import tensorflow as tf
+
+    return tf.reverse(x, [1]), y
+
+def _sequence_length(x, y):
+    '''
+    :return: Length of a single (unpadded) example
+    '''
+    import tensorflow as tf
+
+    return tf.shape(x)[0]
+
+def _unpadded_dataset(ins, outs, chunk=4096):
+    '''
+    TF DataSet of the unpadded examples, in order.  Tokens are never zero and padding is on the
+    left, so the nonzero entries of each row are exactly the tokens of the string.  The rows are
+    gathered from ins (e.g., a memory-mapped rotation) a chunk at a time, so ins is never copied
+    as a whole or embedded in the graph.
+
+    :param ins: Left-padded tokenized inputs (examples x len_max)
+    :param outs: Tokenized outputs (examples x 1)
+    :param chunk: Number of rows gathered at once
+    :return: Dataset of (sequence (length,), output) pairs
+    '''
+    import tensorflow as tf
+
+    outs = np.asarray(outs)
+    x_shape = (None,) + ins.shape[1:]
+    y_shape = (None,) + outs.shape[1:]
+
+    def gather(start):
+        x, y = tf.numpy_function(lambda s: (np.asarray(ins[s:s + chunk]), outs[s:s + chunk]), [start],
+                                 (tf.as_dtype(ins.dtype), tf.as_dtype(outs.dtype)))
+        x.set_shape(x_shape)
+        y.set_shape(y_shape)
+        return tf.ragged.boolean_mask(x, x > 0), y
+
+    return tf.data.Dataset.range(0, len(ins), chunk).map(gather).unbatch()
+
+def create_bucketed_dataset(ins, outs, batch=8, bucket_boundaries=(100, 200, 400, 800), shuffle=None,
+                            cache=None, seed=None):
+    '''
+    Create a TF DataSet that groups examples by their true (unpadded) length and pads each batch
+    only to the longest sequence in that batch.  Padding remains on the left hand side.
+
+    Note: examples are reordered by the bucketing.  Use these datasets with .fit() and .evaluate(),
+    not to produce per-example predictions.
+
+    :param ins: Left-padded tokenized inputs (examples x len_max)
+    :param outs: Tokenized outputs (examples x 1)
+    :param batch: Batch size (int)
+    :param bucket_boundaries: Increasing sequence lengths that separate the buckets
+    :param shuffle: Shuffle buffer size (None = no shuffle).  Examples are reshuffled every epoch
+    :param cache: None = no cache; '' = cache the unpadded examples in memory; otherwise, cache file name
+    :param seed: Shuffle seed
+
+    '''
+    import tensorflow as tf
+
+    # Batches are padded at the end: pad the reversed strings and reverse the padded batch
+    dataset = _unpadded_dataset(ins, outs).map(_reverse_sequence, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+    if shuffle is not None:
+        dataset = dataset.shuffle(shuffle, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.bucket_by_sequence_length(element_length_func=_sequence_length,
+                                                bucket_boundaries=list(bucket_boundaries),
+                                                bucket_batch_sizes=[batch] * (len(bucket_boundaries) + 1))
+    return dataset.map(_reverse_batch, num_parallel_calls=tf.data.AUTOTUNE)
+
+def _random_window(window, seed=None, fixed=False):
+    '''
+    :param window: Window length
+    :param seed: Op-level random seed
+    :param fixed: The window of an example only depends on the seed and the position of the example,
+                  i.e., it is the same every epoch
+    :return: Function (x, y) -> (x', y) that takes a random window of an unpadded example (with fixed:
+             function (i, (x, y)) -> (x', y), for enumerated examples).  Examples that are shorter
+             than the window are kept whole and left-padded to the window length
+    '''
+    import tensorflow as tf
+
+    def cut(x, start):
+        x = x[start:start + window]
+        x = tf.pad(x, [[window - tf.shape(x)[0], 0]])
+        return tf.ensure_shape(x, [window])
+
+    def crop(x, y):
+        n = tf.shape(x)[0]
+        start = tf.random.uniform((), 0, tf.maximum(n - window, 0) + 1, dtype=tf.int32, seed=seed)
+        return cut(x, start), y
+
+    def crop_fixed(i, example):
+        x, y = example
+        n = tf.shape(x)[0]
+        start = tf.random.stateless_uniform((), tf.stack([tf.cast(seed or 0, tf.int64), i]), 0,
+                                            tf.maximum(n - window, 0) + 1, dtype=tf.int32)
+        return cut(x, start), y
+
+    return crop_fixed if fixed else crop
+
+def create_crop_dataset(ins, outs, batch=8, window=256, shuffle=None, cache=None, seed=None, fixed=False):
+    '''
+    Create a TF DataSet of fixed-length random windows of the true (unpadded) sequences.  A new
+    window is drawn for every example every epoch, so a model built for the window length sees
+    all parts of the sequences over the course of training (see window_examples() for the
+    matching inference).  With fixed, every example keeps the same window in every epoch, so
+    that a validation metric computed on these windows only changes with the model.
+
+    :param ins: Left-padded tokenized inputs (examples x len_max)
+    :param outs: Tokenized outputs (examples x 1)
+    :param batch: Batch size (int)
+    :param window: Window length
+    :param shuffle: Shuffle buffer size (None = no shuffle).  Examples are reshuffled every epoch
+    :param cache: None = no cache; '' = cache the unpadded examples in memory; otherwise, cache file name
+    :param seed: Shuffle and window seed
+    :param fixed: Draw the same window of each example every epoch (e.g., for validation; not
+                  combined with shuffle)
+
+    '''
+    import tensorflow as tf
+
+    assert not (fixed and shuffle is not None), "Fixed windows are drawn from the examples in order"
+    dataset = _unpadded_dataset(ins, outs)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+    if fixed:
+        dataset = dataset.enumerate().map(_random_window(window, seed, fixed=True),
+                                          num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.batch(batch)
+
+    if shuffle is not None:
+        dataset = dataset.shuffle(shuffle, seed=seed, reshuffle_each_iteration=True)
+    # Windows are drawn after the cache: they change every epoch
+    dataset = dataset.map(_random_window(window, seed), num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.batch(batch)
+
+def window_starts(lengths, window, stride):
+    '''
+    Starts of the overlapping windows that cover each sequence
+
+    :param lengths: True (unpadded) length of each sequence
+    :param window: Window length
+    :param stride: Distance between the starts of consecutive windows
+    :return: Tuple (owner, start): for each window, the index of its sequence and its start within
+             the sequence.  The last window of each sequence ends with the sequence; sequences that
+             are not longer than the window have a single window
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    last = np.maximum(lengths - window, 0)
+    counts = -(-last // stride) + 1
+    owner = np.repeat(np.arange(len(lengths)), counts)
+    # Position of each window within its sequence
+    first = np.cumsum(counts) - counts
+    k = np.arange(owner.size) - np.repeat(first, counts)
+    start = np.minimum(k * stride, last[owner])
+    return owner, start
+
+def window_examples(ins, window, stride):
+    '''
+    Cut left-padded sequences into overlapping windows of a fixed length (left-padded if the
+    sequence is shorter than the window)
+
+    :param ins: Left-padded tokenized inputs (examples x len_max), with len_max >= window
+    :param window: Window length
+    :param stride: Distance between the starts of consecutive windows
+    :return: Tuple (windows (windows x window), owner (index of the example of each window))
+    '''
+    len_max = ins.shape[1]
+    assert window <= len_max, "Window is longer than the sequences"
+    lengths = np.count_nonzero(ins, axis=1)
+    owner, start = window_starts(lengths, window, stride)
+
+    # Column of the first token of each window.  Short sequences: the last window columns
+    col = np.where(lengths[owner] >= window, len_max - lengths[owner] + start, len_max - window)
+    windows = ins[owner[:, None], col[:, None] + np.arange(window)]
+    return windows, owner
+
+def window_tokens(tokens, offsets, window, stride, chunk=65536):
+    '''
+    Cut unpadded tokenized strings into overlapping windows of a fixed length (left-padded if the
+    string is shorter than the window).  Each string is windowed from its own offsets, so the cost
+    depends on the total length of the strings rather than on the longest one
+
+    :param tokens: Concatenated tokens
+    :param offsets: String i occupies tokens[offsets[i]:offsets[i+1]]
+    :param window: Window length
+    :param stride: Distance between the starts of consecutive windows
+    :param chunk: Number of windows to cut at once (bounds the size of the index arrays)
+    :return: Tuple (windows (windows x window), owner (index of the string of each window))
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    owner, start = window_starts(lengths, window, stride)
+
+    # Index 0 of the padded stream is the padding token
+    padded = np.concatenate([np.zeros(1, dtype=tokens.dtype), tokens])
+    windows = np.empty((len(owner), window), dtype=tokens.dtype)
+    pos = np.arange(window)
+    for lo in range(0, len(owner), chunk):
+        o = owner[lo:lo + chunk]
+        pad = (window - np.minimum(lengths[o], window)).reshape(-1, 1)
+        src = (offsets[o] + start[lo:lo + chunk]).reshape(-1, 1) + pos - pad + 1
+        windows[lo:lo + chunk] = padded[np.where(pos >= pad, src, 0)]
+    return windows, owner
+
+def aggregate_windows(pred, owner, n, method='logit'):
+    '''
+    Combine the predictions of the windows of each sequence
+
+    :param pred: Predicted class probabilities of the windows (windows x classes)
+    :param owner: Index of the sequence of each window
+    :param n: Number of sequences
+    :param method: 'logit': softmax of the mean log-probability (i.e., mean logits);
+                   'prob': mean probability
+    :return: Class probabilities of the sequences (n x classes)
+    '''
+    pred = np.asarray(pred, dtype=np.float64)
+    counts = np.bincount(owner, minlength=n).reshape(-1, 1)
+    values = np.log(np.clip(pred, 1e-7, 1)) if method == 'logit' else pred
+    assert method in ['logit', 'prob'], "Unknown aggregation %s" % method
+
+    total = np.zeros((n, pred.shape[1]))
+    np.add.at(total, owner, values)
+    mean = total / np.maximum(counts, 1)
+    if method == 'prob':
+        return mean.astype(np.float32)
+
+    mean -= mean.max(axis=1, keepdims=True)
+    out = np.exp(mean)
+    return (out / out.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def create_balanced_dataset(ins, outs, batch=8, class_weights=None, prefetch=None, seed=None):
+    '''
+    Create an infinite TF DataSet that streams a class-balanced mix of examples.  Each class has
+    its own (reshuffled) stream of example indices; the streams are interleaved at random according
+    to the target class distribution (per-class resampling).  Minority classes are therefore
+    repeated more often than majority classes within an "epoch".
+
+    Only the index streams live in the graph: the examples of each batch are gathered from ins
+    (e.g., a memory-mapped rotation) when the batch is produced, so ins is never copied as a whole.
+
+    The dataset never ends: use it with model.fit(steps_per_epoch=...)
+
+    :param ins: Tokenized inputs (examples x len_max)
+    :param outs: Tokenized outputs (examples x 1).  Values are 0 ... n_classes-1
+    :param batch: Batch size (int)
+    :param class_weights: Target class distribution (one weight per class; normalized).  None = uniform
+    :param prefetch: Number of batches to prefetch.  (None = no prefetch; tf.data.AUTOTUNE (-1) = autotuned)
+    :param seed: Sampling seed
+
+    '''
+    import tensorflow as tf
+
+    labels = np.asarray(outs).reshape(-1)
+    n_classes = int(np.max(labels)) + 1
+    if class_weights is None:
+        class_weights = np.ones(n_classes)
+    assert len(class_weights) >= n_classes, "Need one class weight per class"
+
+    # One stream of indices per class that is present (and wanted)
+    streams = []
+    weights = []
+    for c in range(n_classes):
+        idx = np.nonzero(labels == c)[0]
+        if len(idx) > 0 and class_weights[c] > 0:
+            streams.append(tf.data.Dataset.from_tensor_slices(idx).shuffle(len(idx), seed=seed,
+                                                                           reshuffle_each_iteration=True).repeat())
+            weights.append(float(class_weights[c]))
+    weights = list(np.array(weights) / np.sum(weights))
+
+    outs = np.asarray(outs)
+    x_shape = (None,) + ins.shape[1:]
+    y_shape = (None,) + outs.shape[1:]
+
+    def gather(i):
+        x, y = tf.numpy_function(lambda idx: (np.asarray(ins[idx]), outs[idx]), [i],
+                                 (tf.as_dtype(ins.dtype), tf.as_dtype(outs.dtype)))
+        x.set_shape(x_shape)
+        y.set_shape(y_shape)
+        return x, y
+
+    dataset = tf.data.Dataset.sample_from_datasets(streams, weights=weights, seed=seed)
+    dataset = dataset.batch(batch).map(gather, num_parallel_calls=tf.data.AUTOTUNE)
+
+    # Prefetch if specified
+    if prefetch is not None:
+        dataset = dataset.prefetch(prefetch)
+
+    return dataset
+
+def create_view_dataset(ins_views, outs, batch=8, shuffle=False, seed=None):
+    '''
+    Create a TF DataSet that reads batches directly from a list of arrays (e.g., views of folds that
+    live in shared memory) without concatenating them.  Only one batch at a time is copied.
+
+    :param ins_views: List of tokenized input arrays (examples_i x len_max), all of the same dtype
+    :param outs: Tokenized outputs for the concatenation of the views (examples x 1)
+    :param batch: Batch size (int)
+    :param shuffle: Visit the examples in a new random order every epoch
+    :param seed: Shuffle seed (the seed for epoch e is seed + e)
+
+    '''
+    import tensorflow as tf
+
+    bounds = np.cumsum([0] + [len(v) for v in ins_views])
+    len_max = ins_views[0].shape[1]
+    dtype = ins_views[0].dtype
+    outs = np.asarray(outs)
+    epoch = [0]
+
+    def generator():
+        n = bounds[-1]
+        if shuffle:
+            order = np.random.default_rng(None if seed is None else seed + epoch[0]).permutation(n)
+            epoch[0] += 1
+        else:
+            order = np.arange(n)
+
+        for start in range(0, n, batch):
+            idx = order[start:start + batch]
+            view = np.searchsorted(bounds, idx, side='right') - 1
+            x = np.empty((len(idx), len_max), dtype=dtype)
+            for j in np.unique(view):
+                mask = view == j
+                x[mask] = ins_views[j][idx[mask] - bounds[j]]
+            yield x, outs[idx]
+
+    return tf.data.Dataset.from_generator(generator,
+                                          output_signature=(tf.TensorSpec((None, len_max), dtype),
+                                                            tf.TensorSpec((None,) + outs.shape[1:], outs.dtype)))
+
+def create_dataset(ins, outs, batch=8, prefetch=None, bucket_boundaries=None, shuffle=None, cache=None,
+                   seed=None, crop_window=None, fixed_crops=False):
+    '''
+    Create a TF DataSet for one set of inputs/outputs.  The pipeline is:
+    examples -> cache -> shuffle -> batch -> prefetch
+
+    If ins is a list of arrays, the batches are read from these arrays (see create_view_dataset()).
+    Bucketing and caching are not available in this case, and any shuffle buffer size means a
+    full reshuffle every epoch.
+
+    :param ins: Tokenized inputs (examples x len_max), or a list of such arrays
+    :param outs: Tokenized outputs (examples x 1)
+    :param batch: Batch size (int)
+    :param prefetch: Number of batches to prefetch.  (None = no prefetch; tf.data.AUTOTUNE (-1) = autotuned)
+    :param bucket_boundaries: Sequence lengths that separate length buckets.  None = every batch is padded
+                              to len_max; otherwise, see create_bucketed_dataset()
+    :param shuffle: Shuffle buffer size (None = no shuffle).  Examples are reshuffled every epoch
+    :param cache: None = no cache; '' = cache in memory; otherwise, cache file name
+    :param seed: Shuffle seed
+    :param crop_window: Window length: the examples are random windows of the sequences
+                        (see create_crop_dataset()).  None = whole sequences
+    :param fixed_crops: Each example keeps the same window every epoch (see create_crop_dataset())
+
+    '''
+    import tensorflow as tf
+
+    if isinstance(ins, list):
+        assert bucket_boundaries is None and cache is None and crop_window is None, \
+            "Lists of arrays cannot be bucketed, cached or cropped"
+        dataset = create_view_dataset(ins, outs, batch, shuffle=shuffle is not None, seed=seed)
+    elif crop_window is not None:
+        assert bucket_boundaries is None, "Windows all have the same length: bucketing does not apply"
+        dataset = create_crop_dataset(ins, outs, batch, crop_window, shuffle=shuffle, cache=cache, seed=seed,
+                                      fixed=fixed_crops)
+    elif bucket_boundaries is None:
+        dataset = tf.data.Dataset.from_tensor_slices((ins, outs))
+        if cache is not None:
+            dataset = dataset.cache(cache)
+        if shuffle is not None:
+            dataset = dataset.shuffle(shuffle, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch)
+    else:
+        dataset = create_bucketed_dataset(ins, outs, batch, bucket_boundaries, shuffle=shuffle, cache=cache,
+                                          seed=seed)
+
+    # Prefetch if specified
+    if prefetch is not None:
+        dataset = dataset.prefetch(prefetch)
+
+    return dataset
+
+def create_tf_datasets(dat, batch=8, prefetch=None, bucket_boundaries=None, shuffle=None, cache=None,
+                       batch_inference=None, seed=None, balance=False, class_weights=None, crop_window=None):
     '''
     Translate the data structure from load_rotation() or prepare_data_set() into a proper TF DataSet object
     for each of training, validation and testing.  These act as configurable generators that can be used by
     model.fit(), .predict() and .evaluate()
 
+    Only the training set is shuffled.  Without bucketing, the validation and testing sets keep their
+    order, so they can also be used to produce per-example predictions.
+
     :param dat: Data structure from load_rotation() or prepare_data_set()
     :param batch: Batch size (int)
-    :param prefetch: Number of batches to prefetch.  (None = no prefetch)
+    :param prefetch: Number of batches to prefetch.  (None = no prefetch; tf.data.AUTOTUNE (-1) = autotuned)
+    :param bucket_boundaries: Sequence lengths that separate length buckets.  None = every batch is padded
+                              to len_max; otherwise, see create_bucketed_dataset()
+    :param shuffle: Training set shuffle buffer size (None = no shuffle).  Reshuffled every epoch
+    :param cache: None = no cache; '' = cache in memory; otherwise, cache file name prefix (one file per set)
+    :param batch_inference: Batch size for the validation and testing sets (None = same as batch)
+    :param seed: Shuffle seed
+    :param balance: The training set is an infinite, class-balanced stream (see create_balanced_dataset()).
+                    Use with model.fit(steps_per_epoch=...).  Not combined with bucketing, shuffling or caching
+    :param class_weights: Target class distribution for balance (None = uniform)
+    :param crop_window: Window length: the training examples are random windows of the sequences (see
+                        create_crop_dataset()).  The validation and testing sets use a fixed window of each
+                        sequence, so that their metrics (e.g., for early stopping) do not change from epoch to
+                        epoch by chance.  Whole-sequence predictions come from window_examples()
 
+    :return: Tuple of datasets (train, valid, test).  test is None if there is no testing set
     '''
 
-    # Translate tensors into datasets
-    dataset_train = tf.data.Dataset.from_tensor_slices((dat['ins_train'], dat['outs_train'])).batch(batch)
-    dataset_valid = tf.data.Dataset.from_tensor_slices((dat['ins_valid'], dat['outs_valid'])).batch(batch)
-    dataset_test = tf.data.Dataset.from_tensor_slices((dat['ins_test'], dat['outs_test'])).batch(batch)
+    if batch_inference is None:
+        batch_inference = batch
 
-    # Prefetch if specified
-    if prefetch is not None:
-        dataset_train = dataset_train.prefetch(prefetch)
-        dataset_valid = dataset_valid.prefetch(prefetch)
-        dataset_test = dataset_test.prefetch(prefetch)
+    if balance:
+        assert not isinstance(dat['ins_train'], list), "Lists of arrays cannot be balanced"
+        assert crop_window is None, "Balanced streams cannot be cropped"
+
+    datasets = []
+    for k in ['train', 'valid', 'test']:
+        if dat['ins_'+k] is None:
+            datasets.append(None)
+            continue
+
+        if k == 'train' and balance:
+            datasets.append(create_balanced_dataset(dat['ins_train'], dat['outs_train'], batch=batch,
+                                                    class_weights=class_weights, prefetch=prefetch, seed=seed))
+            continue
+
+        # In-memory caches are per dataset; cache files need one name per set
+        cache_k = cache if not cache else '%s_%s'%(cache, k)
+
+        datasets.append(create_dataset(dat['ins_'+k], dat['outs_'+k],
+                                       batch=batch if k == 'train' else batch_inference,
+                                       prefetch=prefetch,
+                                       bucket_boundaries=bucket_boundaries,
+                                       shuffle=shuffle if k == 'train' else None,
+                                       cache=cache_k,
+                                       seed=seed,
+                                       crop_window=crop_window,
+                                       fixed_crops=k != 'train'))
+
+    dataset_train, dataset_valid, dataset_test = datasets
 
     return dataset_train, dataset_valid, dataset_test
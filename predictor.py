@@ -0,0 +1,328 @@
+'''
+Batch inference on raw amino-acid strings
+
+A trained run is stored as <fbase>_model (the Keras model) and <fbase>_vocab.json (written
+by execute_exp(), see write_vocabulary()): the input vocabulary, len_max, the label map and,
+for models trained on windows, the window settings.  Together these reproduce the
+tokenization and padding of training, so that new sequences are classified exactly as the
+test set was.
+
+Predictor streams sequences from CSV or FASTA files of any size: each chunk of strings is
+tokenized with the vectorized tokenizer of pfam_loader and padded (or, for window models,
+cut into windows string by string), and its batches are
+scored on a thread pool (TensorFlow releases the GIL while it runs a batch).  Reading and
+tokenizing the next chunk overlaps with the inference of the current one.
+
+Example:
+
+python predictor.py --model results/amino__..._rot_00 --input unannotated.fasta --output scores.csv \
+       --batch 4096 --threads 4 --cpus_per_task 8
+
+From Python:
+
+predictor = Predictor('results/amino__..._rot_00')
+labels, probabilities = predictor.predict_strings(['MKVLAAGIVG...', ...])
+
+'''
+import argparse
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from pfam_loader import TOKENIZER_CONFIG, _read_json, _write_json, aggregate_windows, pad_tokens, \
+    tokenize_strings, window_tokens
+from results_io import VOCAB_SUFFIX
+
+# Input file formats
+FASTA_EXTENSIONS = ['.fa', '.fasta', '.faa', '.fas']
+
+
+def write_vocabulary(fbase, dat, window=None, stride=None, aggregate='logit'):
+    '''
+    Store what is needed to tokenize new strings for a run's model
+
+    :param fbase: File base of the run
+    :param dat: Rotation data structure (word_index, len_max, n_tokens and out_index_word are used)
+    :param window: Window length of the model (None -> whole sequences)
+    :param stride: Distance between consecutive windows (None -> window // 2)
+    :param aggregate: Combination of the windows of a sequence ('logit' or 'prob')
+    :return: Name of the vocabulary file
+    '''
+    assert dat.get('word_index') is not None, "The data set does not carry its input vocabulary"
+    fname = fbase + VOCAB_SUFFIX
+    _write_json(fname, {'word_index': {c: int(i) for c, i in dat['word_index'].items()},
+                        'out_index_word': {str(i): w for i, w in dat['out_index_word'].items()},
+                        'len_max': int(dat['len_max']),
+                        'n_tokens': int(dat['n_tokens']),
+                        'tokenizer': TOKENIZER_CONFIG,
+                        'window': window,
+                        'stride': stride,
+                        'aggregate': aggregate})
+    return fname
+
+
+def read_vocabulary(fbase):
+    '''
+    :param fbase: File base of the run
+    :return: Vocabulary dictionary (see write_vocabulary()), with integer out_index_word keys
+    '''
+    vocab = _read_json(fbase + VOCAB_SUFFIX)
+    assert vocab is not None, "No vocabulary for %s (%s)" % (fbase, fbase + VOCAB_SUFFIX)
+    assert vocab['tokenizer'] == TOKENIZER_CONFIG, "The model was trained with a different tokenizer configuration"
+    vocab['out_index_word'] = {int(i): w for i, w in vocab['out_index_word'].items()}
+    return vocab
+
+
+def _open_text(fname):
+    return gzip.open(fname, 'rt') if fname.endswith('.gz') else open(fname, 'r')
+
+
+def iter_fasta(fname, chunksize=65536):
+    '''
+    Iterate over the records of a FASTA file in chunks
+
+    :param fname: FASTA file (optionally gzipped)
+    :param chunksize: Number of records per chunk
+    :return: Generator of (ids, strings) lists.  The id of a record is the first word of its header
+    '''
+    ids, strings = [], []
+    name, parts = None, []
+    with _open_text(fname) as fp:
+        for line in fp:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    ids.append(name)
+                    strings.append(''.join(parts))
+                    if len(ids) == chunksize:
+                        yield ids, strings
+                        ids, strings = [], []
+                fields = line[1:].split(maxsplit=1)
+                name, parts = fields[0] if len(fields) > 0 else '', []
+            elif line:
+                parts.append(line)
+    if name is not None:
+        ids.append(name)
+        strings.append(''.join(parts))
+    if len(ids) > 0:
+        yield ids, strings
+
+
+def iter_csv(fname, chunksize=65536, column='string', id_column=None):
+    '''
+    Iterate over the rows of a CSV file in chunks
+
+    :param fname: CSV file (optionally compressed)
+    :param chunksize: Number of rows per chunk
+    :param column: Column holding the strings
+    :param id_column: Column holding the ids (None -> the row number)
+    :return: Generator of (ids, strings)
+    '''
+    columns = [column] if id_column is None else [column, id_column]
+    row = 0
+    with pd.read_csv(fname, chunksize=chunksize, usecols=columns, dtype=str, keep_default_na=False) as reader:
+        for df in reader:
+            ids = np.arange(row, row + len(df)) if id_column is None else df[id_column].values
+            row += len(df)
+            yield ids, df[column].values
+
+
+def iter_sequences(fname, fmt=None, chunksize=65536, column='string', id_column=None):
+    '''
+    :param fname: CSV or FASTA file
+    :param fmt: 'csv' or 'fasta' (None -> from the file extension)
+    :param chunksize: Number of sequences per chunk
+    :param column: CSV column holding the strings
+    :param id_column: CSV column holding the ids (None -> the row number)
+    :return: Generator of (ids, strings)
+    '''
+    if fmt is None:
+        ext = os.path.splitext(fname[:-3] if fname.endswith('.gz') else fname)[1].lower()
+        fmt = 'fasta' if ext in FASTA_EXTENSIONS else 'csv'
+    if fmt == 'fasta':
+        return iter_fasta(fname, chunksize=chunksize)
+    assert fmt == 'csv', "Unknown input format %s" % fmt
+    return iter_csv(fname, chunksize=chunksize, column=column, id_column=id_column)
+
+
+class Predictor:
+    def __init__(self, fbase, batch=4096, threads=1):
+        '''
+        @param fbase File base of a run (<fbase>_model and <fbase>_vocab.json)
+        @param batch Inference batch size (sequences, or windows for window models)
+        @param threads Number of batches that are scored concurrently
+        '''
+        import tensorflow as tf
+
+        self.vocab = read_vocabulary(fbase)
+        self.model = tf.keras.models.load_model('%s_model' % fbase, compile=False)
+        self.batch = batch
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+        self.window = self.vocab['window']
+        self.stride = self.vocab['stride'] if self.vocab['stride'] is not None else \
+            None if self.window is None else max(1, self.window // 2)
+        self.labels = np.array([self.vocab['out_index_word'][c + 1] for c in range(len(self.vocab['out_index_word']))])
+
+        model = self.model
+        # One traced function for all batches (a batch of a new shape traces it again)
+        self._infer = tf.function(lambda x: model(x, training=False), reduce_retracing=True)
+
+    def close(self):
+        self.pool.shutdown()
+
+    def _predict_batch(self, ins):
+        return np.asarray(self._infer(ins), dtype=np.float32)
+
+    def predict_tokens(self, ins):
+        '''
+        :param ins: Left-padded tokenized inputs (examples x len) of the length that the model takes
+        :return: Class probabilities (examples x classes)
+        '''
+        batches = [ins[i:i + self.batch] for i in range(0, len(ins), self.batch)]
+        if len(batches) == 0:
+            return np.zeros((0, len(self.labels)), dtype=np.float32)
+        return np.concatenate(list(self.pool.map(self._predict_batch, batches)))
+
+    def prepare(self, tokens, offsets, padded=None):
+        '''
+        Model inputs for a chunk of tokenized strings, padded or windowed as in training
+
+        :param tokens: Concatenated tokens (see pfam_loader.tokenize_strings())
+        :param offsets: String i occupies tokens[offsets[i]:offsets[i+1]]
+        :param padded: The same strings, already left-padded to at least len_max (e.g., shared by
+                       several models; None -> pad them here).  Only used by whole-sequence models
+        :return: Whole-sequence models: left-padded tokens (examples x len_max; longer strings are
+                 truncated, as in training).  Window models: tuple (windows, owner, examples), with
+                 the windows cut from each string's own tokens (see pfam_loader.window_tokens())
+        '''
+        if self.window is None:
+            if padded is None:
+                return pad_tokens(tokens, offsets, self.vocab['len_max'])
+            # The last len_max columns: the same left-truncation as pad_tokens()
+            return padded[:, padded.shape[1] - self.vocab['len_max']:]
+        windows, owner = window_tokens(tokens, offsets, self.window, self.stride)
+        return windows, owner, len(offsets) - 1
+
+    def tokenize(self, strings):
+        '''
+        Tokenize a chunk of strings and prepare the model inputs (see prepare())
+
+        :param strings: Sequence of strings
+        :return: Model inputs for predict_tokenized()
+        '''
+        return self.prepare(*tokenize_strings(strings, self.vocab['word_index']))
+
+    def predict_tokenized(self, ins):
+        '''
+        :param ins: From tokenize() or prepare()
+        :return: Class probabilities (examples x classes)
+        '''
+        if self.window is None:
+            return self.predict_tokens(ins)
+        windows, owner, n = ins
+        return aggregate_windows(self.predict_tokens(windows), owner, n, method=self.vocab['aggregate'])
+
+    def predict_strings(self, strings):
+        '''
+        :param strings: Sequence of amino-acid strings
+        :return: Tuple (labels (examples,), probabilities (examples x classes)).  Column c of the
+                 probabilities is the class self.labels[c]
+        '''
+        pred = self.predict_tokenized(self.tokenize(strings))
+        return self.labels[np.argmax(pred, axis=1)], pred
+
+    def predict_file(self, fname, out, **kwargs):
+        '''
+        Classify all of the sequences of a file (see predict_file())
+        '''
+        return predict_file(self, fname, out, **kwargs)
+
+
+def predict_file(scorer, fname, out, fmt=None, chunksize=65536, column='string', id_column=None,
+                 probabilities=False):
+    '''
+    Classify all of the sequences of a file, one chunk at a time.  The next chunk is read and
+    tokenized while the current one is scored
+
+    :param scorer: Predictor (or anything with tokenize(), predict_tokenized() and labels, e.g., an Ensemble)
+    :param fname: CSV or FASTA input file (see iter_sequences())
+    :param out: Output CSV file: id, label and probability of each sequence
+    :param fmt: Input format ('csv' or 'fasta'; None -> from the file extension)
+    :param chunksize: Number of sequences per chunk
+    :param column: CSV column holding the strings
+    :param id_column: CSV column holding the ids (None -> the row number)
+    :param probabilities: Also write the probability of every class (one column per class)
+    :return: Number of sequences
+    '''
+    chunks = iter_sequences(fname, fmt=fmt, chunksize=chunksize, column=column, id_column=id_column)
+
+    def next_chunk():
+        # Read and tokenize the next chunk (None at the end of the file)
+        chunk = next(chunks, None)
+        return None if chunk is None else (chunk[0], scorer.tokenize(chunk[1]))
+
+    n = 0
+    tmp = '%s.%d.tmp' % (out, os.getpid())
+    with ThreadPoolExecutor(max_workers=1) as reader, open(tmp, 'w') as fp:
+        pending = reader.submit(next_chunk)
+        while True:
+            chunk = pending.result()
+            if chunk is None:
+                break
+            pending = reader.submit(next_chunk)
+
+            ids, ins = chunk
+            pred = scorer.predict_tokenized(ins)
+            best = np.argmax(pred, axis=1)
+            df = pd.DataFrame({'id': ids,
+                               'label': scorer.labels[best],
+                               'probability': pred[np.arange(len(best)), best]})
+            if probabilities:
+                df = pd.concat([df, pd.DataFrame(pred, columns=scorer.labels)], axis=1)
+            df.to_csv(fp, header=n == 0, index=False, float_format='%.5g')
+            n += len(ids)
+    # The output appears once it is complete
+    os.replace(tmp, out)
+    return n
+
+
+def create_parser():
+    '''
+    Create argument parser
+    '''
+    parser = argparse.ArgumentParser(description='Classify raw amino-acid strings with a trained model',
+                                     fromfile_prefix_chars='@')
+    parser.add_argument('--model', type=str, required=True,
+                        help='File base of the run (<model>_model and <model>%s)' % VOCAB_SUFFIX)
+    parser.add_argument('--input', type=str, required=True, help='CSV or FASTA file (optionally gzipped)')
+    parser.add_argument('--output', type=str, required=True, help='Output CSV file')
+    parser.add_argument('--format', type=str, default=None, choices=['csv', 'fasta'],
+                        help='Input format (default: from the file extension)')
+    parser.add_argument('--column', type=str, default='string', help='CSV column holding the strings')
+    parser.add_argument('--id_column', type=str, default=None, help='CSV column holding the ids (default: row number)')
+    parser.add_argument('--batch', type=int, default=4096, help='Inference batch size')
+    parser.add_argument('--threads', type=int, default=1, help='Number of batches scored concurrently')
+    parser.add_argument('--chunksize', type=int, default=65536, help='Sequences read and tokenized at once')
+    parser.add_argument('--cpus_per_task', type=int, default=None, help='Number of TensorFlow threads')
+    parser.add_argument('--probabilities', action='store_true', help='Write the probability of every class')
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+
+    import tensorflow as tf
+    if args.cpus_per_task is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(args.cpus_per_task)
+        tf.config.threading.set_inter_op_parallelism_threads(args.cpus_per_task)
+
+    predictor = Predictor(args.model, batch=args.batch, threads=args.threads)
+    n = predictor.predict_file(args.input, args.output, fmt=args.format, chunksize=args.chunksize,
+                               column=args.column, id_column=args.id_column, probabilities=args.probabilities)
+    predictor.close()
+    print('%d sequences -> %s' % (n, args.output))
@@ -0,0 +1,380 @@
+'''
+Results storage
+
+A run is stored as two files next to each other:
+
+<fbase>_results.json: the arguments, the evaluations (loss/accuracy, per-class precision/recall
+                      and confusion matrices), the training history and the other small
+                      entries.  This is all that is needed to plot learning curves or to
+                      aggregate the performance of many runs.
+<fbase>_predictions.npz: (optional) the prediction matrices, compressed.  Either stored
+                      as float16 or only as the top-k classes (indices + probabilities)
+                      of each example.
+
+The json file is written last: its existence marks a complete run.  Runs stored in the
+original format (<fbase>_results.pkl: one pickle containing everything) can still be read
+and can be converted with convert_results_pickle().
+
+Examples:
+
+# Learning curves and evaluations of all rotations (predictions are not loaded)
+results = read_all_results('results', 'amino__*_ntrain_03_rot_*')
+
+# One row per run
+df = summarize_results(results)
+
+# Predictions of one run
+pred = read_predictions(results[0]['fname_base'], keys=['predict_testing'])
+
+Convert existing pickles:
+
+python results_io.py --convert results/*_results.pkl --predictions float16
+
+'''
+import argparse
+import fnmatch
+import json
+import os
+import pickle
+
+# Suffixes of the results files (preferred format first)
+RESULTS_SUFFIXES = ['_results.json', '_results.pkl']
+PREDICTIONS_SUFFIX = '_predictions.npz'
+
+# Input vocabulary, len_max and label map of a run's saved model (see predictor)
+VOCAB_SUFFIX = '_vocab.json'
+
+# Exported TFLite models (%s: quantization) and their benchmark report (see tflite_export)
+TFLITE_SUFFIX = '_model_%s.tflite'
+TFLITE_REPORT_SUFFIX = '_tflite.json'
+
+# Progress of a run that stopped at an epoch budget (see asha)
+BUDGET_SUFFIX = '_budget.json'
+
+# Directory of the training checkpoints of a run that has not finished (see checkpointing)
+CHECKPOINTS_SUFFIX = '_checkpoints'
+
+# Keys of the prediction matrices in a results dictionary
+PREDICTION_KEYS = ['predict_training', 'predict_validation', 'predict_testing']
+
+# Ways of storing the predictions
+PREDICTION_FORMATS = ['none', 'float16', 'float32', 'topk']
+
+
+def _json_default(obj):
+    '''
+    Convert objects that json does not know about
+
+    :param obj: Object to convert
+    :return: json-compatible version of obj
+    '''
+    if hasattr(obj, 'tolist'):
+        # numpy arrays and scalars
+        return obj.tolist()
+    if isinstance(obj, (range, tuple, set)):
+        return list(obj)
+    return str(obj)
+
+
+def _replace(fname, write):
+    '''
+    Write a file atomically (readers never see a partial file)
+
+    :param fname: File name
+    :param write: Function(tmp_name) that writes the file
+    '''
+    tmp = '%s.%d.tmp%s' % (fname, os.getpid(), os.path.splitext(fname)[1])
+    write(tmp)
+    os.replace(tmp, fname)
+
+
+def split_fname(fname):
+    '''
+    Strip the results suffix from a file name
+
+    :param fname: Results file name or file base
+    :return: File base
+    '''
+    for s in RESULTS_SUFFIXES + [PREDICTIONS_SUFFIX]:
+        if fname.endswith(s):
+            return fname[:-len(s)]
+    return fname
+
+
+def results_exist(fbase):
+    '''
+    :param fbase: File base of a run
+    :return: The name of the results file of the run (either format), or None if there is none
+    '''
+    for s in RESULTS_SUFFIXES:
+        if os.path.exists(fbase + s):
+            return fbase + s
+    return None
+
+
+def compress_predictions(pred, predictions='float16', top_k=5):
+    '''
+    Compress a prediction matrix
+
+    :param pred: Predictions (examples x classes)
+    :param predictions: Format: 'float16', 'float32' or 'topk'
+    :param top_k: Number of classes to keep per example ('topk' only)
+    :return: Dictionary of arrays ('' -> the matrix; '_topk_index'/'_topk_value' for 'topk')
+    '''
+    import numpy as np
+
+    pred = np.asarray(pred)
+    if predictions == 'float16':
+        return {'': pred.astype(np.float16)}
+    if predictions == 'float32':
+        return {'': pred.astype(np.float32)}
+
+    assert predictions == 'topk', "Unknown predictions format %s" % predictions
+    k = min(top_k, pred.shape[1])
+    # Top k classes of each example, most likely first
+    index = np.argpartition(-pred, k - 1, axis=1)[:, :k]
+    value = np.take_along_axis(pred, index, axis=1)
+    order = np.argsort(-value, axis=1, kind='stable')
+    index = np.take_along_axis(index, order, axis=1)
+    value = np.take_along_axis(value, order, axis=1)
+
+    return {'_topk_index': index.astype(np.min_scalar_type(max(pred.shape[1] - 1, 0))),
+            '_topk_value': value.astype(np.float16)}
+
+
+def write_results(fbase, results, predictions='float16', top_k=5):
+    '''
+    Write the results of a run
+
+    :param fbase: File base of the run
+    :param results: Results dictionary (the prediction matrices are stored separately)
+    :param predictions: Format of the prediction matrices (see PREDICTION_FORMATS)
+    :param top_k: Number of classes to keep per example ('topk' only)
+    :return: Name of the results file
+    '''
+    assert predictions in PREDICTION_FORMATS, "Unknown predictions format %s" % predictions
+
+    scalars = {k: v for k, v in results.items() if k not in PREDICTION_KEYS}
+    if isinstance(scalars.get('args'), argparse.Namespace):
+        scalars['args'] = vars(scalars['args'])
+    scalars['predictions'] = predictions
+    scalars['fname_base'] = fbase
+
+    # Predictions first: the json file marks a complete run
+    arrays = {}
+    if predictions != 'none':
+        import numpy as np
+
+        for k in PREDICTION_KEYS:
+            if results.get(k) is not None:
+                for suffix, a in compress_predictions(results[k], predictions, top_k).items():
+                    arrays[k + suffix] = a
+        if len(arrays) > 0:
+            _replace(fbase + PREDICTIONS_SUFFIX, lambda tmp: np.savez_compressed(tmp, **arrays))
+    scalars['prediction_keys'] = sorted(arrays)
+
+    def write(tmp):
+        with open(tmp, 'w') as fp:
+            json.dump(scalars, fp, default=_json_default)
+
+    fname = fbase + RESULTS_SUFFIXES[0]
+    _replace(fname, write)
+    return fname
+
+
+def read_results(fname, fields=None, predictions=False, namespace=True):
+    '''
+    Read the results of a run (either format)
+
+    :param fname: Results file name or file base of the run
+    :param fields: List of entries to return (None -> all).  'fname_base' is always included
+    :param predictions: Also load the prediction matrices (they are not loaded otherwise)
+    :param namespace: Return the arguments as an argparse.Namespace (as in the original format)
+    :return: Results dictionary
+    '''
+    fbase = split_fname(fname)
+    fname = results_exist(fbase)
+    assert fname is not None, "No results for %s" % fbase
+
+    if fname.endswith('.json'):
+        with open(fname, 'r') as fp:
+            results = json.load(fp)
+        if predictions:
+            results.update(read_predictions(fbase))
+    else:
+        with open(fname, 'rb') as fp:
+            results = pickle.load(fp)
+        if not predictions:
+            for k in PREDICTION_KEYS:
+                results.pop(k, None)
+        if isinstance(results.get('args'), argparse.Namespace) and not namespace:
+            results['args'] = vars(results['args'])
+
+    if namespace and isinstance(results.get('args'), dict):
+        results['args'] = argparse.Namespace(**results['args'])
+    results['fname_base'] = fbase
+
+    if fields is not None:
+        results = {k: v for k, v in results.items() if k in fields or k == 'fname_base'}
+    return results
+
+
+def write_budget(fbase, report):
+    '''
+    Record the progress of a run that stopped at an epoch budget (its results are not written
+    until it has trained all of its epochs)
+
+    :param fbase: File base of the run
+    :param report: Dictionary: epochs, epoch_budget, history, ...
+    :return: Name of the file
+    '''
+    def write(tmp):
+        with open(tmp, 'w') as fp:
+            json.dump(report, fp, default=_json_default)
+
+    fname = fbase + BUDGET_SUFFIX
+    _replace(fname, write)
+    return fname
+
+
+def read_budget(fbase):
+    '''
+    :param fbase: File base of the run
+    :return: From write_budget(), or None if the run never stopped at a budget
+    '''
+    try:
+        with open(fbase + BUDGET_SUFFIX, 'r') as fp:
+            return json.load(fp)
+    except OSError:
+        return None
+
+
+def read_predictions(fbase, keys=None):
+    '''
+    Read the prediction matrices of a run.  Only the requested arrays are decompressed
+
+    :param fbase: File base of the run
+    :param keys: Prediction entries to load (None -> all stored entries)
+    :return: Dictionary of arrays (empty if the predictions were not stored).  Top-k predictions
+             are returned as <key>_topk_index/<key>_topk_value
+    '''
+    import numpy as np
+
+    fbase = split_fname(fbase)
+    fname = fbase + PREDICTIONS_SUFFIX
+    if os.path.exists(fname):
+        with np.load(fname) as npz:
+            return {k: npz[k] for k in npz.files if keys is None or k in keys or k.rsplit('_topk', 1)[0] in keys}
+
+    # Original format
+    fname = fbase + RESULTS_SUFFIXES[1]
+    if os.path.exists(fname):
+        with open(fname, 'rb') as fp:
+            results = pickle.load(fp)
+        return {k: results[k] for k in PREDICTION_KEYS if k in results and (keys is None or k in keys)}
+    return {}
+
+
+def list_results(dirname, filebase='*'):
+    '''
+    Find the runs in a directory
+
+    :param dirname: Results directory
+    :param filebase: File name pattern of the runs (matched against the file base, without the
+                     results suffix; a pattern ending with a results suffix is also accepted)
+    :return: Sorted list of file bases (one per run, whatever the format)
+    '''
+    pattern = split_fname(filebase.replace('_results.*', ''))
+    fbases = set()
+    for f in os.listdir(dirname):
+        for s in RESULTS_SUFFIXES:
+            if f.endswith(s) and fnmatch.fnmatch(f[:-len(s)], pattern):
+                fbases.add(f[:-len(s)])
+    return ['%s/%s' % (dirname, f) for f in sorted(fbases)]
+
+
+def read_all_results(dirname, filebase='*', fields=None, predictions=False):
+    '''
+    Read the results of all of the matching runs in a directory
+
+    :param dirname: Results directory
+    :param filebase: File name pattern of the runs (see list_results())
+    :param fields: List of entries to return (None -> all)
+    :param predictions: Also load the prediction matrices
+    :return: List of results dictionaries
+    '''
+    return [read_results(f, fields=fields, predictions=predictions) for f in list_results(dirname, filebase)]
+
+
+def summarize_results(results, metrics=('loss', 'sparse_categorical_accuracy')):
+    '''
+    One row per run: the scalar arguments, the evaluations, the number of training epochs and the
+    run totals of the telemetry (time, throughput, memory)
+
+    :param results: List of results dictionaries (from read_all_results())
+    :param metrics: Names of the evaluation entries (in the order returned by model.evaluate())
+    :return: pandas DataFrame
+    '''
+    import pandas as pd
+
+    rows = []
+    for r in results:
+        args = r.get('args', {})
+        args = vars(args) if isinstance(args, argparse.Namespace) else args
+        row = {k: v for k, v in args.items() if v is None or isinstance(v, (bool, int, float, str))}
+        for split in ['training', 'validation', 'testing']:
+            ev = r.get('predict_%s_eval' % split)
+            if ev is not None:
+                for m, v in zip(metrics, ev):
+                    row['%s_%s' % (split, m)] = v
+        if 'history' in r:
+            row['epochs_trained'] = len(next(iter(r['history'].values()), []))
+        for k, v in r.get('telemetry', {}).items():
+            if v is None or isinstance(v, (int, float)):
+                row[k] = v
+        row['fname_base'] = r['fname_base']
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+def convert_results_pickle(fname, predictions='float16', top_k=5, remove=False):
+    '''
+    Convert a run stored in the original format (one pickle)
+
+    :param fname: Pickle file name (or file base)
+    :param predictions: Format of the prediction matrices (see PREDICTION_FORMATS)
+    :param top_k: Number of classes to keep per example ('topk' only)
+    :param remove: Remove the pickle once it has been converted
+    :return: Name of the results file
+    '''
+    fbase = split_fname(fname)
+    fname = fbase + RESULTS_SUFFIXES[1]
+    with open(fname, 'rb') as fp:
+        results = pickle.load(fp)
+
+    fname_out = write_results(fbase, results, predictions=predictions, top_k=top_k)
+    if remove:
+        os.remove(fname)
+    return fname_out
+
+
+def create_parser():
+    '''
+    Create argument parser
+    '''
+    parser = argparse.ArgumentParser(description='Results storage', fromfile_prefix_chars='@')
+    parser.add_argument('--convert', nargs='+', type=str, default=[], help='Results pickles to convert')
+    parser.add_argument('--predictions', type=str, default='float16', choices=PREDICTION_FORMATS,
+                        help='Storage of the prediction matrices')
+    parser.add_argument('--top_k', type=int, default=5, help='Classes to keep per example (topk)')
+    parser.add_argument('--remove', action='store_true', help='Remove the pickles once converted')
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+
+    for f in args.convert:
+        print(convert_results_pickle(f, predictions=args.predictions, top_k=args.top_k, remove=args.remove))
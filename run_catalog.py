@@ -0,0 +1,398 @@
+'''
+Run catalog
+
+An embedded (SQLite) index of the runs of a results directory.  execute_exp() registers a
+run when it starts and records its metrics when it finishes, so completeness checks and
+result queries never have to list or open the results files.
+
+Each run is keyed by a canonical hash of its hyperparameters: all of the arguments except
+the ones that only control how/where a run is executed (RUN_CONTROL_KEYS) or that are unset
+(None, or False for on/off switches, so that adding a switch does not change existing keys).
+Runs that differ only in their rotation share a group key, which is used to aggregate across
+rotations.
+
+Tables:
+runs:    one row per run (key, group key, file base, exp_index, rotation, status, timings,
+         host/pid and the hyperparameters as json)
+metrics: one row per (run, metric name) with a float value (e.g., validation_accuracy)
+
+Examples:
+
+catalog = RunCatalog('results/run_catalog.sqlite')
+
+# Finished runs with a given configuration
+runs = catalog.query(status='finished', rnnNeurons=30, dropout=0.2)
+
+# Mean/std/min/max of every metric across the rotations of each configuration
+rows = catalog.aggregate(rnnNeurons=30)
+
+# Index the runs that were written before the catalog existed
+python run_catalog.py --index results
+
+Note: SQLite serializes writers with file locks.  These are reliable on local disks, but not
+on NFS and similar network file systems, where concurrent writers (e.g., the tasks of a SLURM
+array) can corrupt the database.  The catalog must therefore be on a local disk: with a results
+directory on NFS, run the array with --no_catalog (or with --catalog on a node-local path) and
+index the results afterwards (python run_catalog.py --index results).  Completeness checks do
+not depend on the catalog being complete: runs that are not in it are found from their
+results files.
+
+'''
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import time
+
+# Default catalog file (in the results directory)
+CATALOG_NAME = 'run_catalog.sqlite'
+
+# Arguments that do not define a run
+RUN_CONTROL_KEYS = {'check', 'nogo', 'verbose', 'cpus_per_task', 'gpu', 'exp_index', 'dataset', 'cache_dir',
+                    'results_path', 'results_format', 'save_predictions', 'top_k', 'catalog', 'no_catalog',
+                    'batch_inference', 'eval_splits', 'profile_steps', 'profile_dir', 'checkpoint_every',
+                    'checkpoint_keep', 'no_resume', 'keep_checkpoints', 'tflite', 'tflite_calibration',
+                    'epoch_budget', 'step_timing', 'tf_data', 'prefetch'}
+
+# Arguments that vary within a group of runs (see group_key())
+GROUP_KEYS = {'rotation'}
+
+# Run states ('paused': stopped at an epoch budget, continues from its checkpoints; see asha)
+STATUSES = ['running', 'finished', 'failed', 'paused']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    key TEXT PRIMARY KEY,
+    group_key TEXT NOT NULL,
+    fbase TEXT,
+    exp_index INTEGER,
+    rotation INTEGER,
+    status TEXT NOT NULL,
+    started REAL,
+    finished REAL,
+    host TEXT,
+    pid INTEGER,
+    params TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_group ON runs (group_key);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+CREATE TABLE IF NOT EXISTS metrics (
+    key TEXT NOT NULL REFERENCES runs (key) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (key, name)
+);
+'''
+
+
+def _canonical(v):
+    '''
+    Normalize a hyperparameter value so that equal settings always hash the same way
+
+    :param v: Value
+    :return: json-compatible value
+    '''
+    if hasattr(v, 'tolist'):
+        # numpy arrays and scalars
+        v = v.tolist()
+    if isinstance(v, (range, tuple, list)):
+        return [_canonical(x) for x in v]
+    if isinstance(v, float) and v.is_integer():
+        # 1.0 and 1 are the same setting
+        return int(v)
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    return str(v)
+
+
+def run_params(args):
+    '''
+    The hyperparameters of a run
+
+    :param args: argparse.Namespace or dictionary of arguments
+    :return: Dictionary of the (canonical) hyperparameter values
+    '''
+    args = args if isinstance(args, dict) else vars(args)
+    return {k: _canonical(v) for k, v in sorted(args.items())
+            if k not in RUN_CONTROL_KEYS and v is not None and v is not False}
+
+
+def _hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def run_key(args):
+    '''
+    :param args: argparse.Namespace or dictionary of arguments
+    :return: Canonical hash of the hyperparameters of a run
+    '''
+    return _hash(run_params(args))
+
+
+def group_key(args):
+    '''
+    :param args: argparse.Namespace or dictionary of arguments
+    :return: Hash of the hyperparameters without the GROUP_KEYS (i.e., shared by all rotations)
+    '''
+    return _hash({k: v for k, v in run_params(args).items() if k not in GROUP_KEYS})
+
+
+def results_metrics(results, metrics=('loss', 'accuracy')):
+    '''
+    Extract the scalar metrics of a run from its results dictionary
+
+    :param results: Results dictionary (see execute_exp())
+    :param metrics: Names of the entries of the evaluations (in the order returned by model.evaluate())
+    :return: Dictionary name -> float
+    '''
+    out = {}
+    for split in ['training', 'validation', 'testing']:
+        ev = results.get('predict_%s_eval' % split)
+        if ev is None:
+            continue
+        ev = ev if isinstance(ev, (list, tuple)) else [ev]
+        for m, v in zip(metrics, ev):
+            out['%s_%s' % (split, m)] = float(v)
+
+        # Per-class metrics (see evaluation.store_evaluations()): macro averages over the classes
+        for m, vals in results.get('predict_%s_metrics' % split, {}).items():
+            if m in ['precision', 'recall']:
+                vals = [v for v in vals if v is not None and v == v]
+                if len(vals) > 0:
+                    out['%s_macro_%s' % (split, m)] = float(sum(vals) / len(vals))
+
+    history = results.get('history')
+    if history:
+        out['epochs_trained'] = float(len(next(iter(history.values()), [])))
+        if 'val_sparse_categorical_accuracy' in history and len(history['val_sparse_categorical_accuracy']) > 0:
+            out['best_validation_accuracy'] = float(max(history['val_sparse_categorical_accuracy']))
+
+    # Cost of the run (see telemetry.TelemetryCallback)
+    telemetry = results.get('telemetry')
+    if telemetry:
+        for m in ['wall_time', 'train_time', 'eval_time', 'samples_per_sec', 'input_wait_fraction', 'peak_rss']:
+            if telemetry.get(m) is not None:
+                out[m] = float(telemetry[m])
+    return out
+
+
+class RunCatalog():
+    def __init__(self, fname, timeout=60.0):
+        '''
+        Open (and create, if needed) a catalog
+
+        @param fname Catalog file name
+        @param timeout Seconds to wait for a lock held by another process
+        '''
+        self.fname = fname
+        dirname = os.path.dirname(fname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(fname, timeout=timeout)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        with self.conn:
+            self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self, args, fbase=None):
+        '''
+        Register a run that is starting (replaces any earlier entry for the same hyperparameters)
+
+        @param args argparse.Namespace or dictionary of arguments
+        @param fbase File base of the run
+        @return Key of the run
+        '''
+        a = args if isinstance(args, dict) else vars(args)
+        key = run_key(a)
+        with self.conn:
+            self.conn.execute('DELETE FROM runs WHERE key = ?', (key,))
+            self.conn.execute('INSERT INTO runs (key, group_key, fbase, exp_index, rotation, status, started, '
+                              'host, pid, params) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (key, group_key(a), fbase, a.get('exp_index'), a.get('rotation'), 'running',
+                               time.time(), socket.gethostname(), os.getpid(), json.dumps(run_params(a))))
+        return key
+
+    def finish(self, key, metrics=None, status='finished', finished=None):
+        '''
+        Record the end of a run
+
+        @param key Key of the run (from start())
+        @param metrics Dictionary name -> float
+        @param status Final status ('finished', 'failed' or 'paused')
+        @param finished Time stamp of the end of the run (None -> now)
+        '''
+        assert status in STATUSES, "Unknown status %s" % status
+        with self.conn:
+            self.conn.execute('UPDATE runs SET status = ?, finished = ? WHERE key = ?',
+                              (status, time.time() if finished is None else finished, key))
+            if metrics:
+                self.conn.executemany('INSERT OR REPLACE INTO metrics (key, name, value) VALUES (?, ?, ?)',
+                                      [(key, k, float(v)) for k, v in metrics.items()])
+
+    def record(self, args, fbase=None, metrics=None, started=None, finished=None):
+        '''
+        Register a run that has already finished (e.g., when indexing existing results)
+
+        @return Key of the run
+        '''
+        key = self.start(args, fbase)
+        if started is not None:
+            with self.conn:
+                self.conn.execute('UPDATE runs SET started = ? WHERE key = ?', (started, key))
+        self.finish(key, metrics, finished=finished)
+        return key
+
+    def status(self, keys=None):
+        '''
+        @param keys Iterable of run keys (None -> all runs)
+        @return Dictionary key -> status (runs that are not in the catalog are absent)
+        '''
+        rows = self.conn.execute('SELECT key, status FROM runs').fetchall()
+        out = {r['key']: r['status'] for r in rows}
+        if keys is not None:
+            out = {k: out[k] for k in keys if k in out}
+        return out
+
+    def missing(self, keys):
+        '''
+        @param keys Dictionary index -> run key (e.g., one entry per JobIterator index)
+        @return Sorted list of the indices whose run has not finished
+        '''
+        finished = {r['key'] for r in self.conn.execute("SELECT key FROM runs WHERE status = 'finished'")}
+        return sorted(i for i, k in keys.items() if k not in finished)
+
+    def _metrics(self, keys):
+        out = {k: {} for k in keys}
+        for r in self.conn.execute('SELECT key, name, value FROM metrics'):
+            if r['key'] in out:
+                out[r['key']][r['name']] = r['value']
+        return out
+
+    def query(self, status=None, **params):
+        '''
+        Find runs by their hyperparameters
+
+        @param status Only runs with this status (None -> any status)
+        @param params Hyperparameter values to match (e.g., rnnNeurons=30, hidden=[15, 10, 5])
+        @return List of dictionaries (one per run: the columns of the runs table, with 'params'
+                decoded and a 'metrics' dictionary), ordered by group and rotation
+        '''
+        sql = 'SELECT * FROM runs'
+        if status is not None:
+            sql += ' WHERE status = ?'
+        rows = self.conn.execute(sql + ' ORDER BY group_key, rotation, exp_index',
+                                 () if status is None else (status,)).fetchall()
+
+        want = run_params(params)
+        runs = []
+        for r in rows:
+            run = dict(r)
+            run['params'] = json.loads(run['params'])
+            if all(run['params'].get(k) == v for k, v in want.items()):
+                runs.append(run)
+
+        metrics = self._metrics([r['key'] for r in runs])
+        for run in runs:
+            run['metrics'] = metrics[run['key']]
+        return runs
+
+    def aggregate(self, **params):
+        '''
+        Aggregate the metrics of the finished runs across rotations
+
+        @param params Hyperparameter values to match (see query())
+        @return List of dictionaries, one per group: the shared hyperparameters, the rotations,
+                the number of runs and <metric>_mean/_std/_min/_max for each metric
+        '''
+        groups = {}
+        for run in self.query(status='finished', **params):
+            g = groups.setdefault(run['group_key'], {'group_key': run['group_key'], 'runs': []})
+            g['runs'].append(run)
+
+        out = []
+        for g in groups.values():
+            runs = g.pop('runs')
+            row = {k: v for k, v in runs[0]['params'].items() if k not in GROUP_KEYS}
+            row['group_key'] = g['group_key']
+            row['rotations'] = sorted(r['rotation'] for r in runs if r['rotation'] is not None)
+            row['nruns'] = len(runs)
+            names = sorted({m for r in runs for m in r['metrics']})
+            for m in names:
+                vals = [r['metrics'][m] for r in runs if r['metrics'].get(m) is not None]
+                if len(vals) == 0:
+                    continue
+                mean = sum(vals) / len(vals)
+                row['%s_mean' % m] = mean
+                row['%s_std' % m] = (sum((v - mean) ** 2 for v in vals) / len(vals)) ** 0.5
+                row['%s_min' % m] = min(vals)
+                row['%s_max' % m] = max(vals)
+            out.append(row)
+        return out
+
+
+def default_catalog(results_path):
+    '''
+    :param results_path: Results directory
+    :return: Name of the default catalog of the directory
+    '''
+    return os.path.join(results_path, CATALOG_NAME)
+
+
+def index_results(catalog, dirname, filebase='*'):
+    '''
+    Add the runs of a results directory (either format) to a catalog.  This reads every
+    results file once; afterwards, the catalog is kept up to date by execute_exp()
+
+    :param catalog: RunCatalog
+    :param dirname: Results directory
+    :param filebase: File name pattern of the runs (see results_io.list_results())
+    :return: Number of runs indexed
+    '''
+    from results_io import list_results, read_results, results_exist
+
+    n = 0
+    for fbase in list_results(dirname, filebase):
+        results = read_results(fbase, namespace=False)
+        if not isinstance(results.get('args'), dict):
+            continue
+        mtime = os.path.getmtime(results_exist(fbase))
+        catalog.record(results['args'], fbase=fbase, metrics=results_metrics(results), finished=mtime)
+        n += 1
+    return n
+
+
+def create_parser():
+    '''
+    Create argument parser
+    '''
+    parser = argparse.ArgumentParser(description='Run catalog', fromfile_prefix_chars='@')
+    parser.add_argument('--catalog', type=str, default=None,
+                        help='Catalog file (default: %s in the results directory)' % CATALOG_NAME)
+    parser.add_argument('--index', type=str, default=None, help='Results directory to index')
+    parser.add_argument('--filebase', type=str, default='*', help='File name pattern of the runs to index')
+    parser.add_argument('--aggregate', action='store_true', help='Print the metrics aggregated across rotations')
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    fname = args.catalog if args.catalog is not None else default_catalog(args.index or '.')
+
+    with RunCatalog(fname) as catalog:
+        if args.index is not None:
+            print('Indexed %d runs into %s' % (index_results(catalog, args.index, args.filebase), fname))
+        if args.aggregate:
+            for row in catalog.aggregate():
+                print(json.dumps(row, sort_keys=True))
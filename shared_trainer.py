@@ -0,0 +1,272 @@
+'''
+Shared-memory multi-rotation trainer
+
+Loads the tokenized folds once into shared memory and then trains several
+JobIterator indices (e.g., all rotations) in worker processes that attach to
+these buffers without copying them.  The available cores are split evenly
+between the workers (and each worker is pinned to its own cores).
+
+Each fold is stored once, left-padded to the longest string of all folds.  A
+rotation with training length len_max uses the last len_max columns of each fold
+(a view), which is exactly the left-padded/left-truncated data that
+prepare_data_set() produces.  Batches are read from the views through
+create_view_dataset(), so a worker only ever copies one batch at a time.
+
+Example (a full 5-rotation sweep on one node):
+
+python shared_trainer.py @parameters.txt --label GRU --exp_indices 0 1 2 3 4 --nworkers 5
+
+All arguments other than the ones below are passed on to hw6_base.py.
+
+'''
+import argparse
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from pfam_loader import build_vocabulary, load_fold, pad_tokens, rotation_folds
+
+
+def create_shared_folds(basedir = '/home/fagg/datasets/pfam', nfolds = 5, cachedir = None, chunksize = None):
+    '''
+    Place all of the (padded) folds into shared memory
+
+    :param basedir: Directory containing input files
+    :param nfolds: Total number of folds
+    :param cachedir: Directory for the cache files (None -> use the basedir)
+    :param chunksize: Number of CSV rows to read at once when building caches (None -> whole folds)
+
+    :return: Tuple (spec, blocks)
+             spec: picklable description of the shared folds (what workers need to attach)
+             blocks: SharedMemory objects (the caller must close() and unlink() these when done)
+    '''
+    vocab = build_vocabulary(basedir=basedir, nfolds=nfolds, cachedir=cachedir, chunksize=chunksize)
+    folds = [load_fold(basedir, f, vocab=vocab, cachedir=cachedir, chunksize=chunksize) for f in range(nfolds)]
+
+    # Longest string over all folds: every rotation's len_max fits within this width
+    lengths = [int(np.max(np.diff(fold['offsets']))) for fold in folds]
+    width = max(lengths)
+
+    spec = {'width': width,
+            'n_tokens': len(vocab['word_index']) + 2,
+            'word_index': dict(vocab['word_index']),
+            'out_word_index': dict(vocab['out_word_index']),
+            'folds': []}
+    blocks = []
+    for fold, len_max in zip(folds, lengths):
+        n = len(fold['labels'])
+
+        # Newly created shared memory is zero filled (i.e., already padded)
+        ins_shm = shared_memory.SharedMemory(create=True, size=max(1, n * width * fold['tokens'].itemsize))
+        ins = np.ndarray((n, width), dtype=fold['tokens'].dtype, buffer=ins_shm.buf)
+        pad_tokens(fold['tokens'], fold['offsets'], width, out=ins)
+
+        outs_shm = shared_memory.SharedMemory(create=True, size=max(1, fold['labels'].nbytes))
+        outs = np.ndarray((n, 1), dtype=fold['labels'].dtype, buffer=outs_shm.buf)
+        outs[:, 0] = fold['labels'] - 1
+
+        blocks += [ins_shm, outs_shm]
+        spec['folds'].append({'ins': ins_shm.name,
+                              'outs': outs_shm.name,
+                              'n': n,
+                              'len_max': len_max,
+                              'ins_dtype': fold['tokens'].dtype.str,
+                              'outs_dtype': fold['labels'].dtype.str})
+        del ins, outs
+
+    return spec, blocks
+
+
+# Blocks that this process has attached to (kept open for the lifetime of the process)
+_attached = {}
+
+def _attach(name, shape, dtype):
+    '''
+    Attach to a shared memory block (once per process)
+
+    :param name: Name of the block
+    :param shape: Shape of the array in the block
+    :param dtype: Type of the array in the block
+    :return: Array backed by the shared memory block
+    '''
+    if name not in _attached:
+        # Workers share the resource tracker of the process that created the block, which
+        #  unlinks it: attaching does not transfer ownership
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+
+def attach_rotation(spec, rotation = 0, nfolds = 5, ntrain_folds = 3):
+    '''
+    Build a rotation from the shared folds without copying the inputs
+
+    :param spec: Description of the shared folds from create_shared_folds()
+    :param rotation: Rotation to build
+    :param nfolds: Total number of folds
+    :param ntrain_folds: Number of training folds to use
+
+    :return: Dictionary in the format of prepare_data_set(), except that ins_train/ins_valid/ins_test
+             are lists of views (one per fold); see create_dataset()
+    '''
+    width = spec['width']
+    splits = dict(zip(['train', 'valid', 'test'], rotation_folds(rotation, nfolds, ntrain_folds)))
+
+    # Compute max length: only defined with respect to the training set
+    len_max = max(spec['folds'][f]['len_max'] for f in splits['train'])
+
+    dat_out = {}
+    for k, fs in splits.items():
+        ins = []
+        outs = []
+        for f in fs:
+            fold = spec['folds'][f]
+            ins.append(_attach(fold['ins'], (fold['n'], width), np.dtype(fold['ins_dtype']))[:, width - len_max:])
+            outs.append(_attach(fold['outs'], (fold['n'], 1), np.dtype(fold['outs_dtype'])))
+        dat_out['ins_'+k] = ins
+        # Labels are small: these are copied
+        dat_out['outs_'+k] = np.concatenate(outs)
+
+    dat_out['len_max'] = len_max
+    dat_out['n_tokens'] = spec['n_tokens']
+    dat_out['word_index'] = dict(spec['word_index'])
+    dat_out['out_word_index'] = dict(spec['out_word_index'])
+    dat_out['out_index_word'] = {i: w for w, i in spec['out_word_index'].items()}
+    dat_out['rotation'] = rotation
+
+    return dat_out
+
+
+def check_shared_args(args):
+    '''
+    Reject the hw6_base.py options that the views of the shared folds do not support (see
+    pfam_loader.create_dataset()), before any worker starts
+
+    :param args: hw6_base.py arguments
+    '''
+    assert args.crop_window is None, "Shared folds cannot be cropped (--crop_window)"
+    assert not args.balance, "Shared folds cannot be balanced (--balance)"
+    assert args.bucket_boundaries is None, "Shared folds cannot be bucketed (--bucket_boundaries)"
+    assert args.cache is None, "Shared folds cannot be cached (--cache)"
+
+
+def _init_worker(core_sets, gpu):
+    '''
+    Worker process initialization: claim a set of cores and size the TF thread pools to match.
+    This happens once per worker (the thread pools cannot be changed after TF starts up)
+
+    :param core_sets: Queue of core lists (one per worker)
+    :param gpu: Use a GPU
+    '''
+    cores = core_sets.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    if not gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(len(cores))
+
+
+def _run_job(argv, exp_index, spec):
+    '''
+    Train and evaluate one JobIterator index in a worker process
+
+    :param argv: hw6_base.py arguments
+    :param exp_index: Experiment index
+    :param spec: Description of the shared folds from create_shared_folds()
+    :return: Experiment index
+    '''
+    import tensorflow as tf
+    import hw6_base
+
+    args = hw6_base.create_parser().parse_args(argv)
+    args.exp_index = exp_index
+    # Views are only read through the tf.data pipeline
+    args.tf_data = True
+    hw6_base.check_args(args)
+    check_shared_args(args)
+    # Thread pools were already sized by _init_worker()
+    args.cpus_per_task = None
+
+    # Models of earlier jobs in this worker are no longer needed
+    tf.keras.backend.clear_session()
+
+    hw6_base.execute_exp(args, data_loader=lambda a: attach_rotation(spec, rotation=a.rotation,
+                                                                     nfolds=a.Nfolds,
+                                                                     ntrain_folds=a.Ntraining))
+    return exp_index
+
+
+def run_shared(argv, exp_indices, nworkers, cores = None, chunksize = None):
+    '''
+    Load the folds once and train the given JobIterator indices on a pool of workers
+
+    :param argv: hw6_base.py arguments (shared by all jobs)
+    :param exp_indices: List of experiment indices to execute
+    :param nworkers: Number of concurrent workers
+    :param cores: List of cores to split between the workers (None -> all cores available to this process)
+    :param chunksize: Number of CSV rows to read at once when building caches (None -> whole folds)
+    '''
+    import hw6_base
+
+    args = hw6_base.create_parser().parse_args(argv)
+    hw6_base.check_args(args)
+    check_shared_args(args)
+
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    nworkers = max(1, min(nworkers, len(exp_indices)))
+    per_worker = max(1, len(cores) // nworkers)
+
+    spec, blocks = create_shared_folds(basedir=args.dataset, nfolds=args.Nfolds, cachedir=args.cache_dir,
+                                       chunksize=chunksize)
+    print('Shared folds: %.1f MB' % (sum(b.size for b in blocks) / 2**20))
+
+    try:
+        # TensorFlow must not be forked: start fresh worker processes
+        ctx = mp.get_context('spawn')
+        core_sets = ctx.Queue()
+        for w in range(nworkers):
+            # Disjoint sets of cores (shared round-robin if there are more workers than cores)
+            core_sets.put([cores[(w * per_worker + j) % len(cores)] for j in range(per_worker)])
+
+        with ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(core_sets, args.gpu)) as pool:
+            futures = [pool.submit(_run_job, argv, i, spec) for i in exp_indices]
+            for f in futures:
+                print('Finished exp_index %d' % f.result())
+    finally:
+        for b in blocks:
+            b.close()
+            b.unlink()
+
+
+def create_parser():
+    '''
+    Create argument parser (the remaining arguments are passed on to hw6_base.py)
+    '''
+    parser = argparse.ArgumentParser(description='Shared-memory multi-rotation trainer', fromfile_prefix_chars='@')
+    parser.add_argument('--exp_indices', nargs='+', type=int, default=None,
+                        help='Experiment indices to execute (default: all JobIterator indices)')
+    parser.add_argument('--nworkers', type=int, default=5, help='Number of concurrent workers')
+    parser.add_argument('--chunksize', type=int, default=None, help='CSV rows to read at once when building caches')
+
+    return parser
+
+
+if __name__ == "__main__":
+    args, argv = create_parser().parse_known_args()
+
+    exp_indices = args.exp_indices
+    if exp_indices is None:
+        import hw6_base
+        from job_control import JobIterator
+        exp_indices = list(range(JobIterator(hw6_base.exp_type_to_hyperparameters(
+            hw6_base.create_parser().parse_args(argv))).get_njobs()))
+
+    run_shared(argv, exp_indices, args.nworkers, chunksize=args.chunksize)
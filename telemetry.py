@@ -0,0 +1,159 @@
+'''
+Training telemetry
+
+TelemetryCallback records, for every epoch:
+- wall time of the epoch (including validation) and of the training steps alone
+- training throughput (samples/sec)
+- resident memory: current and peak RSS of the process
+
+With step timing, it also records:
+- step latency percentiles (from the start of a step to its end)
+- input wait: the time between the end of one step and the start of the next, which is
+  where Keras fetches the next batch from the input pipeline (plus a small, constant
+  callback overhead).  A large share of input wait means the run is input bound
+
+Optionally, a TF profiler trace is captured for a window of (global) training steps; the
+trace can be opened with TensorBoard's profile plugin.
+
+Note: a callback with batch hooks makes Keras wait for each step to finish before calling
+them (so the latencies are those of complete steps), which takes fit() off its fast path.
+The batch hooks are therefore only installed for step timing or profiling; otherwise, the
+training time is measured from the start of the epoch to the start of its validation.
+
+'''
+import os
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Step latency percentiles to report
+PERCENTILES = [50, 90, 99]
+
+
+def current_rss():
+    '''
+    :return: Resident set size of this process (bytes), or None if it is not available
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss():
+    '''
+    :return: Peak resident set size of this process (bytes)
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class TelemetryCallback(tf.keras.callbacks.Callback):
+    def __init__(self, batch_size, step_timing=False, profile_steps=None, profile_dir=None):
+        '''
+        @param batch_size Training batch size (used for the throughput)
+        @param step_timing Time every training step (step latencies and input wait)
+        @param profile_steps Pair (first, last) of global training steps to trace with the TF profiler
+                             (None -> no trace)
+        @param profile_dir Directory for the profiler trace
+        '''
+        super().__init__()
+        self.batch_size = batch_size
+        self.step_timing = step_timing or profile_steps is not None
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        assert profile_steps is None or profile_dir is not None, "A profile directory is required"
+
+        # Keras only calls the batch hooks of callbacks that override them
+        if self.step_timing:
+            self.on_train_batch_begin = self._on_train_batch_begin
+            self.on_train_batch_end = self._on_train_batch_end
+
+        self.epochs = []
+        self.global_step = 0
+        self.profiling = False
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.train_end = None
+        self.step_start = None
+        self.last_step_end = None
+        self.latencies = []
+        self.waits = []
+
+    def on_test_begin(self, logs=None):
+        # The validation of an epoch starts where its training steps end
+        if self.train_end is None:
+            self.train_end = time.perf_counter()
+
+    def _on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps is not None and self.global_step == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.profile_dir)
+            self.profiling = True
+
+        self.step_start = time.perf_counter()
+        if self.last_step_end is not None:
+            self.waits.append(self.step_start - self.last_step_end)
+        else:
+            self.first_step_start = self.step_start
+
+    def _on_train_batch_end(self, batch, logs=None):
+        self.last_step_end = time.perf_counter()
+        self.latencies.append(self.last_step_end - self.step_start)
+
+        if self.profiling and self.global_step >= self.profile_steps[1]:
+            self._stop_profiler()
+        self.global_step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        end = time.perf_counter()
+        if self.step_timing:
+            steps = len(self.latencies)
+            train_time = self.last_step_end - self.first_step_start if steps > 0 else 0.0
+            input_wait = float(np.sum(self.waits))
+        else:
+            steps = self.params.get('steps')
+            train_time = (end if self.train_end is None else self.train_end) - self.epoch_start
+            input_wait = None
+        latencies = np.array(self.latencies) * 1000
+
+        entry = {'epoch': epoch,
+                 'wall_time': end - self.epoch_start,
+                 'train_time': train_time,
+                 'steps': steps,
+                 'samples_per_sec': steps * self.batch_size / train_time if steps and train_time > 0 else None,
+                 'input_wait': input_wait,
+                 'input_wait_fraction': input_wait / train_time if input_wait is not None and train_time > 0
+                 else None,
+                 'rss': current_rss(),
+                 'peak_rss': peak_rss()}
+        for p in PERCENTILES:
+            entry['step_ms_p%d' % p] = float(np.percentile(latencies, p)) if len(latencies) > 0 else None
+        self.epochs.append(entry)
+
+    def on_train_end(self, logs=None):
+        if self.profiling:
+            self._stop_profiler()
+
+    def _stop_profiler(self):
+        tf.profiler.experimental.stop()
+        self.profiling = False
+
+    def summary(self):
+        '''
+        @return Dictionary: 'epochs' (list of per-epoch entries) and totals over all epochs
+        '''
+        train_time = sum(e['train_time'] for e in self.epochs)
+        steps = sum(e['steps'] or 0 for e in self.epochs)
+        wait = sum(e['input_wait'] or 0.0 for e in self.epochs)
+        return {'epochs': self.epochs,
+                'wall_time': sum(e['wall_time'] for e in self.epochs),
+                'train_time': train_time,
+                'samples_per_sec': steps * self.batch_size / train_time if steps and train_time > 0 else None,
+                'input_wait_fraction': wait / train_time if self.step_timing and train_time > 0 else None,
+                'peak_rss': peak_rss(),
+                'profile_dir': self.profile_dir if self.profile_steps is not None else None}
@@ -0,0 +1,64 @@
+'''
+Parity of the vectorized tokenizer (pfam_loader) with the keras Tokenizer + pad_sequences path
+that prepare_data_set() originally used
+
+python -m pytest -q test_pfam_loader.py
+
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+tf = pytest.importorskip('tensorflow')
+
+from pfam_loader import encode_labels, fit_char_vocabulary, fit_label_vocabulary, texts_to_padded
+
+# Ties in the character counts (e.g., 'C'/'D') are broken by first occurrence
+TRAIN_STRINGS = ['MKVLAAG', 'ACDEFGHIK', 'LMNPQRST', 'VWYAAKK', 'GG']
+TRAIN_LABELS = ['PF00001', 'PF00002', 'PF00001', 'PF00003', 'PF00002']
+
+# Unseen characters ('X', 'U', 'B', non-latin-1, lower case is folded), a string longer than
+#  len_max and an empty string
+STRINGS = ['MKXVLU', 'ACDEFGHIKLMNPQRSTVWY', 'B', '', 'mkvl', 'GGAA', 'M\u20acK\u03b1V']
+LABELS = ['PF00003', 'PF00001', 'PF00002', 'PF00001', 'pf00002', 'PF00003', 'PF00001']
+LEN_MAX = 8
+
+
+def keras_tokenize(train_strings, train_labels, strings, labels, len_max):
+    tokenizer = tf.keras.preprocessing.text.Tokenizer(char_level=True, filters='\t\n')
+    tokenizer.fit_on_texts(train_strings)
+    ins = tf.keras.preprocessing.sequence.pad_sequences(tokenizer.texts_to_sequences(strings), maxlen=len_max)
+
+    label_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters='\t\n')
+    label_tokenizer.fit_on_texts(train_labels)
+    outs = np.array(label_tokenizer.texts_to_sequences(labels)) - 1
+
+    return tokenizer.word_index, ins, label_tokenizer.word_index, outs
+
+
+def test_vocabulary_matches_keras():
+    word_index, _, out_word_index, _ = keras_tokenize(TRAIN_STRINGS, TRAIN_LABELS, STRINGS, LABELS, LEN_MAX)
+
+    assert fit_char_vocabulary([TRAIN_STRINGS]) == word_index
+    assert fit_label_vocabulary([TRAIN_LABELS]) == out_word_index
+
+
+def test_vocabulary_from_several_sets_matches_keras():
+    word_index, _, out_word_index, _ = keras_tokenize(TRAIN_STRINGS, TRAIN_LABELS, STRINGS, LABELS, LEN_MAX)
+
+    assert fit_char_vocabulary([TRAIN_STRINGS[:2], TRAIN_STRINGS[2:]]) == word_index
+    assert fit_label_vocabulary([TRAIN_LABELS[:3], TRAIN_LABELS[3:]]) == out_word_index
+
+
+@pytest.mark.parametrize('len_max', [1, LEN_MAX, 25])
+def test_padded_tokens_match_keras(len_max):
+    _, ins_keras, _, outs_keras = keras_tokenize(TRAIN_STRINGS, TRAIN_LABELS, STRINGS, LABELS, len_max)
+
+    word_index = fit_char_vocabulary([TRAIN_STRINGS])
+    out_word_index = fit_label_vocabulary([TRAIN_LABELS])
+    ins = texts_to_padded(STRINGS, word_index, len_max)
+    outs = encode_labels(LABELS, out_word_index).reshape(-1, 1) - 1
+
+    assert ins.shape == ins_keras.shape
+    assert np.array_equal(ins, ins_keras)
+    assert np.array_equal(outs, outs_keras)
@@ -0,0 +1,335 @@
+'''
+TFLite export and CPU inference benchmark
+
+export_tflite() converts a trained create_network() model into a TFLite flat buffer:
+
+float32  no quantization (the reference for the converter itself)
+dynamic  dynamic-range quantization: int8 weights, float activations.  Needs no data
+int8     full-integer quantization: int8 weights and activations, calibrated from a
+         sample of the rotation's training inputs (ops without an int8 kernel, e.g.,
+         parts of the recurrent loop, stay in float)
+
+The token inputs are uint8 in all variants and the outputs are float probabilities, so an
+exported model is a drop-in replacement for the Keras model (see TFLiteModel).
+
+benchmark_exports() compares the variants against the float Keras model on the rotation's
+test split: accuracy, loss, agreement with the Keras predictions, file size, single-example
+latency and batched throughput.
+
+Examples:
+
+# Export the dynamic-range and int8 variants of a finished run and benchmark them
+python tflite_export.py --model results/amino__..._rot_00 --quantization dynamic int8 --benchmark
+
+# Export while training
+python hw6_base.py @parameters.txt --exp_index 0 --tflite dynamic int8
+
+Files: <fbase>_model_<quantization>.tflite and (benchmark) <fbase>_tflite.json
+
+'''
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from pfam_loader import window_examples
+from results_io import TFLITE_SUFFIX, TFLITE_REPORT_SUFFIX, read_results
+
+QUANTIZATIONS = ['float32', 'dynamic', 'int8']
+
+
+def tflite_fname(fbase, quantization):
+    '''
+    :param fbase: File base of the run
+    :param quantization: One of QUANTIZATIONS
+    :return: Name of the exported model
+    '''
+    return fbase + TFLITE_SUFFIX % quantization
+
+
+def calibration_sample(ins, n=500, window=None, stride=None, seed=0):
+    '''
+    Random sample of training inputs for the int8 calibration
+
+    :param ins: Left-padded training inputs (examples x len_max), or a list of such arrays
+                (see pfam_loader.create_dataset())
+    :param n: Number of examples
+    :param window: Window length of the model (None -> whole sequences).  The sampled sequences are
+                   cut into windows, as at inference time
+    :param stride: Distance between consecutive windows (None -> window // 2)
+    :param seed: Seed of the sample
+    :return: Calibration inputs (examples x model input length), uint8
+    '''
+    rng = np.random.default_rng(seed)
+    parts = ins if isinstance(ins, list) else [ins]
+    bounds = np.cumsum([0] + [len(a) for a in parts])
+    index = np.sort(rng.choice(bounds[-1], size=min(n, bounds[-1]), replace=False))
+    # Gather from each array separately (the arrays may be views of shared memory)
+    sample = np.concatenate([np.asarray(a[index[(index >= lo) & (index < hi)] - lo])
+                             for a, lo, hi in zip(parts, bounds[:-1], bounds[1:])])
+    if window is not None:
+        sample, _ = window_examples(sample, window, max(1, window // 2) if stride is None else stride)
+        sample = sample[rng.permutation(len(sample))[:n]]
+    return sample.astype(np.uint8)
+
+
+def export_tflite(model, fname, quantization='dynamic', calibration=None):
+    '''
+    Convert a Keras model to TFLite
+
+    :param model: Keras model with a fixed input length (uint8 tokens)
+    :param fname: Output file
+    :param quantization: One of QUANTIZATIONS
+    :param calibration: Calibration inputs (examples x input length; 'int8' only)
+    :return: Size of the flat buffer (bytes)
+    '''
+    import tensorflow as tf
+
+    assert quantization in QUANTIZATIONS, "Unknown quantization %s" % quantization
+    len_in = model.input_shape[1]
+    assert len_in is not None, "TFLite export needs a model with a fixed input length (no bucketing)"
+
+    # Batch dimension stays dynamic; the interpreter is resized to the batch at hand
+    fn = tf.function(lambda x: model(x, training=False),
+                     input_signature=[tf.TensorSpec([None, len_in], tf.uint8)])
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([fn.get_concrete_function()], model)
+
+    if quantization != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'int8':
+        assert calibration is not None, "int8 quantization needs calibration inputs"
+
+        def representative():
+            for i in range(len(calibration)):
+                yield [calibration[i:i + 1]]
+
+        converter.representative_dataset = representative
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+
+    flat = converter.convert()
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(flat)
+    os.replace(tmp, fname)
+    return len(flat)
+
+
+def export_run(model, fbase, quantizations, ins_train=None, n_calibration=500, window=None, stride=None):
+    '''
+    Export several variants of a run's model
+
+    :param model: Keras model
+    :param fbase: File base of the run
+    :param quantizations: List of QUANTIZATIONS
+    :param ins_train: Training inputs (needed for 'int8')
+    :param n_calibration: Number of calibration examples
+    :param window: Window length of the model (None -> whole sequences)
+    :param stride: Distance between consecutive windows
+    :return: Dictionary quantization -> file name
+    '''
+    calibration = None
+    if 'int8' in quantizations:
+        calibration = calibration_sample(ins_train, n=n_calibration, window=window, stride=stride)
+
+    fnames = {}
+    for q in quantizations:
+        fnames[q] = tflite_fname(fbase, q)
+        export_tflite(model, fnames[q], quantization=q, calibration=calibration)
+        print('Exported %s (%.1f kB)' % (fnames[q], os.path.getsize(fnames[q]) / 1024))
+    return fnames
+
+
+class TFLiteModel:
+    def __init__(self, fname, threads=None, regularization=0.0):
+        '''
+        Exported model with the part of the Keras model interface that evaluation.py uses
+
+        @param fname TFLite file
+        @param threads Number of interpreter threads (None -> TFLite default)
+        @param regularization Regularization loss of the source Keras model (the exported file
+                              does not carry the regularizers), so that the reported loss is
+                              comparable with the Keras one
+        '''
+        import tensorflow as tf
+
+        self.interpreter = tf.lite.Interpreter(model_path=fname, num_threads=threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.losses = [regularization]
+        self.shape = None
+
+    def _resize(self, shape):
+        if shape != self.shape:
+            self.interpreter.resize_tensor_input(self.input['index'], shape)
+            self.interpreter.allocate_tensors()
+            self.shape = shape
+
+    def predict(self, ins, batch_size=1024, verbose=0):
+        '''
+        :param ins: Inputs (examples x input length)
+        :param batch_size: Examples per interpreter call
+        :return: Class probabilities (examples x classes)
+        '''
+        out = []
+        for start in range(0, len(ins), batch_size):
+            x = np.asarray(ins[start:start + batch_size], dtype=self.input['dtype'])
+            self._resize(list(x.shape))
+            self.interpreter.set_tensor(self.input['index'], x)
+            self.interpreter.invoke()
+            out.append(self.interpreter.get_tensor(self.output['index']).astype(np.float32))
+        return np.concatenate(out)
+
+
+def _latency(model, ins, n=200):
+    '''
+    :param model: Keras model or TFLiteModel
+    :param ins: Model inputs
+    :param n: Number of examples to time
+    :return: Single-example latencies (ms): median and 90th percentile over n examples
+    '''
+    times = []
+    for i in range(min(n, len(ins))):
+        start = time.perf_counter()
+        model.predict(ins[i:i + 1], batch_size=1, verbose=0)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return float(np.percentile(times, 50)), float(np.percentile(times, 90))
+
+
+def benchmark_model(model, ins, labels, batch=256, window=None, stride=None, aggregate='logit', n_latency=200):
+    '''
+    Accuracy and CPU cost of a model on a data set
+
+    :param model: Keras model or TFLiteModel
+    :param ins: Left-padded inputs (examples x len_max)
+    :param labels: True class indices
+    :param batch: Batch size of the throughput measurement
+    :param window: Window length of the model (None -> whole sequences)
+    :param stride: Distance between consecutive windows (required with a window)
+    :param aggregate: Combination of the windows of a sequence
+    :param n_latency: Number of single examples (or windows) timed for the latency
+    :return: Dictionary of metrics, with the predictions under 'predictions'
+    '''
+    from evaluation import evaluate_model
+
+    # Inputs of the model itself: whole sequences or windows.  The first call traces/allocates
+    head = np.asarray(ins[:max(batch, n_latency)])
+    single = head if window is None else window_examples(head, window, stride)[0]
+    model.predict(single[:batch], batch_size=batch, verbose=0)
+
+    start = time.perf_counter()
+    ev = evaluate_model(model, {'test': (ins, labels)}, batch=batch, splits=['test'], window=window, stride=stride,
+                        aggregate=aggregate)['test']
+    elapsed = time.perf_counter() - start
+
+    p50, p90 = _latency(model, single, n=n_latency)
+    return {'accuracy': ev['accuracy'],
+            'loss': ev['loss'],
+            'examples_per_sec': len(labels) / elapsed,
+            'latency_ms_p50': p50,
+            'latency_ms_p90': p90,
+            'predictions': ev['predictions']}
+
+
+def benchmark_exports(model, fnames, ins, labels, batch=256, threads=None, window=None, stride=None,
+                      aggregate='logit'):
+    '''
+    Compare exported variants with the Keras model
+
+    :param model: Keras model
+    :param fnames: Dictionary quantization -> TFLite file (see export_run())
+    :param ins: Test inputs (examples x len_max)
+    :param labels: Test class indices
+    :param batch: Batch size
+    :param threads: Number of interpreter threads
+    :param window: Window length of the model (None -> whole sequences)
+    :param stride: Distance between consecutive windows (None -> window // 2)
+    :param aggregate: Combination of the windows of a sequence
+    :return: Dictionary variant ('keras', then each quantization) -> metrics.  'agreement' is the
+             fraction of examples whose predicted class matches the Keras model's
+    '''
+    if window is not None and stride is None:
+        stride = max(1, window // 2)
+
+    from evaluation import regularization_loss
+
+    report = {}
+    regularization = regularization_loss(model)
+    ref = benchmark_model(model, ins, labels, batch=batch, window=window, stride=stride, aggregate=aggregate)
+    ref_class = np.argmax(ref.pop('predictions'), axis=1)
+    report['keras'] = dict(ref, agreement=1.0, bytes=None)
+
+    for q, fname in fnames.items():
+        tflite_model = TFLiteModel(fname, threads=threads, regularization=regularization)
+        res = benchmark_model(tflite_model, ins, labels, batch=batch, window=window, stride=stride,
+                              aggregate=aggregate)
+        res['agreement'] = float(np.mean(np.argmax(res.pop('predictions'), axis=1) == ref_class))
+        res['bytes'] = os.path.getsize(fname)
+        report[q] = res
+    return report
+
+
+def format_report(report):
+    '''
+    :param report: From benchmark_exports()
+    :return: Human-readable table
+    '''
+    lines = ['%-8s %8s %8s %9s %10s %10s %10s' % ('variant', 'acc', 'agree', 'kB', 'ex/sec', 'p50 ms', 'p90 ms')]
+    for name, r in report.items():
+        lines.append('%-8s %8.4f %8.4f %9s %10.1f %10.3f %10.3f' % (
+            name, r['accuracy'], r['agreement'], '-' if r['bytes'] is None else '%.1f' % (r['bytes'] / 1024),
+            r['examples_per_sec'], r['latency_ms_p50'], r['latency_ms_p90']))
+    return '\n'.join(lines)
+
+
+def create_parser():
+    '''
+    Create argument parser
+    '''
+    parser = argparse.ArgumentParser(description='TFLite export and CPU benchmark of a trained model',
+                                     fromfile_prefix_chars='@')
+    parser.add_argument('--model', type=str, required=True, help='File base of the run')
+    parser.add_argument('--quantization', nargs='+', type=str, default=['dynamic', 'int8'], choices=QUANTIZATIONS,
+                        help='Variants to export')
+    parser.add_argument('--calibration', type=int, default=500, help='Training examples used to calibrate int8')
+    parser.add_argument('--benchmark', action='store_true', help='Compare the variants on the test split')
+    parser.add_argument('--max_examples', type=int, default=None, help='Benchmark on the first examples only')
+    parser.add_argument('--batch', type=int, default=256, help='Batch size of the benchmark')
+    parser.add_argument('--threads', type=int, default=None, help='Interpreter/TensorFlow threads')
+    parser.add_argument('--dataset', type=str, default=None, help='Data set directory (default: that of the run)')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Fold cache directory (default: that of the run)')
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+
+    import tensorflow as tf
+    from pfam_loader import load_rotation
+    from predictor import read_vocabulary
+
+    if args.threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+        tf.config.threading.set_inter_op_parallelism_threads(args.threads)
+
+    # The run's arguments locate its rotation; its vocabulary file holds the window settings
+    run_args = read_results(args.model, fields=['args'])['args']
+    vocab = read_vocabulary(args.model)
+    dat = load_rotation(basedir=args.dataset or run_args.dataset, rotation=run_args.rotation,
+                        nfolds=run_args.Nfolds, ntrain_folds=run_args.Ntraining,
+                        cachedir=args.cache_dir or getattr(run_args, 'cache_dir', None))
+
+    model = tf.keras.models.load_model('%s_model' % args.model, compile=False)
+    fnames = export_run(model, args.model, args.quantization, ins_train=dat['ins_train'],
+                        n_calibration=args.calibration, window=vocab['window'], stride=vocab['stride'])
+
+    if args.benchmark:
+        n = len(dat['ins_test']) if args.max_examples is None else args.max_examples
+        report = benchmark_exports(model, fnames, dat['ins_test'][:n], dat['outs_test'][:n], batch=args.batch,
+                                   threads=args.threads, window=vocab['window'], stride=vocab['stride'],
+                                   aggregate=vocab['aggregate'])
+        print(format_report(report))
+        with open(args.model + TFLITE_REPORT_SUFFIX, 'w') as fp:
+            json.dump(report, fp, indent=1)